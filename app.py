@@ -6,7 +6,8 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QApplication
 
 from exceptions import NotFound
-from model import ApplicationModel, DatumModel, GridModel
+from model import ApplicationModel, DatumModel, GridModel, \
+    datum_name_exists, get_storage
 from views import WrenWindow
 from wren import log
 
@@ -71,17 +72,26 @@ class WrenApplication:
         self.app.setWindowIcon(QIcon(path))
 
         self.init_data()
+        # Interactive saves (cursor moves, scrolling) are written behind.
+        get_storage().start_writer()
 
         self.main_window = WrenWindow()
         self.main_window.setup()
         self.main_window.grid.view.setFocus()
 
     def run(self):
-        return self.app.exec_()
+        try:
+            return self.app.exec_()
+        finally:
+            # Write out anything the write-behind thread has not yet.
+            get_storage().close()
 
     def get_next_name(self):
-        retval = self.name_model.data
-        num = int(retval)
+        num = int(self.name_model.data)
+        # Skip numbers a Datum has already been given as its name.
+        while datum_name_exists(str(num)):
+            num += 1
+        retval = str(num)
         num += 1
         self.name_model.data = str(num)
         self.name_model.save()
@@ -0,0 +1,297 @@
+"""Benchmarks for Wren.
+
+Run all of them with 'python bench.py', or name the ones to run, ex:
+'python bench.py grid_codec'.
+
+"""
+import sys
+import time
+from uuid import uuid1
+
+from wren import log
+
+
+def _best_time(func, repeat=5):
+    """Best time of repeat calls to func, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _memory_storage():
+    import model
+    model._STORAGE = model.WrenData.initialize(file_name=':memory:')
+    model.get_model_id_map()._reset()
+
+
+def bench_grid_codec(rows=10000):
+    """Encode and decode a grid row, json against the binary codec.
+
+    The row is only the offsets, cursors and clipboard, the rest of the
+    grid is in its own tables.
+
+    """
+    import json
+    import codec
+    main_cursor = (uuid1().hex, 2, 2)
+    secondary_cursor = (uuid1().hex, 2, 2)
+    clipboard_datum_key = uuid1().hex
+
+    def encode_json():
+        # As GridModel.serialize_json, cursors are json inside the json.
+        return json.dumps([{
+            name: json.dumps([key, 'grid_key', x, y, name])
+            for name, (key, x, y) in [('main', main_cursor),
+                                      ('secondary', secondary_cursor)]},
+            {}, 0, -2, [], clipboard_datum_key])
+
+    def decode_json(value):
+        values = json.loads(value)
+        for s_cursor in values[0].values():
+            json.loads(s_cursor)
+        return values
+
+    def encode_binary():
+        return codec.encode_grid(0, -2, main_cursor, secondary_cursor,
+                                 clipboard_datum_key)
+
+    results = []
+    for name, encode, decode in [
+            ('json', encode_json, decode_json),
+            ('binary', encode_binary, codec.decode_grid)]:
+        value = encode()
+        if isinstance(value, str):
+            size = len(value.encode('utf-8'))
+        else:
+            size = len(value)
+
+        def encode_rows():
+            for _ in range(rows):
+                encode()
+
+        def decode_rows():
+            for _ in range(rows):
+                decode(value)
+        encode_time = _best_time(encode_rows) / rows
+        decode_time = _best_time(decode_rows) / rows
+        results.append((name, size, encode_time, decode_time))
+
+    print('grid_codec: a grid row, best of {} rows'.format(rows))
+    json_size, json_encode, json_decode = results[0][1:]
+    for name, size, encode_time, decode_time in results:
+        print('  {:8} {:>5,} bytes ({:5.1f}%)  encode {:6.2f}us ({:4.1f}x)'
+              '  decode {:6.2f}us ({:4.1f}x)'.format(
+                  name, size, 100.0 * size / json_size,
+                  encode_time * 1e6, json_encode / encode_time,
+                  decode_time * 1e6, json_decode / decode_time))
+
+
+def bench_grid_save(datums=20000, scored=2000, cells=5, saves=200):
+    """Small changes to a big grid: a cursor move and a relationship edit."""
+    from model import GridModel, get_storage
+    _memory_storage()
+    datum_keys = [uuid1().hex for _ in range(datums)]
+    grid_model = GridModel()
+    with get_storage().batch():
+        for i, a_key in enumerate(datum_keys[:scored]):
+            for j in range(1, cells + 1):
+                grid_model.set_relationship(
+                    a_key, datum_keys[(i + j) % datums], '.{}'.format(j))
+        for datum_key in datum_keys:
+            grid_model.add_active_datum(datum_key)
+        grid_model.save()
+    cursor_model = grid_model.main_cursor_model
+
+    def move_cursor():
+        for _ in range(saves):
+            cursor_model.x += 1
+            cursor_model.save()
+
+    def edit_relationship():
+        for i in range(saves):
+            grid_model.set_relationship(datum_keys[0], datum_keys[1], str(i))
+
+    print('grid_save: {} active datums, {} relationship cells, row is {} '
+          'bytes'.format(datums, scored * cells, len(grid_model.serialize())))
+    for name, func in [('cursor move', move_cursor),
+                       ('relationship edit', edit_relationship)]:
+        print('  {:18} {:7.3f}ms per save'.format(
+            name, _best_time(func) * 1000 / saves))
+
+
+def _bytes_written():
+    """Bytes this process has passed to write(), None if unknown."""
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def bench_kvs(datums=5000, rankings=200, ranked=20):
+    """The sqlite and log kvs backends on an import, Datums saved in one
+    batch, and on ranking, small saves committed one at a time."""
+    import json
+    import os
+    import tempfile
+    import codec
+    from model import WrenData
+
+    datum_keys = [uuid1().hex for _ in range(datums)]
+    grid_key = uuid1().hex
+
+    def datum_value(i):
+        return json.dumps(['term.n.{:02}'.format(i), str(i),
+                           15000000000000000 + i, None])
+
+    def import_datums(storage):
+        with storage.batch():
+            for i, key in enumerate(datum_keys):
+                storage.write(key, 'DatumModel', datum_value(i))
+
+    def rank(storage):
+        # Each ranking saves the grid row, a cursor and the Datums it
+        # ranked, each save on its own like interactive saves.
+        for i in range(rankings):
+            storage.write(grid_key, 'GridModel', codec.encode_grid(
+                i, -2, (uuid1().hex, 2, 2), (uuid1().hex, 2, 2),
+                datum_keys[0]))
+            storage.write('cursor', 'CursorModel', json.dumps(
+                ['datum', grid_key, 2, i, 'main']))
+            for j in range(ranked):
+                k = (i * ranked + j) % datums
+                storage.write(datum_keys[k], 'DatumModel', datum_value(k))
+
+    print('kvs: import {} Datums in a batch, {} rankings of {} saves'.format(
+        datums, rankings, ranked + 2))
+    for backend in ['sqlite', 'log']:
+        with tempfile.TemporaryDirectory() as directory:
+            storage = WrenData.initialize(
+                file_name=os.path.join(directory, 'wren.db'),
+                backend=backend)
+            for name, func, saves in [
+                    ('import', import_datums, datums),
+                    ('ranking', rank, rankings * (ranked + 2))]:
+                logical = 0
+                write = storage.kvs.write
+
+                def counting_write(key, kind, value):
+                    nonlocal logical
+                    logical += len(key) + len(kind) + len(value)
+                    write(key, kind, value)
+                storage.kvs.write = counting_write
+                written = _bytes_written()
+                start = time.perf_counter()
+                func(storage)
+                elapsed = time.perf_counter() - start
+                storage.kvs.write = write
+                if written is None:
+                    amplification = 'n/a'
+                else:
+                    amplification = '{:5.1f}x'.format(
+                        (_bytes_written() - written) / logical)
+                print('  {:6} {:8} {:8.3f}ms per save  write amplification '
+                      '{}'.format(backend, name, elapsed * 1000 / saves,
+                                  amplification))
+            storage.close()
+
+
+def bench_distance(sizes=(1181, 82115), dim=5, anchors=48):
+    """The numpy distance kernels against poincare.model's torch
+    PoincareDistance, as scoring called it, for the mammals and the size of
+    WordNet's nouns."""
+    import numpy as np
+    import torch as th
+    from torch.autograd import Variable
+    import distance
+    import poincare.model
+
+    print('distance: poincare, one anchor to all, {} anchors to all'.format(
+        anchors))
+    for size in sizes:
+        rows = np.random.uniform(-1, 1, (size, dim))
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        rows *= np.random.uniform(0, 0.999, (size, 1))
+        tensor = Variable(th.from_numpy(rows))
+        torch_distance = poincare.model.PoincareDistance()
+
+        def torch_one(i=0):
+            # forward, as calling the legacy Function needs torch 0.4
+            s_e = Variable(tensor.data[i].expand_as(tensor))
+            return torch_distance.forward(s_e, tensor).data.numpy()
+
+        def torch_many():
+            return [torch_one(i) for i in range(anchors)]
+
+        kernel = distance.PoincareDistance(rows)
+        results = [
+            ('torch', _best_time(torch_one), _best_time(torch_many)),
+            ('numpy', _best_time(lambda: kernel.one_to_many(rows[0])),
+             _best_time(lambda: kernel.pairwise(rows[:anchors])))]
+        _, torch_one_time, torch_many_time = results[0]
+        print('  {:,} terms'.format(size))
+        for name, one_time, many_time in results:
+            print('    {:6} one {:8.3f}ms ({:4.1f}x)  many {:8.2f}ms '
+                  '({:4.1f}x)'.format(name, one_time * 1000,
+                                      torch_one_time / one_time,
+                                      many_time * 1000,
+                                      torch_many_time / many_time))
+
+
+def bench_vptree(sizes=(1181, 82115, 500000), dim=5, k=20, queries=50):
+    """k nearest with vptree.VPTree, exact and approximate, against a pass
+    over every row."""
+    import numpy as np
+    import distance
+    from vptree import VPTree
+
+    print('vptree: {} nearest'.format(k))
+    for size in sizes:
+        rows = np.random.uniform(-1, 1, (size, dim))
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        rows *= np.random.uniform(0, 0.999, (size, 1))
+        rows = rows.astype(np.float32)
+        start = time.perf_counter()
+        tree = VPTree(rows)
+        build_time = time.perf_counter() - start
+        kernel = distance.PoincareDistance(rows)
+        us = rows[:queries]
+
+        def brute():
+            for u in us:
+                next(distance.ranked(kernel.one_to_many(u), k))
+
+        def knn(eps):
+            return lambda: [tree.knn(u, k, eps=eps) for u in us]
+
+        results = [(name, _best_time(run) / queries) for name, run
+                   in [('brute', brute), ('exact', knn(0.0)),
+                       ('approx', knn(0.5))]]
+        brute_time = results[0][1]
+        print('  {:,} terms, built in {:.2f}s'.format(size, build_time))
+        for name, one_time in results:
+            print('    {:6} {:8.3f}ms ({:4.1f}x)'.format(
+                name, one_time * 1000, brute_time / one_time))
+
+
+BENCHMARKS = {
+    'distance': bench_distance,
+    'grid_codec': bench_grid_codec,
+    'grid_save': bench_grid_save,
+    'kvs': bench_kvs,
+    'vptree': bench_vptree,
+}
+
+
+if __name__ == '__main__':
+    log.setLevel('WARNING')
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,118 @@
+"""Compact binary encoding for GridModel rows in storage.
+
+A grid row is a header and a payload. The header is the magic b'WRG', a
+version byte and a flags byte. The payload is zlib compressed if the
+FLAG_ZLIB flag is set, and is (all little-endian):
+
+    uint32 string count, uint32 string table size in bytes
+    string table: the strings, utf-8, each followed by a NUL
+    int32 x_offset, int32 y_offset
+    main cursor: uint32 key, int32 x, int32 y
+    secondary cursor: uint32 key, int32 x, int32 y
+    uint32 clipboard datum key
+
+Every key is written once in the string table and referred to by its
+index, NO_STRING stands for None.
+
+The grid's Clips, relationships and active datums are rows in their own
+tables, see model.WrenData, so they are not in it.
+
+Rows that do not start with the magic are the older json format, which
+GridModel still reads and, with GridModel.serialize_format, writes.
+
+"""
+import struct
+import zlib
+
+MAGIC = b'WRG'
+VERSION = 1
+FLAG_ZLIB = 1
+# Payloads bigger than this are compressed when compress is not given.
+COMPRESS_THRESHOLD = 4096
+NO_STRING = 0xffffffff
+
+_HEADER = struct.Struct('<3sBB')
+_COUNTS = struct.Struct('<II')
+_VIEW = struct.Struct('<iiIiiIiiI')  # offsets, cursors and clipboard
+
+
+def is_encoded_grid(value):
+    """True if value was made by encode_grid"""
+    return isinstance(value, bytes) and value[:len(MAGIC)] == MAGIC
+
+
+def encode_grid(x_offset, y_offset, main_cursor, secondary_cursor,
+                clipboard_datum_key, compress=None):
+    """Encode a grid's fields to bytes.
+
+    Cursors are (key, x, y) tuples. If compress is None the payload is
+    compressed when it is bigger than COMPRESS_THRESHOLD.
+
+    """
+    main_key, main_x, main_y = main_cursor
+    secondary_key, secondary_x, secondary_y = secondary_cursor
+
+    # Every string once, in the order they are first seen.
+    strings = list(dict.fromkeys(
+        key for key in (main_key, secondary_key, clipboard_datum_key)
+        if key is not None))
+    index = dict(zip(strings, range(len(strings))))
+    index[None] = NO_STRING
+    ref = index.__getitem__
+    body = _VIEW.pack(x_offset, y_offset,
+                      ref(main_key), main_x, main_y,
+                      ref(secondary_key), secondary_x, secondary_y,
+                      ref(clipboard_datum_key))
+
+    if strings:
+        text = '\0'.join(strings) + '\0'
+        if text.count('\0') != len(strings):
+            raise ValueError('Grid strings may not contain NUL')
+        table = text.encode('utf-8')
+    else:
+        table = b''
+    payload = b''.join([_COUNTS.pack(len(strings), len(table)), table, body])
+
+    if compress is None:
+        compress = len(payload) > COMPRESS_THRESHOLD
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= FLAG_ZLIB
+    return _HEADER.pack(MAGIC, VERSION, flags) + payload
+
+
+def decode_grid(value):
+    """Decode bytes made by encode_grid to a dict of the grid's fields."""
+    magic, version, flags = _HEADER.unpack_from(value)
+    if magic != MAGIC:
+        raise ValueError('Not an encoded grid')
+    if version != VERSION:
+        raise ValueError('Unknown grid encoding version {}'.format(version))
+    payload = value[_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    count, table_size = _COUNTS.unpack_from(payload)
+    offset = _COUNTS.size
+    strings = payload[offset:offset + table_size].decode('utf-8')\
+        .split('\0')[:count]
+    offset += table_size
+
+    x_offset, y_offset, main_ref, main_x, main_y, secondary_ref,\
+        secondary_x, secondary_y, clipboard_ref = _VIEW.unpack_from(
+            payload, offset)
+
+    def lookup_key(ref):
+        if ref == NO_STRING:
+            return None
+        return strings[ref]
+
+    return {
+        'x_offset': x_offset,
+        'y_offset': y_offset,
+        'main_cursor': (lookup_key(main_ref), main_x, main_y),
+        'secondary_cursor': (lookup_key(secondary_ref), secondary_x,
+                             secondary_y),
+        'clipboard_datum_key': lookup_key(clipboard_ref),
+    }
@@ -1,34 +1,22 @@
 
+from collections import OrderedDict
 from datetime import datetime
 from inspect import isclass
+from itertools import chain, compress
 import math
+from weakref import WeakSet
+
+import numpy as np
 import pytz
 
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
 from PyQt5.QtWidgets import QApplication
 
+from distance import ranked
+from embedding import get_embedding
 import model
 from wren import IDMap, log, spiral_coords
 
-import torch as th
-from torch.autograd import Variable
-
-# --- Start embedding load kludge ---
-# This loads the serialization used to sort mammals clips, it could be moved,
-# having it here is a bit of a kludge.
-_serialization = th.load('mammals.pth')
-_size = len(_serialization['objects'])
-_dim = 5 # from opts, not sure how to read it out of serialization
-from poincare.model import SNEmbedding
-_m = SNEmbedding(_size, _dim)
-_m.load_state_dict(_serialization['model'])
-_lt = th.from_numpy(_m.embedding())
-_embedding = Variable(_lt, volatile=True)
-_term_to_index = {}
-for i, obj in enumerate(_serialization['objects']):
-    _term_to_index[obj] = i
-# --- End embedding load kludge ---
-
 
 _CONTROLLER_ID_MAP = None
 def get_controller_id_map():
@@ -53,6 +41,23 @@ def get(key, **kwargs):
         controller.setup(**kwargs)
     return controller
 
+def get_many(keys, **kwargs):
+    """Get the Controllers for many keys, loading their Models in bulk.
+
+    The Models each Controller will 'get' in its setup (see setup_keys) are
+    loaded in bulk too.
+
+    """
+    id_map = get_controller_id_map()
+    missing = [key for key in keys
+               if key is not None and id_map.get(key) is None]
+    setup_keys = []
+    for got_model in model.get_models(missing):
+        controller_class = MODEL_TO_CONTROLLER[type(got_model).__name__]
+        setup_keys += controller_class.setup_keys(got_model)
+    model.get_models(setup_keys)
+    return [get(key, **kwargs) for key in keys]
+
 
 class WrenController(QObject):
     model_class = model.WrenModel
@@ -68,6 +73,11 @@ class WrenController(QObject):
     def setup(self):
         pass
 
+    @staticmethod
+    def setup_keys(instance_model):
+        """Keys setup will 'get', so get_many can load their Models first."""
+        return []
+
     @classmethod
     def create(cls, *args, **kwargs):
         # This is a convenience. Don't override b/c want preserve
@@ -96,6 +106,7 @@ class Datum(WrenController):
         self.model.data = text
         self.model.last_changed = datetime.now(tz=pytz.utc)
         self.model.save()
+        TermIds.forget_everywhere(self.model.key)
 
     def set_name(self, name):
         self.model.name = name
@@ -103,6 +114,228 @@ class Datum(WrenController):
         self.model.save()
 
 
+class ClipMap:
+    """Map of a Grid's absolute (x, y) to Clip, made as they are looked up.
+
+    A Clip is read from storage the first time its coordinates are looked
+    up, and empty coordinates are remembered as empty. Only the `size` most
+    recently used coordinates are kept, so memory goes with what is on
+    screen and not the grid size. Older Clips are only let go of here, the
+    id-maps hold them weakly, so one still in use elsewhere (ex. by the
+    Inspector) is the one found when it is looked up again.
+
+    Setting and deleting only change what is remembered, saving is still up
+    to the ClipModel. The *_row and column methods change storage too, and
+    the ClipModels they move or delete, wherever those are held.
+
+    """
+    def __init__(self, grid_key, size):
+        self.grid_key = grid_key
+        self.size = size
+        self._clips = OrderedDict()  # (x, y) to Clip, or None if empty.
+
+    def get(self, coords, default=None):
+        try:
+            clip = self._clips[coords]
+        except KeyError:
+            row = model.get_storage().get_clip_at(self.grid_key, *coords)
+            clip = None
+            if row is not None:
+                # Held until its Clip is made, so it is not let go first.
+                clip_model = model.ClipModel.from_row(self.grid_key, row)
+                clip = get(clip_model.key)
+            self._remember(coords, clip)
+        else:
+            self._clips.move_to_end(coords)
+        if clip is None:
+            return default
+        return clip
+
+    def __getitem__(self, coords):
+        clip = self.get(coords)
+        if clip is None:
+            raise KeyError(coords)
+        return clip
+
+    def __contains__(self, coords):
+        return self.get(coords) is not None
+
+    def __setitem__(self, coords, clip):
+        self._remember(coords, clip)
+
+    def __delitem__(self, coords):
+        self._remember(coords, None)
+
+    def load(self, min_x, max_x, min_y, max_y):
+        """Look up a rectangle, ex. the screen, with one query."""
+        area = [(x, y) for x in range(min_x, max_x + 1)
+                for y in range(min_y, max_y + 1)]
+        if all(coords in self._clips for coords in area):
+            return
+        rows = model.get_storage().get_clips_in(self.grid_key, min_x, max_x,
+                                                min_y, max_y)
+        # Held until their Clips are made, past the id-map's recent tier.
+        clip_models = [model.ClipModel.from_row(self.grid_key, row)
+                       for row in rows]
+        clips = get_many([clip_model.key for clip_model in clip_models])
+        found = {(row[2], row[3]): clip for row, clip in zip(rows, clips)}
+        for coords in area:
+            self._remember(coords, found.get(coords))
+
+    def delete_row(self, row):
+        """Delete the Clip of a row from the clips table."""
+        clip_key, datum_key, x, y, edit_cursor_position = row
+        clip_model = model.get_model_id_map().get(clip_key)
+        if clip_model is not None:
+            clip_model.deleted = True
+        model.get_storage().delete_clip(self.grid_key, clip_key)
+        self._remember((x, y), None)
+
+    def move_row(self, row, new_x, new_y):
+        """Move the Clip of a row from the clips table."""
+        clip_key, datum_key, x, y, edit_cursor_position = row
+        clip_model = model.get_model_id_map().get(clip_key)
+        if clip_model is not None:
+            clip_model.x = new_x
+            clip_model.y = new_y
+        model.get_storage().write_clip(self.grid_key, clip_key, datum_key,
+                                       new_x, new_y, edit_cursor_position)
+        clip = self._clips.get((x, y))
+        self._remember((x, y), None)
+        if clip is None:
+            # Not looked up yet, it is read the next time it is.
+            self._clips.pop((new_x, new_y), None)
+        else:
+            self._remember((new_x, new_y), clip)
+
+    def delete_column(self, x):
+        """Delete the Clips of column x from the clips table."""
+        model.get_storage().delete_column(self.grid_key, x)
+        # Every loaded ClipModel in it, see shift().
+        for clip_model in model.get_model_id_map().values():
+            if isinstance(clip_model, model.ClipModel) and \
+                    clip_model.grid_key == self.grid_key and \
+                    clip_model.x == x:
+                clip_model.deleted = True
+        for coords in list(self._clips):
+            if coords[0] == x:
+                self._clips[coords] = None
+
+    def shift(self, delta_x, min_x, max_x):
+        """Move the Clips in columns min_x to max_x over by delta_x."""
+        model.get_storage().shift_clips(self.grid_key, delta_x, min_x, max_x)
+        # Every loaded ClipModel, not just those remembered here, so one
+        # still in use elsewhere does not save itself back.
+        for clip_model in model.get_model_id_map().values():
+            if isinstance(clip_model, model.ClipModel) and \
+                    clip_model.grid_key == self.grid_key and \
+                    min_x <= clip_model.x <= max_x:
+                clip_model.x += delta_x
+        clips = OrderedDict()
+        for (x, y), clip in self._clips.items():
+            if clip is None:
+                # Empties may not be empty any more.
+                continue
+            if min_x <= x <= max_x:
+                x += delta_x
+            clips[x, y] = clip
+        self._clips = clips
+
+    def _remember(self, coords, clip):
+        self._clips[coords] = clip
+        self._clips.move_to_end(coords)
+        while len(self._clips) > self.size:
+            self._clips.popitem(last=False)
+
+
+class TermIds:
+    """Map of a Grid's active datum_keys to their rows in the embedding.
+
+    The keys are in a list and their term_ids in a numpy array alongside,
+    so a ranking gets them all at once with items() and not a Datum lookup
+    each. A term_id is worked out from the Datum's data the first time it
+    is wanted, and again after Datum.set_data changes the data. NO_TERM is
+    the term_id of data that is not a term.
+
+    """
+    NO_TERM = -1
+    UNKNOWN = -2
+    _all = WeakSet()  # Every TermIds, for forget_everywhere.
+
+    def __init__(self, datum_keys):
+        self.keys = list(datum_keys)
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._ids = np.full(max(len(self.keys), 16), self.UNKNOWN,
+                            dtype=np.int64)
+        TermIds._all.add(self)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, datum_key):
+        return datum_key in self._positions
+
+    def add(self, datum_key):
+        if datum_key in self._positions:
+            return
+        if len(self.keys) == len(self._ids):
+            self._ids = np.concatenate([
+                self._ids, np.full(len(self._ids), self.UNKNOWN,
+                                   dtype=np.int64)])
+        self._positions[datum_key] = len(self.keys)
+        self._ids[len(self.keys)] = self.UNKNOWN
+        self.keys.append(datum_key)
+
+    def remove(self, datum_key):
+        # The last key takes its place.
+        i = self._positions.pop(datum_key)
+        last = self.keys.pop()
+        if last != datum_key:
+            self.keys[i] = last
+            self._ids[i] = self._ids[len(self.keys)]
+            self._positions[last] = i
+
+    def forget(self, datum_key):
+        """Work out datum_key's term_id again the next time it is wanted"""
+        i = self._positions.get(datum_key)
+        if i is not None:
+            self._ids[i] = self.UNKNOWN
+
+    @classmethod
+    def forget_everywhere(cls, datum_key):
+        for term_ids in list(cls._all):
+            term_ids.forget(datum_key)
+
+    def _resolve(self):
+        ids = self._ids[:len(self.keys)]
+        unknown = np.flatnonzero(ids == self.UNKNOWN)
+        if len(unknown):
+            datum_models = model.get_models(
+                [self.keys[i] for i in unknown.tolist()])
+            ids[unknown] = get_embedding().term_indexes(
+                [datum_model.data for datum_model in datum_models])
+        return ids
+
+    def items(self):
+        """Get (keys, term_ids) of all the datums, a list and an array"""
+        return list(self.keys), self._resolve().copy()
+
+    def get(self, datum_key):
+        """Get the term_id of a Datum, None if its data is not a term"""
+        i = self._positions.get(datum_key)
+        if i is None:
+            # Not active, so not kept.
+            term_id = int(get_embedding().term_indexes(
+                [get(datum_key).model.data])[0])
+        else:
+            term_id = int(self._ids[i])
+            if term_id == self.UNKNOWN:
+                term_id = int(self._resolve()[i])
+        if term_id == self.NO_TERM:
+            return None
+        return term_id
+
+
 class Grid(WrenController):
     """Controller for a Grid of Clips"""
     model_class = model.GridModel
@@ -122,37 +355,61 @@ class Grid(WrenController):
         self.main_cursor = get(self.model.main_cursor_model.key)
         self.secondary_cursor = get(self.model.secondary_cursor_model.key)
 
-        # Clips
-        self.coordinates_to_clip = {}  # Un-offset Clip Grid
-        self.min_x = float('inf')
-        self.max_x = -float('inf')
-        self.y_upper_bounds = {}  # x-> y upper bound lowest valued y (most up)
-        self.y_lower_bounds = {}  # x-> y lower bound highest valued y(mst dwn)
-        for clip_model in self.model.clip_models:
-            clip = get(clip_model.key)
-            x = clip_model.x
-            y = clip_model.y
-            self.max_x = max(self.max_x, x)
-            self.min_x = min(self.min_x, x)
-            self.y_upper_bounds[x] = min(self.y_upper_bounds.get(x, 0), y)
-            self.y_lower_bounds[x] = max(self.y_lower_bounds.get(x, 0), y)
-            self.coordinates_to_clip[(x, y)] = clip
-
-        if self.min_x == float('inf'):
-            self.min_x = None
-        if self.max_x == -float('inf'):
-            self.max_x = None
+        # Clips, made as they are looked up, see ClipMap.
+        if width and height:
+            cache_size = 8 * width * height  # A few screens worth.
+        else:
+            cache_size = 1000
+        self.coordinates_to_clip = ClipMap(self.model.key, cache_size)
+        self._load_bounds()
 
         # Datums
         self.active_datums = set(self.model.active_datums)
+        self.term_ids = TermIds(self.model.active_datums)
 
         # ctl-l state-machine, center, bottom, top
         self.last_ctrl_l = 'center'  # see: self.do_ctrl_l()
 
         # Widget
         from views import GridView
+        self.load_viewport()
         self.view = GridView(self, width, height)
 
+    def _load_bounds(self):
+        """Read the y bounds of the columns from the clips table."""
+        self.y_upper_bounds = {}  # x-> y upper bound lowest valued y (most up)
+        self.y_lower_bounds = {}  # x-> y lower bound highest valued y(mst dwn)
+        for x, (min_y, max_y) in model.get_storage().get_column_bounds(
+                self.model.key).items():
+            self.y_upper_bounds[x] = min(0, min_y)
+            self.y_lower_bounds[x] = max(0, max_y)
+        self._update_min_max_x()
+
+    def reload(self):
+        """Read the Clips and active datums from storage again, ex. after a
+        batch was rolled back."""
+        self.coordinates_to_clip = ClipMap(self.model.key,
+                                           self.coordinates_to_clip.size)
+        self._load_bounds()
+        self.active_datums = set(self.model.active_datums)
+        self.term_ids = TermIds(self.model.active_datums)
+
+    def _update_min_max_x(self):
+        """Set min_x and max_x from the columns with Clips."""
+        self.min_x = min(self.y_upper_bounds, default=None)
+        self.max_x = max(self.y_upper_bounds, default=None)
+
+    def load_viewport(self):
+        """Look up the Clips on screen, and the home row, in bulk."""
+        if not (self.grid_width and self.grid_height):
+            return
+        min_x = self.model.x_offset
+        max_x = min_x + self.grid_width - 1
+        min_y = self.model.y_offset
+        self.coordinates_to_clip.load(min_x, max_x, min_y,
+                                      min_y + self.grid_height - 1)
+        self.coordinates_to_clip.load(min_x, max_x, 0, 0)
+
     def get_clip_at(self, screen_x, screen_y):
         """Get the Clip at the given SCREEN coordinates."""
         x = screen_x + self.model.x_offset
@@ -189,17 +446,17 @@ class Grid(WrenController):
         inspector.view.refresh()
 
     def get_clips(self):
-        return self.coordinates_to_clip.values()
+        """Get every Clip in the Grid, this makes them all."""
+        rows = list(model.get_storage().get_clips(self.model.key))
+        return [self.coordinates_to_clip[row[2], row[3]] for row in rows]
 
     def _get_next_coords(self):
         """Return tuple of x, y for next available grid placement."""
-        # Make a set to keep track of coordinates already in use.
-        used_coords = self.coordinates_to_clip.keys()
         # We'll start from the cursor.
         next_x = self.main_cursor.model.x
         next_y = self.main_cursor.model.y
         for x, y in spiral_coords(next_x, next_y):
-            if (x, y) not in used_coords:
+            if (x, y) not in self.coordinates_to_clip:
                 next_x = x
                 next_y = y
                 break
@@ -209,8 +466,8 @@ class Grid(WrenController):
                            edit_cursor_position, emit=True):
         datum = Datum.create(text)
         self.active_datums.add(datum.model.key)
-        self.model.active_datums.append(datum.model.key)
-        self.model.save()
+        self.term_ids.add(datum.model.key)
+        self.model.add_active_datum(datum.model.key)
         return self.new_clip(screen_x, screen_y, datum, edit_cursor_position,
                              emit=emit)
 
@@ -274,41 +531,17 @@ class Grid(WrenController):
         self.model.delete_clip(clip.model)
 
         # Is it the highest, lowest, last-leftest or last-rightest?
-        if absolute_y == self.y_upper_bounds[absolute_x]:
-            new_upper_y = None
-            for (x, y), clip in self.coordinates_to_clip.items():
-                if x == absolute_x:
-                    if new_upper_y is None or y < new_upper_y:
-                        new_upper_y = y
-            if new_upper_y is None:
-                del self.y_upper_bounds[absolute_x]
-            else:
-                self.y_upper_bounds[absolute_x] = new_upper_y
-
-        if absolute_y == self.y_lower_bounds[absolute_x]:
-            new_lower_y = None
-            for (x, y), clip in self.coordinates_to_clip.items():
-                if x == absolute_x:
-                    if new_lower_y is None or y > new_lower_y:
-                        new_lower_y = y
-            if new_lower_y is None:
-                del self.y_lower_bounds[absolute_x]
-            else:
-                self.y_lower_bounds[absolute_x] = new_lower_y
-
-        if absolute_x == self.min_x:
-            if absolute_x not in self.y_upper_bounds:
-                self.min_x = None
-                for (x, y), clip in self.coordinates_to_clip.items():
-                    if self.min_x is None or x < self.min_x:
-                        self.min_x = x
-
-        if absolute_x == self.max_x:
-            if absolute_x not in self.y_upper_bounds:
-                self.max_x = None
-                for (x, y), clip in self.coordinates_to_clip.items():
-                    if self.max_x is None or x > self.max_x:
-                        self.max_x = x
+        bounds = model.get_storage().get_column_bounds(
+            self.model.key, absolute_x).get(absolute_x)
+        if bounds is None:
+            del self.y_upper_bounds[absolute_x]
+            del self.y_lower_bounds[absolute_x]
+            self._update_min_max_x()
+        else:
+            if absolute_y == self.y_upper_bounds[absolute_x]:
+                self.y_upper_bounds[absolute_x] = bounds[0]
+            if absolute_y == self.y_lower_bounds[absolute_x]:
+                self.y_lower_bounds[absolute_x] = bounds[1]
 
         self.view.clip_changed.emit()
 
@@ -351,45 +584,30 @@ class Grid(WrenController):
     def delete_column(self, screen_x):
         absolute_x = screen_x + self.model.x_offset
         self.status_bar.showMessage('Delete Column {}'.format(absolute_x))
-        delete_clips = []
-        shift_clips = []
-        y_bounds_to_change = set()
-        for (x, y), clip in self.coordinates_to_clip.items():
-            if x == absolute_x:
-                delete_clips.append(((x, y), clip))
-            elif x < absolute_x:
-                y_bounds_to_change.add(x)
-                shift_clips.append(((x, y), clip))
-
-        if not delete_clips and not shift_clips:
+        delete_column = absolute_x in self.y_upper_bounds
+        shift_columns = sorted((x for x in self.y_upper_bounds
+                                if x < absolute_x), reverse=True)
+
+        if not delete_column and not shift_columns:
             return
 
-        if delete_clips:
+        if delete_column:
             del self.y_upper_bounds[absolute_x]
             del self.y_lower_bounds[absolute_x]
-        y_bounds_to_change = sorted(y_bounds_to_change, reverse=True)
-        for x in y_bounds_to_change:
+        for x in shift_columns:
             self.y_upper_bounds[x+1] = self.y_upper_bounds[x]
             del self.y_upper_bounds[x]
             self.y_lower_bounds[x+1] = self.y_lower_bounds[x]
             del self.y_lower_bounds[x]
-        if y_bounds_to_change:
-            self.min_x += 1
-
-        removes = set()
-        for (x, y), clip in delete_clips:
-            del self.coordinates_to_clip[x, y]
-            removes.add(clip.model)
-
-        models = [c for c in self.model.clip_models if c not in removes]
-        self.model.clip_models = models
-
-        for (x, y), clip in shift_clips:
-            del self.coordinates_to_clip[x, y]
-        for (x, y), clip in shift_clips:
-            clip.model.x = x + 1
-            self.coordinates_to_clip[x + 1, y] = clip
-        self.model.save()
+        self._update_min_max_x()
+
+        with model.get_storage().batch():
+            if delete_column:
+                self.coordinates_to_clip.delete_column(absolute_x)
+            if shift_columns:
+                # Moved in storage, the Clips are not made to move them.
+                self.coordinates_to_clip.shift(1, shift_columns[-1],
+                                               absolute_x - 1)
         self.view.refresh()
 
     def archive_datum(self):
@@ -398,7 +616,13 @@ class Grid(WrenController):
             self.status_bar.showMessage(
 "archive fail - selection is empty, select a Clip to archive its Datum")
             return
-        key = clip.model.datum_key
+        with model.get_storage().batch():
+            self._archive_datum_key(clip.model.datum_key)
+        self.view.clip_changed.emit()
+        self.view.refresh()
+
+    def _archive_datum_key(self, key):
+        """Delete the Datum's Clips, collapse the gaps and deactivate it."""
         x_diff = 0  # Number of accumulated column-to-left shifts,
         # this is how leftward you shift every clip you touch based on previous
         # deleted columns.
@@ -407,21 +631,24 @@ class Grid(WrenController):
         # previous deleted clips. It resets every top-home and home-to-bottom
         # process.
         #
+        # Clips are read as rows and changed in storage, without making a
+        # Clip for each.
+        storage = model.get_storage()
+        clips = self.coordinates_to_clip
         for x in range(self.min_x, self.max_x+1):
             if x not in self.y_upper_bounds:
                 continue  # Blank column
             y_diff = 0
             # We get the un-offset x when we get, we write to x-x_diff.
-            home_clip = self.coordinates_to_clip.get((x, 0))
             min_y = self.y_upper_bounds[x]
             max_y = self.y_lower_bounds[x]
-            if home_clip and home_clip.model.datum_key == key:
+            column = {row[3]: row for row in storage.get_clips_in(
+                self.model.key, x, x, min_y, max_y)}
+            home_row = column.get(0)
+            if home_row and home_row[1] == key:
                 # Clear all clips from the column
-                for y in range(min_y, max_y+1):
-                    c = self.coordinates_to_clip.get((x, y))
-                    if c:
-                        del self.coordinates_to_clip[(x, y)]
-                        self.model.delete_clip(c.model)
+                for row in column.values():
+                    clips.delete_row(row)
 
                 # Clear old bounds-tracking invariants.
                 del self.y_upper_bounds[x]
@@ -433,51 +660,42 @@ class Grid(WrenController):
                 if min_y < 0:
                     for y in range(1, abs(min_y-1)):
                         y = -y
-                        c = self.coordinates_to_clip.get((x, y))
-                        if c:
-                            if c.model.datum_key == key:
+                        row = column.get(y)
+                        if row:
+                            if row[1] == key:
                                 y_diff += 1
-                                del self.coordinates_to_clip[(x, y)]
-                                self.model.delete_clip(c.model)
+                                clips.delete_row(row)
                             else:
                                 # Move the clip.
                                 new_x = x-x_diff
                                 new_y = y+y_diff  # We're above homerow.
-                                if new_x != c.model.x or new_y != c.model.y:
-                                    del self.coordinates_to_clip[(x, y)]
-                                    c.model.x = new_x
-                                    c.model.y = new_y
-                                    c.model.save()
-                                    new_coords = (new_x, new_y)
-                                    self.coordinates_to_clip[new_coords] = c
+                                if new_x != x or new_y != y:
+                                    clips.move_row(row, new_x, new_y)
+                if x_diff:
+                    del self.y_upper_bounds[x]
                 self.y_upper_bounds[x-x_diff] = min_y + y_diff
-                if max_y > 0:
-                    for y in range(0, max_y+1):
-                        c = self.coordinates_to_clip.get((x, y))
-                        if c:
-                            if c.model.datum_key == key:
-                                y_diff += 1
-                                del self.coordinates_to_clip[(x, y)]
-                                self.model.delete_clip(c.model)
-                            else:
-                                # Move the clip.
-                                new_x = x-x_diff
-                                new_y = y-y_diff
-                                if new_x != c.model.x or new_y != c.model.y:
-                                    del self.coordinates_to_clip[(x, y)]
-                                    c.model.x = new_x
-                                    c.model.y = new_y
-                                    c.model.save()
-                                    new_coords = (new_x, new_y)
-                                    self.coordinates_to_clip[new_coords] = c
+                # Below home is collapsed on its own.
+                y_diff = 0
+                for y in range(0, max_y+1):
+                    row = column.get(y)
+                    if row:
+                        if row[1] == key:
+                            y_diff += 1
+                            clips.delete_row(row)
+                        else:
+                            # Move the clip.
+                            new_x = x-x_diff
+                            new_y = y-y_diff
+                            if new_x != x or new_y != y:
+                                clips.move_row(row, new_x, new_y)
+                if x_diff:
+                    del self.y_lower_bounds[x]
                 self.y_lower_bounds[x-x_diff] = max_y - y_diff
 
-        self.max_x -= x_diff
+        self._update_min_max_x()
         self.active_datums.remove(key)
-        self.model.active_datums.remove(key)
-        self.model.save()
-        self.view.clip_changed.emit()
-        self.view.refresh()
+        self.term_ids.remove(key)
+        self.model.remove_active_datum(key)
 
     def set_clip_focus(self, screen_x, screen_y):
         """Called when initiating editing of a Clip"""
@@ -496,38 +714,23 @@ class Grid(WrenController):
 
     def insert_column(self, screen_x):
         """Take every Clip at <= screen_x, decrement its x by 1"""
-        start_size = len(self.coordinates_to_clip)
         absolute_x = screen_x + self.model.x_offset
 
-        to_change = []
-        y_bounds_to_change = set()
-        for (x, y), clip in self.coordinates_to_clip.items():
-            if x <= absolute_x:
-                to_change.append(((x, y), clip))
-                y_bounds_to_change.add(x)
-
-        y_bounds_to_change = sorted(y_bounds_to_change)
+        y_bounds_to_change = sorted(x for x in self.y_upper_bounds
+                                    if x <= absolute_x)
         for x in y_bounds_to_change:
             self.y_upper_bounds[x-1] = self.y_upper_bounds[x]
             del self.y_upper_bounds[x]
             self.y_lower_bounds[x-1] = self.y_lower_bounds[x]
             del self.y_lower_bounds[x]
 
-        to_change = sorted(to_change, key=lambda x:x[0][0])
-        for (x, y), clip in to_change:
-            del self.coordinates_to_clip[x, y]
-            self.coordinates_to_clip[x-1, y] = clip
-            clip.model.x = clip.model.x - 1
-            # Clip automatically saves when Grid saves, and Clip save re-saves
-            # whole Grid, so we just save the Grid at the end, which serializes
-            # all the ClipModels.
-        if to_change:
-            self.min_x -= 1
-            self.model.save()
+        if y_bounds_to_change:
+            # Moved in storage, the Clips are not made to move them.
+            self.coordinates_to_clip.shift(-1, y_bounds_to_change[0],
+                                           absolute_x)
+            self._update_min_max_x()
             self.view.refresh()
 
-        assert len(self.coordinates_to_clip) == start_size
-
     def refresh_selected_column(self):
         self.refresh_column(self.main_cursor.model.x)
 
@@ -548,6 +751,13 @@ class Grid(WrenController):
 
     def make_ranked_clips(self, main_cursor=True, secondary_cursor=False,
                           lexical=False, in_place=False, force_homerow=False):
+        # Every Clip this makes, moves or deletes is written in one batch.
+        with model.get_storage().batch():
+            self._make_ranked_clips(main_cursor, secondary_cursor, lexical,
+                                    in_place, force_homerow)
+
+    def _make_ranked_clips(self, main_cursor, secondary_cursor, lexical,
+                           in_place, force_homerow):
         # If in-place is true it re-sorts / re-creates the current column.
         # Note: This function is old and crusty and poorly documented. At the
         # moment it is the "sort" used when you give the ctrl-enter command,
@@ -579,33 +789,27 @@ class Grid(WrenController):
             # If we are on the home-row then this gives a 'null-search'
             if self.main_cursor.model.y == homerow_screen_y:
                 self.status_bar.showMessage('Make Ranked Clips - null search')
-                positives = []  # list of (score, key) tuples
+                # Active datums scored given themselves, highest first.
+                positives = [datum_key for datum_key, score
+                             in self.model.active_self_scores()]
                 negatives = []  # Should be empty, nothing is its own parent.
-                unscoreds = []
-                for datum_key in self.active_datums:
-                    try:
-                        score = self.model.relationships[datum_key][datum_key]
-                        score = float(score)
-                    except (KeyError, ValueError):
-                        score = None
-                    if score is not None:
-                        positives.append((score, datum_key))
-                    else:
-                        unscoreds.append(datum_key)
-                # Sort  by score descending
-                positives = [x[1] for x in sorted(positives, reverse=True)]
-                negatives = [x[1] for x in sorted(negatives)]
-                unscoreds = sorted(unscoreds,
-                                   key=lambda x: get(x).model.last_changed)
+                scored = set(positives)
+                # Least recently changed first.
+                unscoreds = [datum_key for datum_key
+                             in self.model.active_datums_by_last_changed()
+                             if datum_key not in scored]
                 self.insert_column(screen_x)
                 for i, datum_key in enumerate(positives+[None]+unscoreds):
                     if datum_key is None:
                         continue
                     datum = get(datum_key)
-                    self.new_clip(screen_x, homerow_screen_y + i + 1, datum, 0)
+                    self.new_clip(screen_x, homerow_screen_y + i + 1, datum, 0,
+                                  emit=False)
                 for i, datum_key in enumerate(negatives):
                     datum = get(datum_key)
-                    self.new_clip(screen_x, homerow_screen_y - i - 1, datum, 0)
+                    self.new_clip(screen_x, homerow_screen_y - i - 1, datum, 0,
+                                  emit=False)
+                self.view.clip_changed.emit()
                 self.main_cursor.model.y = homerow_screen_y
                 self.main_cursor.model.x = screen_x
                 self.main_cursor.model.save()
@@ -630,14 +834,7 @@ class Grid(WrenController):
             # Remove the current column.
             absolute_x = screen_x + self.model.x_offset
             if absolute_x in self.y_upper_bounds:
-                for absolute_y in range(self.y_upper_bounds[absolute_x],
-                                        self.y_lower_bounds[absolute_x]+1):
-                    coords = (absolute_x, absolute_y)
-                    if coords not in self.coordinates_to_clip:
-                        continue
-                    c = self.coordinates_to_clip[coords]
-                    del self.coordinates_to_clip[coords]
-                    self.model.delete_clip(c.model)
+                self.coordinates_to_clip.delete_column(absolute_x)
                 del self.y_upper_bounds[absolute_x]
                 del self.y_lower_bounds[absolute_x]
         else:
@@ -668,9 +865,6 @@ class Grid(WrenController):
         # - - - end old notes - - -
 
         clip_datum_key = clip.model.datum_key
-        # Map of ITEM datum_key with float-value of P(I|Homerow)
-        positives = []
-        unscoreds = []
 
         # find all 'parents' of clip datum key
         # This is now to - do, because mammals is different than parents, it
@@ -697,10 +891,8 @@ class Grid(WrenController):
         # be 0.0.)
         # Note: Could cache the dist-calculations
         clip_datum_text = get(clip_datum_key).model.data
-        clip_term_id = _term_to_index[clip_datum_text]
-        s_e = Variable(_lt[clip_term_id].expand_as(_embedding),
-                       volatile=True)
-        _dists = _m.dist()(s_e, _embedding).data.cpu().numpy().flatten()
+        embedding = get_embedding()
+        clip_term_id = embedding.term_index(clip_datum_text)
 
         from app import get_application
         progress = get_application().main_window.progress
@@ -708,50 +900,47 @@ class Grid(WrenController):
         progress.setMinimumDuration(
             max(0, old_min_time - (datetime.now()-start_time).seconds*1000))
         num = len(self.active_datums)
-        progress.setRange(0, num)
+        progress.setRange(0, 1)
         progress.reset()
         progress.setLabelText('Getting scores for {} datums'.format(num))
 
-        for i, datum_key in enumerate(self.active_datums):
-            progress.setValue(i)
-            if datum_key == clip_datum_key: # or datum_key in parent_keys_set:
-                continue
-            try:
-                datum_text = get(datum_key).model.data
-                datum_term_id = _term_to_index[datum_text]
-                score = _dists[datum_term_id]
-                score = float(score)
-            except (KeyError, ValueError):
-                score = None
-            if score is not None:
-                positives.append((score, datum_key))
-            else:
-                unscoreds.append(datum_key)
-
-        progress.setRange(0, 2)
-        progress.setMinimumDuration(
-            max(0, old_min_time - (datetime.now()-start_time).seconds*1000))
-        progress.reset()
-        progress.setLabelText('Sorting scores')
-
-        # Sort by score ascending (smaller distance, closer match)
-        positives = [x[1] for x in sorted(positives)]
+        # The term_ids of all the active datums at once, see TermIds.
+        keys, term_ids = self.term_ids.items()
+        is_other = np.ones(len(keys), dtype=bool)
+        if clip_datum_key in self.term_ids:
+            is_other[keys.index(clip_datum_key)] = False
+        is_scored = term_ids != TermIds.NO_TERM
+        positives = list(compress(keys, is_scored & is_other))
+        positive_term_ids = term_ids[is_scored & is_other]
+        unscoreds = list(compress(keys, ~is_scored & is_other))
         progress.setValue(1)
+
         #negatives = parent_keys #[x[1] for x in sorted(negatives)]
-        unscoreds = sorted(unscoreds,
-                           key=lambda x: get(x).model.last_changed)
-        progress.setValue(2)
+        # Least recently changed first, from the datums index.
+        unscored = set(unscoreds)
+        unscoreds = [datum_key for datum_key
+                     in self.model.active_datums_by_last_changed()
+                     if datum_key in unscored]
         #self.insert_column(screen_x)  # already done it above if needed
 
-        datums = positives+[None]+unscoreds
-        progress.setRange(0, len(datums)-1)
+        # Ranked by score ascending (smaller distance, closer match), a
+        # screenful first and the rest a chunk at a time as it is placed,
+        # not all sorted up front.
+        # Only the active datums' distances, not every term's.
+        scores = embedding.distances_to(clip_term_id, positive_term_ids)
+        ranked_positives = (positives[i] for chunk
+                            in ranked(scores, self.grid_height)
+                            for i in chunk)
+        num = len(positives) + 1 + len(unscoreds)
+        progress.setRange(0, num-1)
         progress.setMinimumDuration(
             max(0, old_min_time - (datetime.now()-start_time).seconds*1000))
         progress.reset()
         progress.setLabelText(
-            'Creating {} Clips'.format(len(datums)))
+            'Creating {} Clips'.format(num))
 
         self.new_clip(screen_x, homerow_screen_y, clip.datum, 0, emit=False)
+        datums = chain(ranked_positives, [None], unscoreds)
         for i, datum_key in enumerate(datums):
             progress.setValue(i+1)
             if datum_key is None:
@@ -781,20 +970,17 @@ class Grid(WrenController):
                                                "Get text",
                                                "Your name:",
                                                QLineEdit.Normal, "")
-        found = None
-        if okPressed and text != '':
-            for datum_key in self.active_datums:
-                datum = get(datum_key)
-                datum_text = datum.model.data
-                log.debug(datum_text)
-                if text == datum_text:
-                    found = datum
-                    break
-        for (x, y), clip in self.coordinates_to_clip.items():
-            if clip.datum == found:
+        if not okPressed or text == '':
+            return None
+        storage = model.get_storage()
+        # Best match first, the first one with a Clip in this Grid wins.
+        for datum_key in storage.search_datums(text):
+            for row in storage.find_clips(self.model.key, datum_key):
+                clip = self.coordinates_to_clip[row[2], row[3]]
                 # scroll to this Clip.
                 self.scroll_to_clip(clip)
                 return clip
+        self.status_bar.showMessage('Find fail - no Clip for {}'.format(text))
         return None
 
     def scroll_to_clip(self, clip):
@@ -1026,6 +1212,10 @@ class Clip(WrenController):
         self.grid = get(self.model.grid_key)
         self.is_blank = False
 
+    @staticmethod
+    def setup_keys(instance_model):
+        return [instance_model.datum_key, instance_model.grid_key]
+
     def set_datum_name(self, datum_name):
         self.datum.set_name(datum_name)
 
@@ -1043,3 +1233,13 @@ def _init_model_to_controller_map():
             if issubclass(cls, WrenController):
                 MODEL_TO_CONTROLLER[cls.model_class.__name__] = cls
 _init_model_to_controller_map()
+
+
+def _reload_grids():
+    """Read the set up Grids again after a batch was rolled back, their
+    Models are read again first, see model._reload_models."""
+    for controller in get_controller_id_map().values():
+        if isinstance(controller, Grid) and \
+                hasattr(controller, 'coordinates_to_clip'):
+            controller.reload()
+model.on_rollback(_reload_grids)
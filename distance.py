@@ -0,0 +1,217 @@
+"""Distance kernels for scoring with an embedding, numpy and float32.
+
+These work out the same distances as poincare.model's PoincareDistance,
+EuclideanDistance and TranseDistance, but for inference only: no autograd,
+no state saved for a backward pass, no torch. Each is made with the
+vectors it measures to, the rows of an embedding, and works out the
+squared norms of those once.
+
+    kernel = PoincareDistance(store.vectors)
+    dists = kernel.one_to_many(store.vectors[term_id])  # To every row
+    dists = kernel.one_to_rows(store.vectors[term_id], ids)  # To rows ids
+    matrix = kernel.pairwise(store.vectors[term_ids])  # Each to every row
+    dists = kernel.paired(us, vs)  # us[i] to vs[i]
+
+ranked() orders a distance vector a chunk at a time, nearest first.
+
+A kernel reuses a buffer a row of results long, so it is not safe to
+share between threads.
+
+Results are float32 and match the float64 torch versions to within 1e-5.
+EuclideanDistance.pairwise expands |u - v|^2 to |u|^2 + |v|^2 - 2 u.v for
+one matrix product, so it is off by about 1e-7 for points close together.
+
+"""
+import numpy as np
+
+# As in poincare.model
+EPS = 1e-5
+BOUNDARY = 1 - EPS
+
+
+def _as_float32(array):
+    return np.ascontiguousarray(array, dtype=np.float32)
+
+
+def _squared_norms(vectors):
+    """|v|^2 of each row"""
+    return np.einsum('ij,ij->i', vectors, vectors)
+
+
+class EuclideanDistance:
+    """Squared euclidean distance, sum((u - v) ** 2)
+
+    The rows are kept a column per dimension, so working out a distance to
+    every row is a pass over a contiguous array for each dimension and not
+    a sum along the short rows.
+
+    """
+    def __init__(self, vectors):
+        self.columns = _as_float32(np.transpose(vectors))
+        self.sqnorms = _squared_norms(self.columns.T)
+        self._buffer = None
+
+    def __len__(self):
+        return self.columns.shape[1]
+
+    def _query(self, us):
+        """The query vectors, as float32"""
+        return _as_float32(us)
+
+    def _squared_distances(self, u, out=None):
+        """sum((u - v) ** 2) for every row v"""
+        if self._buffer is None:
+            self._buffer = np.empty(len(self), dtype=np.float32)
+        buffer = self._buffer
+        sq = np.subtract(self.columns[0], u[0], out=out)
+        np.multiply(sq, sq, out=sq)
+        for column, x in zip(self.columns[1:], u[1:]):
+            np.subtract(column, x, out=buffer)
+            np.multiply(buffer, buffer, out=buffer)
+            np.add(sq, buffer, out=sq)
+        return sq
+
+    def _squared_distance_matrix(self, us):
+        # |u|^2 + |v|^2 - 2 u.v, one matrix product and no len(us) x rows x
+        # dim temporary.
+        sq = us @ self.columns
+        sq *= -2
+        sq += _squared_norms(us)[:, None]
+        sq += self.sqnorms
+        return np.maximum(sq, 0, out=sq)
+
+    def one_to_many(self, u):
+        """Array of the distance from vector u to every row"""
+        return self._squared_distances(self._query(u))
+
+    def one_to_rows(self, u, ids):
+        """Array of the distance from vector u to each of the rows ids, a
+        slice or an array of indices"""
+        return self.to_rows(u)(ids)
+
+    def to_rows(self, u):
+        """one_to_rows for the one vector u, as a function of ids, for many
+        lookups from the same u"""
+        u = self._query(u)
+        return lambda ids: self._squared_distances_to(u, ids)
+
+    def _squared_distances_to(self, u, ids):
+        # ids may be a slice, so not in place.
+        diff = np.subtract(self.columns[:, ids], u[:, None])
+        return np.einsum('ij,ij->j', diff, diff)
+
+    def pairwise(self, us):
+        """Matrix of the distance from each of the vectors us to every row"""
+        return self._squared_distance_matrix(self._query(us))
+
+    def paired(self, us, vs):
+        """Array of the distance from us[i] to vs[i], for each i"""
+        diff = np.subtract(self._query(us), vs, dtype=np.float32)
+        return np.einsum('ij,ij->i', diff, diff)
+
+
+class TranseDistance(EuclideanDistance):
+    """TransE distance, sum((u - v + r) ** 2) for a relation vector r"""
+    def __init__(self, vectors, r):
+        super().__init__(vectors)
+        self.r = _as_float32(r).reshape(-1)
+
+    def _query(self, us):
+        # u + r, so the rest is as euclidean
+        return np.add(us, self.r, dtype=np.float32)
+
+
+def _arcosh_1p(delta):
+    """arcosh(1 + delta) in place of delta
+
+    Worked out as log1p(delta + sqrt(delta * (delta + 2))) so small
+    distances don't lose their precision to the 1.
+
+    """
+    tmp = delta + 2
+    tmp *= delta
+    np.sqrt(tmp, out=tmp)
+    tmp += delta
+    return np.log1p(tmp, out=delta)
+
+
+class PoincareDistance(EuclideanDistance):
+    """Distance in the poincare ball,
+    arcosh(1 + 2 |u - v|^2 / ((1 - |u|^2) (1 - |v|^2)))
+
+    Squared norms are clamped to BOUNDARY, as in poincare.model.
+
+    """
+    def __init__(self, vectors):
+        super().__init__(vectors)
+        # 1 - |v|^2 of every row
+        self.alphas = self._alphas(vectors)
+
+    @staticmethod
+    def _alphas(us):
+        """1 - |u|^2 for each u, worked out in float64 as near the edge of
+        the ball it is a small difference of numbers close to 1."""
+        us = np.asarray(us, dtype=np.float64)
+        return (1 - np.clip(_squared_norms(us), 0, BOUNDARY))\
+            .astype(np.float32)
+
+    def one_to_many(self, u):
+        alpha = self._alphas(np.reshape(u, (1, -1)))[0]
+        delta = self._squared_distances(self._query(u))
+        delta *= 2 / alpha
+        delta /= self.alphas
+        return _arcosh_1p(delta)
+
+    def to_rows(self, u):
+        scale = 2 / self._alphas(np.reshape(u, (1, -1)))[0]
+        squared_distances = super().to_rows(u)
+
+        def distances(ids):
+            delta = squared_distances(ids)
+            delta *= scale
+            delta /= self.alphas[ids]
+            return _arcosh_1p(delta)
+        return distances
+
+    def pairwise(self, us):
+        # Not the matrix product of EuclideanDistance, near the edge of the
+        # ball its rounding is blown up by the alphas, so a row at a time.
+        us = self._query(us)
+        delta = np.empty((len(us), len(self)), dtype=np.float32)
+        for u, row in zip(us, delta):
+            self._squared_distances(u, out=row)
+        delta *= 2
+        delta /= self._alphas(us)[:, None]
+        delta /= self.alphas
+        return _arcosh_1p(delta)
+
+    def paired(self, us, vs):
+        delta = super().paired(us, vs)
+        delta *= 2
+        delta /= self._alphas(us)
+        delta /= self._alphas(vs)
+        return _arcosh_1p(delta)
+
+
+def ranked(dists, k):
+    """Yield arrays of the indices of dists, smallest distance first.
+
+    The first array is the k smallest, the next the 2k after those, and so
+    on, each twice as long as the last. Each is picked out of what is left
+    with argpartition and only it is sorted, so the first screen of a long
+    ranking costs a pass over dists and not a sort of all of it. Ties are in
+    index order within an array.
+
+    """
+    dists = np.asarray(dists)
+    rest = np.arange(len(dists))
+    k = max(k, 1)
+    while len(rest):
+        if k < len(rest):
+            part = np.argpartition(dists[rest], k - 1)
+            chunk = np.sort(rest[part[:k]])
+            rest = rest[part[k:]]
+        else:
+            chunk, rest = rest, rest[:0]
+        yield chunk[np.argsort(dists[chunk], kind='stable')]
+        k *= 2
@@ -0,0 +1,362 @@
+"""Term embeddings, used to score Datums by their distance to each other.
+
+get_embedding() gives the EmbeddingStore for mammals.pth, shared by
+everything that scores. It loads nothing until it is first used.
+
+The first time a checkpoint is used it is converted to a cache: its
+weights as a .npy file, which is memory-mapped, and its objects (the
+terms) as json. The cache files are named by the checkpoint's checksum, so
+a new checkpoint gets a new cache, and after the first time torch is not
+needed to load it. Distances are worked out with distance.py's numpy
+kernels, and nearest terms with a vptree.VPTree once there are enough of
+them, it is cached with the rest.
+
+For a small vocabulary every distance can be worked out ahead of time,
+
+    python embedding.py [float16]
+
+writes the distance matrix to the cache, and after that scores are looked
+up in it (memory-mapped) instead of worked out, see precompute().
+
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+import numpy as np
+
+from wren import log
+
+CHECKPOINT = 'mammals.pth'
+# Relative to the checkpoint's directory.
+CACHE_DIR = 'cache'
+# Number of distance vectors kept, see EmbeddingStore.distances
+DISTANCES_CACHE_SIZE = 64
+# Vocabularies this big get a vptree.VPTree for nearest, smaller ones a pass
+# over every term is quicker. Measured with bench.py vptree, 20 nearest of 5
+# dimensional vectors: the exact search is 0.5x the pass at 82k terms, 1.0x
+# at 250k and 1.4x at 400k.
+INDEX_MIN_TERMS = 250000
+# How far off an approximate nearest can be, see vptree.
+APPROX_EPS = 0.5
+# Biggest vocabulary precompute() will write a distance matrix for, at
+# float32 this one is 1.6GB.
+MATRIX_MAX_TERMS = 20000
+# Rows of the matrix worked out by each task of precompute()'s pool.
+MATRIX_BLOCK_ROWS = 256
+
+
+def file_checksum(file_name):
+    """sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """The terms of a poincare checkpoint and their vectors.
+
+        store = get_embedding()
+        dists = store.distances(store.term_index('mammal.n.01'))
+
+    It loads the first time it is used.
+
+    The last cache_size distance vectors are kept, so a screen of Clips
+    scored against the same few anchors (the selection and the home row)
+    computes each anchor's distances once.
+
+    """
+    def __init__(self, checkpoint=CHECKPOINT, cache_dir=None,
+                 cache_size=None):
+        self.checkpoint = checkpoint
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.path.dirname(os.path.abspath(checkpoint)), CACHE_DIR)
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._version = None
+        self._vectors = None
+        self._objects = None
+        self._index = None  # Map of term to row
+        self._cache_base = None
+        self._tree = None
+        self._matrix = None
+        self._distance_kernel = None
+        if cache_size is None:
+            cache_size = DISTANCES_CACHE_SIZE
+        self.cache_size = cache_size
+        # Map of (version, term_id) to its distances, most recent last.
+        self._distances = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self):
+        """Checksum of the checkpoint"""
+        self._load()
+        return self._version
+
+    @property
+    def vectors(self):
+        """Memory-mapped array, a row per term"""
+        self._load()
+        return self._vectors
+
+    @property
+    def objects(self):
+        """List of the terms, in row order"""
+        self._load()
+        return self._objects
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            version = file_checksum(self.checkpoint)
+            stem = os.path.splitext(os.path.basename(self.checkpoint))[0]
+            base = os.path.join(self.cache_dir,
+                                '{}-{}'.format(stem, version[:16]))
+            vectors_name = base + '.npy'
+            objects_name = base + '.json'
+            if not (os.path.exists(vectors_name) and
+                    os.path.exists(objects_name)):
+                self._convert(vectors_name, objects_name)
+            self._vectors = np.load(vectors_name, mmap_mode='r')
+            with open(objects_name) as f:
+                self._objects = json.load(f)
+            self._index = {term: i for i, term in enumerate(self._objects)}
+            self._version = version
+            self._cache_base = base
+            for dtype in [np.float32, np.float16]:
+                matrix_name = self._matrix_name(dtype)
+                if os.path.exists(matrix_name):
+                    self._matrix = np.load(matrix_name, mmap_mode='r')
+                    break
+            self._loaded = True
+
+    def _convert(self, vectors_name, objects_name):
+        """Write the checkpoint's weights and objects to the cache."""
+        import torch as th
+        log.info('Caching embedding {}'.format(self.checkpoint))
+        serialization = th.load(self.checkpoint)
+        vectors = serialization['model']['lt.weight'].cpu().numpy()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Written under another name and moved, so a half written cache is
+        # never used.
+        with open(vectors_name + '.tmp', 'wb') as f:
+            np.save(f, vectors)
+        with open(objects_name + '.tmp', 'w') as f:
+            json.dump(list(serialization['objects']), f)
+        os.replace(vectors_name + '.tmp', vectors_name)
+        os.replace(objects_name + '.tmp', objects_name)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __contains__(self, term):
+        self._load()
+        return term in self._index
+
+    def term_index(self, term):
+        """Row of a term, raises KeyError if it has none"""
+        self._load()
+        return self._index[term]
+
+    def term_indexes(self, terms):
+        """Array of the row of each term, -1 for those that have none"""
+        self._load()
+        index = self._index
+        return np.array([index.get(term, -1) for term in terms],
+                        dtype=np.int64)
+
+    def distances(self, term_id):
+        """Array of the poincare distance from term_id to every term
+
+        It is shared with other callers, so it is read only. With a
+        precomputed matrix it is the matrix's row.
+
+        """
+        matrix = self.matrix
+        if matrix is not None:
+            return matrix[term_id]
+        key = (self.version, term_id)
+        with self._lock:
+            dists = self._distances.get(key)
+            if dists is not None:
+                self.hits += 1
+                self._distances.move_to_end(key)
+                return dists
+            self.misses += 1
+        dists = self._compute_distances(term_id)
+        dists.setflags(write=False)
+        with self._lock:
+            self._distances[key] = dists
+            while len(self._distances) > self.cache_size:
+                self._distances.popitem(last=False)
+        return dists
+
+    def distance(self, a_term_id, b_term_id):
+        """The poincare distance between two terms"""
+        matrix = self.matrix
+        if matrix is not None:
+            return float(matrix[a_term_id, b_term_id])
+        with self._lock:
+            dists = self._distances.get((self.version, a_term_id))
+        if dists is not None:
+            return float(dists[b_term_id])
+        return float(self.distances_to(a_term_id, [b_term_id])[0])
+
+    def distances_to(self, term_id, term_ids):
+        """Array of the poincare distance from term_id to each of
+        term_ids, without a pass over the other terms"""
+        matrix = self.matrix
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        if matrix is not None:
+            return matrix[term_id, term_ids]
+        return self._kernel().one_to_rows(self.vectors[term_id], term_ids)
+
+    def pair_distances(self, a_term_ids, b_term_ids):
+        """Array of the poincare distance between each a and b term, in one
+        pass, ex. the scores of a screen of Clips."""
+        matrix = self.matrix
+        if matrix is not None:
+            return matrix[list(a_term_ids), list(b_term_ids)]
+        vectors = self.vectors
+        return self._kernel().paired(vectors[list(a_term_ids)],
+                                     vectors[list(b_term_ids)])
+
+    @property
+    def matrix(self):
+        """Memory-mapped array of the distance between every two terms,
+        None if it has not been precomputed"""
+        self._load()
+        return self._matrix
+
+    def _matrix_name(self, dtype):
+        return '{}-matrix.{}.npy'.format(self._cache_base,
+                                         np.dtype(dtype).name)
+
+    def precompute(self, dtype=np.float32, processes=None):
+        """Write the distance matrix to the cache, as dtype (float32 or
+        float16) and use it from now on.
+
+        It is worked out MATRIX_BLOCK_ROWS at a time across a pool of
+        processes, each writing its rows to the memory-mapped file. Like
+        the rest of the cache it is named by the checkpoint's checksum.
+
+        """
+        self._load()
+        num = len(self)
+        if num > MATRIX_MAX_TERMS:
+            raise ValueError('{} terms is too many for a distance matrix, '
+                             'it is at most {}'.format(num, MATRIX_MAX_TERMS))
+        matrix_name = self._matrix_name(dtype)
+        vectors_name = self._cache_base + '.npy'
+        tmp_name = matrix_name + '.tmp'
+        log.info('Precomputing {}x{} distances of {}'.format(
+            num, num, self.checkpoint))
+        np.lib.format.open_memmap(tmp_name, mode='w+', dtype=dtype,
+                                  shape=(num, num)).flush()
+        blocks = [(start, min(start + MATRIX_BLOCK_ROWS, num))
+                  for start in range(0, num, MATRIX_BLOCK_ROWS)]
+        with multiprocessing.Pool(processes, _init_matrix_worker,
+                                  (vectors_name, tmp_name)) as pool:
+            for _ in pool.imap_unordered(_write_matrix_block, blocks):
+                pass
+        os.replace(tmp_name, matrix_name)
+        with self._lock:
+            self._matrix = np.load(matrix_name, mmap_mode='r')
+            self._distances.clear()
+
+    @property
+    def index(self):
+        """vptree.VPTree of the vectors, built the first time it is used
+        and cached"""
+        if self._tree is None:
+            from vptree import VPTree
+            self._load()
+            tree_name = self._cache_base + '.vpt.npz'
+            if os.path.exists(tree_name):
+                tree = VPTree.load(tree_name, self.vectors)
+            else:
+                log.info('Indexing embedding {}'.format(self.checkpoint))
+                tree = VPTree(self.vectors)
+                tree.save(tree_name + '.tmp')
+                os.replace(tree_name + '.tmp', tree_name)
+            self._tree = tree
+        return self._tree
+
+    def nearest(self, term_id, k, exact=True):
+        """Get (term_ids, dists) of the k terms nearest term_id, nearest
+        first, term_id itself among them. Without exact it is quicker but
+        approximate, see vptree. Asking for every term is a sort of all of
+        them, it does not use the vptree."""
+        if len(self) < INDEX_MIN_TERMS or k >= len(self):
+            from distance import ranked
+            dists = self.distances(term_id)
+            term_ids = next(ranked(dists, k))[:k]
+            return term_ids, dists[term_ids]
+        return self.index.knn(self.vectors[term_id], k,
+                              eps=0.0 if exact else APPROX_EPS)
+
+    def within(self, term_id, radius):
+        """Get (term_ids, dists) of the terms no further than radius from
+        term_id, nearest first"""
+        if len(self) < INDEX_MIN_TERMS:
+            dists = self.distances(term_id)
+            term_ids = np.flatnonzero(dists <= radius)
+            term_ids = term_ids[np.argsort(dists[term_ids], kind='stable')]
+            return term_ids, dists[term_ids]
+        return self.index.within(self.vectors[term_id], radius)
+
+    def _compute_distances(self, term_id):
+        return self._kernel().one_to_many(self.vectors[term_id])
+
+    def _kernel(self):
+        if self._distance_kernel is None:
+            from distance import PoincareDistance
+            self._distance_kernel = PoincareDistance(self.vectors)
+        return self._distance_kernel
+
+
+# The vectors, their kernel and the matrix being written, in each of
+# precompute()'s processes.
+_WORKER_VECTORS = None
+_WORKER_KERNEL = None
+_WORKER_MATRIX = None
+def _init_matrix_worker(vectors_name, matrix_name):
+    global _WORKER_VECTORS, _WORKER_KERNEL, _WORKER_MATRIX
+    from distance import PoincareDistance
+    _WORKER_VECTORS = np.load(vectors_name, mmap_mode='r')
+    _WORKER_KERNEL = PoincareDistance(_WORKER_VECTORS)
+    _WORKER_MATRIX = np.load(matrix_name, mmap_mode='r+')
+
+
+def _write_matrix_block(block):
+    start, end = block
+    _WORKER_MATRIX[start:end] = _WORKER_KERNEL.pairwise(
+        _WORKER_VECTORS[start:end])
+    _WORKER_MATRIX.flush()
+
+
+_EMBEDDING = None
+def get_embedding():
+    """The shared EmbeddingStore of CHECKPOINT"""
+    global _EMBEDDING
+    if _EMBEDDING is None:
+        _EMBEDDING = EmbeddingStore()
+    return _EMBEDDING
+
+
+if __name__ == '__main__':
+    # Precompute the distance matrix, float32 unless float16 is given.
+    get_embedding().precompute(*sys.argv[1:2])
@@ -0,0 +1,350 @@
+"""Backends for WrenData's key-kind-value store.
+
+WrenData keeps each Model as a (kind, value) under its key, see
+WrenModel.save. The backend is where those are kept:
+
+    SQLiteKVStore - the kvs table of the sqlite file, the default.
+    LogKVStore - an append-only log file with an in-memory index.
+
+Set wren.KVS_BACKEND to 'sqlite' or 'log' to choose. A file made with
+sqlite has its kvs rows copied to the log the first time it is opened with
+the log backend. The rows stay in the table, but the log has the writes
+after that, so going back to sqlite goes back to the file as it was then.
+
+A backend has get, get_many, write, scan, commit, rollback and close. A
+write is seen by reads at once but is only durable after commit, and
+rollback drops the writes since the last commit. WrenData commits and
+rolls back the backend with its own transactions, see WrenData.batch.
+
+"""
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from wren import log
+
+# Record header: crc32, flags, key size, kind size, value size. The crc32 is
+# of the rest of the record, the header after it and the key, kind and
+# value, which follow it.
+_HEADER = struct.Struct('<IBHHI')
+FLAG_BYTES = 1  # The value is bytes, not text.
+
+
+class SQLiteKVStore:
+    """The kvs table of WrenData's sqlite connection.
+
+    It shares the connection, so it is in WrenData's transactions and
+    commit and rollback are left to WrenData.
+
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, key):
+        """Get (kind, value) for key, None if there is none"""
+        cmd = 'SELECT kind, value FROM kvs WHERE key=?'
+        return self.conn.execute(cmd, (key,)).fetchone()
+
+    def get_many(self, keys):
+        """Get a map of key to (kind, value), keys not found are left out."""
+        # Keep the query under sqlite's limit on the number of variables.
+        chunk_size = 500
+        keys = list(keys)
+        results = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            cmd = 'SELECT key, kind, value FROM kvs WHERE key IN ({})'\
+                .format(', '.join('?' * len(chunk)))
+            for key, kind, value in self.conn.execute(cmd, chunk):
+                results[key] = (kind, value)
+        return results
+
+    def write(self, key, kind, value):
+        cmd = 'REPLACE INTO kvs (key, kind, value) VALUES (?, ?, ?)'
+        self.conn.execute(cmd, (key, kind, value))
+
+    def scan(self, kind=None):
+        """Get a list of (key, kind, value), of only the given kind if it is
+        not None"""
+        if kind is None:
+            return self.conn.execute(
+                'SELECT key, kind, value FROM kvs').fetchall()
+        cmd = 'SELECT key, kind, value FROM kvs WHERE kind=?'
+        return self.conn.execute(cmd, (kind,)).fetchall()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _encode_record(key, kind, value):
+    flags = 0
+    if isinstance(value, bytes):
+        flags |= FLAG_BYTES
+    else:
+        value = value.encode('utf-8')
+    key = key.encode('utf-8')
+    kind = kind.encode('utf-8')
+    record = bytearray(_HEADER.pack(0, flags, len(key), len(kind),
+                                    len(value)))
+    record += key
+    record += kind
+    record += value
+    struct.pack_into('<I', record, 0, zlib.crc32(memoryview(record)[4:]))
+    return record
+
+
+def _decode_record(record):
+    """Get (key, kind, value) from a record"""
+    _, flags, key_size, kind_size, value_size = _HEADER.unpack_from(record)
+    start = _HEADER.size
+    key = record[start:start + key_size].decode('utf-8')
+    start += key_size
+    kind = record[start:start + kind_size].decode('utf-8')
+    start += kind_size
+    value = record[start:start + value_size]
+    if not flags & FLAG_BYTES:
+        value = value.decode('utf-8')
+    return key, kind, value
+
+
+def _scan_records(data):
+    """Yield (offset, size, key, kind) of each record in data, in order.
+
+    It stops at the first record that is cut short or fails its crc32, the
+    end of the last one yielded is where the good records end.
+
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        crc, _, key_size, kind_size, value_size = _HEADER.unpack_from(
+            data, offset)
+        size = _HEADER.size + key_size + kind_size + value_size
+        if offset + size > len(data) or \
+                zlib.crc32(view[offset + 4:offset + size]) != crc:
+            return
+        start = offset + _HEADER.size
+        key = bytes(view[start:start + key_size]).decode('utf-8')
+        start += key_size
+        kind = sys.intern(bytes(view[start:start + kind_size])
+                          .decode('utf-8'))
+        yield offset, size, key, kind
+        offset += size
+
+
+class LogKVStore:
+    """An append-only log file of (key, kind, value) records.
+
+    A write appends a record and the latest record of a key wins. An
+    in-memory index has where each key's latest record is, so a read is
+    one seek. Writes are held until commit, which appends them all with
+    one write and one fsync (a group commit), so a batch or a flush of the
+    write-behind queue costs one sync however many Models it saves.
+
+    Records written over are garbage. When there is more garbage than
+    live records, and at least compact_min bytes of it, a background
+    thread copies the live records to a new file and swaps it in, see
+    compact().
+
+    A record cut short by a crash in the middle of a commit is cut off the
+    end of the log when it is opened.
+
+    """
+    def __init__(self, file_name, fsync=True, compact_min=1 << 20):
+        self.file_name = file_name
+        self.fsync = fsync
+        self.compact_min = compact_min
+        self._lock = threading.RLock()
+        self._index = {}  # Map of key to (kind, offset, size) of its record
+        self._pending = {}  # Map of key to (kind, value), not committed yet
+        self._garbage = 0  # Bytes of records written over
+        self._end = 0
+        self._compactor = None
+        # Bytes appended to the log, compaction included, and the number of
+        # compactions.
+        self.bytes_written = 0
+        self.compactions = 0
+        if not os.path.exists(file_name):
+            open(file_name, 'wb').close()
+        self._file = open(file_name, 'r+b')
+        self._load()
+
+    def _load(self):
+        data = self._file.read()
+        for offset, size, key, kind in _scan_records(data):
+            if key in self._index:
+                self._garbage += self._index[key][2]
+            self._index[key] = (kind, offset, size)
+            self._end = offset + size
+        if self._end < len(data):
+            log.warning('Cutting {} bytes of torn records off {}'.format(
+                len(data) - self._end, self.file_name))
+            self._file.truncate(self._end)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index.keys() | self._pending.keys())
+
+    def get(self, key):
+        """Get (kind, value) for key, None if there is none"""
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            kind, offset, size = entry
+            self._file.seek(offset)
+            return kind, _decode_record(self._file.read(size))[2]
+
+    def get_many(self, keys):
+        """Get a map of key to (kind, value), keys not found are left out."""
+        results = {}
+        with self._lock:
+            found = []
+            for key in keys:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    results[key] = pending
+                elif key in self._index:
+                    found.append(self._index[key])
+            # Read in file order.
+            found.sort(key=lambda entry: entry[1])
+            for kind, offset, size in found:
+                self._file.seek(offset)
+                key, _, value = _decode_record(self._file.read(size))
+                results[key] = (kind, value)
+        return results
+
+    def write(self, key, kind, value):
+        with self._lock:
+            self._pending[key] = (kind, value)
+
+    def scan(self, kind=None):
+        """Get a list of (key, kind, value), of only the given kind if it is
+        not None"""
+        with self._lock:
+            keys = [key for key, entry in self._index.items()
+                    if key not in self._pending
+                    and (kind is None or entry[0] == kind)]
+            results = list(self.get_many(keys).items())
+            results += [(key, pending) for key, pending
+                        in self._pending.items()
+                        if kind is None or pending[0] == kind]
+        return [(key, got_kind, value)
+                for key, (got_kind, value) in results]
+
+    def commit(self):
+        """Append the writes since the last commit to the log."""
+        with self._lock:
+            if not self._pending:
+                return
+            records = []
+            entries = []
+            offset = self._end
+            for key, (kind, value) in self._pending.items():
+                record = _encode_record(key, kind, value)
+                records.append(record)
+                entries.append((key, (sys.intern(kind), offset,
+                                      len(record))))
+                offset += len(record)
+            self._append(b''.join(records))
+            self._pending = {}
+            for key, entry in entries:
+                if key in self._index:
+                    self._garbage += self._index[key][2]
+                self._index[key] = entry
+            self._end = offset
+            self._maybe_compact()
+
+    def rollback(self):
+        with self._lock:
+            self._pending = {}
+
+    def _append(self, data):
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.bytes_written += len(data)
+
+    def _maybe_compact(self):
+        if self._compactor is not None or \
+                self._garbage < self.compact_min or \
+                self._garbage <= self._end - self._garbage:
+            return
+        self._compactor = threading.Thread(target=self._run_compactor,
+                                           name='wren-compactor',
+                                           daemon=True)
+        self._compactor.start()
+
+    def _run_compactor(self):
+        try:
+            self.compact()
+        except Exception:
+            log.exception('Compacting {} failed'.format(self.file_name))
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def compact(self):
+        """Rewrite the log with only the latest record of each key.
+
+        The live records are copied without the lock, so reads and commits
+        go on. Records committed in the meantime are copied after them with
+        the lock held, and then the new file replaces the old one.
+
+        """
+        with self._lock:
+            entries = sorted(self._index.items(),
+                             key=lambda item: item[1][1])
+            copied_end = self._end
+        new_name = self.file_name + '.compact'
+        index = {}
+        end = 0
+        with open(self.file_name, 'rb') as old, open(new_name, 'wb') as new:
+            for key, (kind, offset, size) in entries:
+                old.seek(offset)
+                new.write(old.read(size))
+                index[key] = (kind, end, size)
+                end += size
+            with self._lock:
+                old.seek(copied_end)
+                tail = old.read(self._end - copied_end)
+                garbage = 0
+                for offset, size, key, kind in _scan_records(tail):
+                    if key in index:
+                        garbage += index[key][2]
+                    index[key] = (kind, end + offset, size)
+                new.write(tail)
+                new.flush()
+                os.fsync(new.fileno())
+                new.close()
+                self.bytes_written += end + len(tail)
+                old.close()
+                self._file.close()
+                os.replace(new_name, self.file_name)
+                self._file = open(self.file_name, 'r+b')
+                self._index = index
+                self._end = end + len(tail)
+                self._garbage = garbage
+                self.compactions += 1
+
+    def close(self):
+        """Commit and wait for compaction to finish."""
+        self.commit()
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            self._file.close()
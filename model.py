@@ -1,11 +1,17 @@
 
+from collections.abc import Mapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import json
 import os
 import pytz
 import sqlite3
+import threading
 from uuid import uuid1
 
+import codec
+from kvstore import LogKVStore, SQLiteKVStore
+import wren
 from wren import IDMap, log
 from exceptions import NotFound
 
@@ -37,6 +43,47 @@ def get_model(key):
         id_map.set(key, model)
     return model
 
+def get_models(keys):
+    """Get id-mapped Models for many keys, loading the missing ones in bulk.
+
+    Returns a list in the order of keys. Raises NotFound if any are missing.
+
+    """
+    id_map = get_model_id_map()
+    models = {}
+    missing = []
+    for key in keys:
+        model = id_map.get(key)
+        if model is None:
+            missing.append(key)
+        else:
+            models[key] = model
+    if missing:
+        loaded = WrenModel.load_many(missing)
+        for key, model in loaded.items():
+            id_map.set(key, model)
+        models.update(loaded)
+    try:
+        return [models[key] for key in keys]
+    except KeyError:
+        raise NotFound
+
+
+# Called after a batch is rolled back, see on_rollback().
+_ROLLBACK_HANDLERS = []
+def on_rollback(handler):
+    """Call handler() after a batch of get_storage() is rolled back, to
+    bring what is in memory back in step with storage."""
+    _ROLLBACK_HANDLERS.append(handler)
+
+
+def to_score(value):
+    """A relationship value as a float score, None if it is not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 
 epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
 def unix_time(dt):
@@ -58,22 +105,60 @@ class WrenData:
     This is a key-type-value store, it returns a string. Each element has
     to stuff its data into a string (suggest: json, with text uuid as key.)
 
+    Writes commit as they are made unless they are inside a batch, see
+    batch(), or the write-behind thread is running, see start_writer().
+
+    The key-type-value store is in the kvs table, or in a log file next to
+    the db if backend (by default wren.KVS_BACKEND) is 'log', see
+    kvstore.py.
+
     """
-    def __init__(self, file_name='wren_temp.db'):
-        self.conn = sqlite3.connect(file_name)
+    def __init__(self, file_name='wren_temp.db', backend=None):
+        # The write-behind thread shares this connection, all use of it is
+        # under self._lock.
+        self.conn = sqlite3.connect(file_name, check_same_thread=False)
+        if backend is None:
+            backend = wren.KVS_BACKEND
+        if backend == 'sqlite':
+            self.kvs = SQLiteKVStore(self.conn)
+            log_name = file_name + '.log'
+            if os.path.isfile(log_name) and os.path.getsize(log_name):
+                # The kvs rows were copied to the log, see _copy_kvs(), and
+                # the log has had the writes since.
+                log.warning('{} has a log, its kvs table may be older than '
+                            'it, see wren.KVS_BACKEND'.format(file_name))
+        elif backend == 'log':
+            if file_name == ':memory:':
+                raise ValueError('The log backend needs a file')
+            self.kvs = LogKVStore(file_name + '.log')
+        else:
+            raise ValueError('Unknown kvs backend {}'.format(backend))
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        # Writes waiting for the write-behind thread, map of a queue key
+        # (what the write is to, ex: ('kvs', key)) to (cmd, params). Only the
+        # latest write to each queue key is kept, in the order of the latest
+        # writes.
+        self._pending = {}
+        self._writer = None
+        self._writer_stop = None
+        # Set by create_tables(), False if sqlite has no fts5.
+        self.has_text_index = False
 
     @staticmethod
-    def initialize(file_name='wren_temp.db'):
+    def initialize(file_name='wren_temp.db', backend=None):
         """Creates file if does not exist."""
         if file_name != ':memory' and os.path.isfile(file_name):
             # Assume it is correct, user can delete and recreate if it's not.
-            return WrenData(file_name=file_name)
+            wren_data = WrenData(file_name=file_name, backend=backend)
+            wren_data.create_tables()
+            return wren_data
         # Note if you close the connection to a :memory: db it disappears.
 
         log.info("Creating temp file {file_name}".format(file_name=file_name))
 
         # This creates the file when it calls conn = sqlite3.connect(file_name)
-        wren_data = WrenData(file_name=file_name)
+        wren_data = WrenData(file_name=file_name, backend=backend)
 
         # Create the database and table
         #conn.execute('CREATE DATABASE ?;', ('main',))
@@ -82,19 +167,593 @@ class WrenData:
                                    value varchar(10000),
                                    PRIMARY KEY (key));"""
         wren_data.conn.execute(cmd)
+        wren_data.create_tables()
         return wren_data
 
+    def create_tables(self):
+        """Create the tables that sit beside kvs, if they are missing.
+
+        These came after the kvs table, so files made by older versions of
+        Wren get them the next time they are opened.
+
+        """
+        self._copy_kvs()
+        # Clips are stored a row each so moving one Clip does not rewrite
+        # its whole Grid.
+        cmd = """CREATE TABLE IF NOT EXISTS clips (
+                     grid_key varchar(100),
+                     clip_key varchar(100),
+                     datum_key varchar(100),
+                     x integer,
+                     y integer,
+                     edit_cursor_position integer,
+                     PRIMARY KEY (grid_key, clip_key));"""
+        self.conn.execute(cmd)
+        cmd = """CREATE INDEX IF NOT EXISTS clips_by_coordinates
+                     ON clips (grid_key, x, y);"""
+        self.conn.execute(cmd)
+        # Loading a ClipModel by its key alone, see ClipModel.load_many.
+        cmd = 'CREATE INDEX IF NOT EXISTS clips_by_key ON clips (clip_key);'
+        self.conn.execute(cmd)
+        # Datums are indexed by name, so finding one by name is one lookup.
+        # kind is the model class name and last_changed is in unix_time()
+        # units, so Datums sort by when they changed without loading them.
+        # id is the row's rowid, named so VACUUM keeps it, datums_text
+        # refers to rows by it.
+        cmd = """CREATE TABLE IF NOT EXISTS datums (
+                     id INTEGER PRIMARY KEY,
+                     key varchar(100) UNIQUE,
+                     name varchar(100),
+                     data text,
+                     kind varchar(100),
+                     last_changed integer);"""
+        self.conn.execute(cmd)
+        cmd = 'CREATE INDEX IF NOT EXISTS datums_by_name ON datums (name);'
+        self.conn.execute(cmd)
+        if self.conn.execute(
+                'SELECT count(*) FROM datums').fetchone()[0] == 0:
+            self._index_datums()
+        cmd = """CREATE INDEX IF NOT EXISTS datums_by_last_changed
+                     ON datums (kind, last_changed);"""
+        self.conn.execute(cmd)
+        self._create_datums_text()
+        # Finding the Clips of a Datum.
+        cmd = """CREATE INDEX IF NOT EXISTS clips_by_datum
+                     ON clips (grid_key, datum_key);"""
+        self.conn.execute(cmd)
+        # A Grid's relationship scores and active datums are rows too, so
+        # changing one is one write and not a rewrite of the Grid.
+        # value is the text as typed, score is it as a float or NULL if it
+        # is not a number, so scores sort and filter in sql.
+        cmd = """CREATE TABLE IF NOT EXISTS relationships (
+                     grid_key varchar(100),
+                     a_key varchar(100),
+                     b_key varchar(100),
+                     value varchar(100),
+                     score real,
+                     PRIMARY KEY (grid_key, a_key, b_key));"""
+        self.conn.execute(cmd)
+        cmd = """CREATE INDEX IF NOT EXISTS relationships_by_a_score
+                     ON relationships (grid_key, a_key, score);"""
+        self.conn.execute(cmd)
+        cmd = """CREATE INDEX IF NOT EXISTS relationships_by_b_score
+                     ON relationships (grid_key, b_key, score);"""
+        self.conn.execute(cmd)
+        # Active datums are read back in rowid order, the order they were
+        # added in.
+        cmd = """CREATE TABLE IF NOT EXISTS active_datums (
+                     grid_key varchar(100),
+                     datum_key varchar(100),
+                     PRIMARY KEY (grid_key, datum_key));"""
+        self.conn.execute(cmd)
+        self.conn.commit()
+
+    def _copy_kvs(self):
+        """Copy the kvs table to the log, the first time a file made with
+        the sqlite backend is opened with the log backend.
+
+        The rows are left in the kvs table, but once the log has any
+        records it is what is read and written, the table is not kept up
+        to date.
+
+        """
+        if isinstance(self.kvs, SQLiteKVStore) or len(self.kvs):
+            return
+        rows = SQLiteKVStore(self.conn).scan()
+        if not rows:
+            return
+        log.info('Copying {} rows from kvs to {}'.format(
+            len(rows), self.kvs.file_name))
+        for key, kind, value in rows:
+            self.kvs.write(key, kind, value)
+        self.kvs.commit()
+
+    def _index_datums(self):
+        """Fill the datums table from kvs, for files made before it."""
+        kind = DatumModel.__name__
+        for key, _, value in self.kvs.scan(kind):
+            # The first fields of DatumModel.serialize()
+            data, name, last_changed = json.loads(value)[:3]
+            self._write_datum_row(key, name, data, kind, last_changed)
+
+    def _create_datums_text(self):
+        """Create the full text index of datum names and data.
+
+        It is an sqlite fts5 table over the datums table, kept up to date by
+        triggers. If this sqlite has no fts5 search_datums() falls back to
+        LIKE.
+
+        """
+        tables = [row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")]
+        cmd = """CREATE VIRTUAL TABLE IF NOT EXISTS datums_text
+                     USING fts5(name, data, content='datums',
+                                content_rowid='id');"""
+        try:
+            self.conn.execute(cmd)
+        except sqlite3.OperationalError:
+            log.warning('No sqlite fts5, search will be slow')
+            self.has_text_index = False
+            return
+        self.has_text_index = True
+        if 'datums_text' not in tables:
+            cmd = "INSERT INTO datums_text(datums_text) VALUES ('rebuild');"
+            self.conn.execute(cmd)
+        cmd = """CREATE TRIGGER IF NOT EXISTS datums_text_insert
+                     AFTER INSERT ON datums BEGIN
+                         INSERT INTO datums_text (rowid, name, data)
+                         VALUES (new.id, new.name, new.data);
+                     END;"""
+        self.conn.execute(cmd)
+        cmd = """CREATE TRIGGER IF NOT EXISTS datums_text_delete
+                     AFTER DELETE ON datums BEGIN
+                         INSERT INTO datums_text (datums_text, rowid, name,
+                                                  data)
+                         VALUES ('delete', old.id, old.name, old.data);
+                     END;"""
+        self.conn.execute(cmd)
+        cmd = """CREATE TRIGGER IF NOT EXISTS datums_text_update
+                     AFTER UPDATE ON datums BEGIN
+                         INSERT INTO datums_text (datums_text, rowid, name,
+                                                  data)
+                         VALUES ('delete', old.id, old.name, old.data);
+                         INSERT INTO datums_text (rowid, name, data)
+                         VALUES (new.id, new.name, new.data);
+                     END;"""
+        self.conn.execute(cmd)
+
+    @contextmanager
+    def batch(self):
+        """Make the writes in this block one transaction.
+
+        Batches nest, an inner batch joins the outer one and only the
+        outermost batch commits. If the outermost batch raises, everything
+        written since it began is rolled back, and the loaded Models (and
+        Controllers, see on_rollback) are read again.
+
+            with get_storage().batch():
+                for datum_model in datum_models:
+                    datum_model.save()
+
+        Writes in a batch are not queued for the write-behind thread, and
+        the thread waits for the batch to finish.
+
+        """
+        with self._lock:
+            if self._batch_depth == 0:
+                # Queued writes go first, so they are not lost to a rollback
+                # or written over the batch later.
+                self._flush_pending()
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.kvs.rollback()
+                    self.conn.rollback()
+                    if self is _STORAGE:
+                        for handler in _ROLLBACK_HANDLERS:
+                            handler()
+                raise
+            self._batch_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        """Commit, unless a batch will commit later."""
+        if self._batch_depth == 0:
+            self.kvs.commit()
+            self.conn.commit()
+
+    def _write(self, queue_key, cmd, params):
+        """Execute a write, or queue it if the write-behind thread is on.
+
+        cmd is sql, or a function to call with params, ex. for writes that
+        are not to sqlite or are more than one statement.
+
+        """
+        with self._lock:
+            if self._writer is not None and self._batch_depth == 0:
+                # To the end, so it is written after the writes before it.
+                self._pending.pop(queue_key, None)
+                self._pending[queue_key] = (cmd, params)
+                return
+            self._pending.pop(queue_key, None)
+            self._execute(cmd, params)
+            self._commit()
+
+    def _execute(self, cmd, params):
+        if callable(cmd):
+            cmd(*params)
+        else:
+            self.conn.execute(cmd, params)
+
+    def start_writer(self, interval=0.25):
+        """Start the write-behind thread.
+
+        Writes are queued and written by a background thread every
+        `interval` seconds, so interactive saves don't wait on sqlite.
+        Repeated writes to the same key between flushes become one write.
+        Reads flush the queue first so they always see the latest writes.
+
+        """
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer_stop = threading.Event()
+            self._writer = threading.Thread(target=self._run_writer,
+                                            args=(interval,),
+                                            name='wren-writer',
+                                            daemon=True)
+            self._writer.start()
+
+    def stop_writer(self):
+        """Stop the write-behind thread, writing anything still queued."""
+        writer = self._writer
+        if writer is None:
+            return
+        self._writer_stop.set()
+        writer.join()
+        with self._lock:
+            self._writer = None
+            self._flush_pending()
+
+    def close(self):
+        """Stop the write-behind thread and close the files."""
+        self.stop_writer()
+        with self._lock:
+            self.kvs.close()
+            self.conn.close()
+
+    def _run_writer(self, interval):
+        while not self._writer_stop.wait(interval):
+            self.flush()
+
+    def flush(self):
+        """Write everything queued for the write-behind thread now."""
+        with self._lock:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        for cmd, params in pending.values():
+            self._execute(cmd, params)
+        self._commit()
+
     def get(self, key):
-        cmd = 'SELECT kind, value FROM kvs WHERE key=?'
-        result = self.conn.execute(cmd, (key,)).fetchone()
+        with self._lock:
+            self._flush_pending()
+            result = self.kvs.get(key)
         if result is None:
             raise NotFound
         return result
 
+    def get_many(self, keys):
+        """Get a map of key to (kind, value), keys not found are left out."""
+        with self._lock:
+            self._flush_pending()
+            return self.kvs.get_many(keys)
+
     def write(self, key, kind, value):
-        cmd = 'REPLACE INTO kvs (key, kind, value) VALUES (?, ?, ?)'
-        self.conn.execute(cmd, (key, kind, value))
-        self.conn.commit()
+        self._write(('kvs', key), self.kvs.write, (key, kind, value))
+
+    def _write_datum_row(self, key, name, data, kind, last_changed):
+        # An update, or an insert if there is no row. Not a REPLACE, so the
+        # row keeps its id and the datums_text triggers see an update, and
+        # not an upsert, which needs sqlite 3.24.
+        cmd = """UPDATE datums SET name=?, data=?, kind=?, last_changed=?
+                 WHERE key=?"""
+        cursor = self.conn.execute(cmd, (name, data, kind, last_changed, key))
+        if cursor.rowcount == 0:
+            cmd = """INSERT INTO datums (key, name, data, kind, last_changed)
+                     VALUES (?, ?, ?, ?, ?)"""
+            self.conn.execute(cmd, (key, name, data, kind, last_changed))
+
+    def write_datum(self, key, name, data, kind, last_changed):
+        """last_changed is in unix_time() units"""
+        self._write(('datums', key), self._write_datum_row,
+                    (key, name, data, kind, last_changed))
+
+    def get_datums_by_last_changed(self, kind, grid_key=None, limit=None,
+                                   reverse=False):
+        """Get a list of the keys of the Datums of a kind, least recently
+        changed first, or most recently if reverse is True.
+
+        If grid_key is given only the Grid's active datums are listed. Ties
+        keep the order the active datums were added in.
+
+        """
+        order = 'DESC' if reverse else 'ASC'
+        if grid_key is None:
+            cmd = """SELECT key FROM datums WHERE kind=?
+                     ORDER BY last_changed {0}, id {0} LIMIT ?"""
+            params = [kind]
+        else:
+            cmd = """SELECT a.datum_key FROM active_datums a
+                         JOIN datums d ON d.key=a.datum_key
+                     WHERE a.grid_key=? AND d.kind=?
+                     ORDER BY d.last_changed {0}, a.rowid {0} LIMIT ?"""
+            params = [grid_key, kind]
+        if limit is None:
+            limit = -1  # No limit
+        with self._lock:
+            self._flush_pending()
+            return [row[0] for row in self.conn.execute(
+                cmd.format(order), params + [limit])]
+
+    def search_datums(self, text, limit=None):
+        """Get a list of the keys of the Datums matching text, best first.
+
+        Every word of text has to match the start of a word in the Datum's
+        name or data. Datums whose data is exactly text come first.
+
+        """
+        words = text.split()
+        if not words:
+            return []
+        if limit is None:
+            limit = -1  # No limit
+        if self.has_text_index:
+            # Each word is a quoted prefix query, "word"*
+            query = ' '.join('"{}"*'.format(word.replace('"', '""'))
+                             for word in words)
+            cmd = """SELECT d.key FROM datums_text t
+                         JOIN datums d ON d.id=t.rowid
+                     WHERE datums_text MATCH ?
+                     ORDER BY d.data=? DESC, t.rank LIMIT ?"""
+            params = [query, text, limit]
+        else:
+            # Slower, and it matches anywhere in a word.
+            cmd = """SELECT key FROM datums WHERE {}
+                     ORDER BY data=? DESC LIMIT ?""".format(' AND '.join(
+                "(name LIKE ? ESCAPE '!' OR data LIKE ? ESCAPE '!')"
+                for _ in words))
+            params = []
+            for word in words:
+                pattern = '%{}%'.format(word.replace('!', '!!')
+                                        .replace('%', '!%')
+                                        .replace('_', '!_'))
+                params += [pattern, pattern]
+            params += [text, limit]
+        with self._lock:
+            self._flush_pending()
+            return [row[0] for row in self.conn.execute(cmd, params)]
+
+    def get_datum_key(self, name):
+        """Get the key of a Datum with the given name, None if there is none"""
+        cmd = 'SELECT key FROM datums WHERE name=? LIMIT 1'
+        with self._lock:
+            self._flush_pending()
+            result = self.conn.execute(cmd, (name,)).fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    def get_clips(self, grid_key):
+        """Iterate the Clip rows of a Grid.
+
+        Rows are (clip_key, datum_key, x, y, edit_cursor_position). They are
+        all read before the first is yielded, so the lock is not held while
+        the caller iterates.
+
+        """
+        cmd = """SELECT clip_key, datum_key, x, y, edit_cursor_position
+                 FROM clips WHERE grid_key=?"""
+        with self._lock:
+            self._flush_pending()
+            rows = self.conn.execute(cmd, (grid_key,)).fetchall()
+        yield from rows
+
+    def get_clip(self, grid_key, clip_key):
+        """Get a Clip row by its key, None if there is none"""
+        cmd = """SELECT clip_key, datum_key, x, y, edit_cursor_position
+                 FROM clips WHERE grid_key=? AND clip_key=?"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key, clip_key)).fetchone()
+
+    def get_clips_by_key(self, clip_keys):
+        """Get the Clip rows with the given keys, from any Grid.
+
+        Rows are (grid_key, clip_key, datum_key, x, y, edit_cursor_position),
+        keys not found are left out.
+
+        """
+        # Keep the query under sqlite's limit on the number of variables.
+        chunk_size = 500
+        clip_keys = list(clip_keys)
+        rows = []
+        with self._lock:
+            self._flush_pending()
+            for i in range(0, len(clip_keys), chunk_size):
+                chunk = clip_keys[i:i + chunk_size]
+                cmd = """SELECT grid_key, clip_key, datum_key, x, y,
+                              edit_cursor_position
+                         FROM clips WHERE clip_key IN ({})""".format(
+                    ', '.join('?' * len(chunk)))
+                rows += self.conn.execute(cmd, chunk).fetchall()
+        return rows
+
+    def get_clip_keys(self, grid_key):
+        cmd = 'SELECT clip_key FROM clips WHERE grid_key=?'
+        with self._lock:
+            self._flush_pending()
+            return [row[0] for row in self.conn.execute(cmd, (grid_key,))]
+
+    def count_clips(self, grid_key):
+        cmd = 'SELECT count(*) FROM clips WHERE grid_key=?'
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key,)).fetchone()[0]
+
+    def get_clip_at(self, grid_key, x, y):
+        """Get the Clip row at the given coordinates, None if there is none"""
+        cmd = """SELECT clip_key, datum_key, x, y, edit_cursor_position
+                 FROM clips WHERE grid_key=? AND x=? AND y=?"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key, x, y)).fetchone()
+
+    def get_clips_in(self, grid_key, min_x, max_x, min_y, max_y):
+        """Get the Clip rows in the given rectangle, bounds inclusive"""
+        cmd = """SELECT clip_key, datum_key, x, y, edit_cursor_position
+                 FROM clips WHERE grid_key=? AND x BETWEEN ? AND ?
+                     AND y BETWEEN ? AND ?"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(
+                cmd, (grid_key, min_x, max_x, min_y, max_y)).fetchall()
+
+    def get_column_bounds(self, grid_key, x=None):
+        """Get a map of column x to its (lowest y, highest y).
+
+        Only the given column if x is given, columns without Clips are left
+        out.
+
+        """
+        cmd = 'SELECT x, min(y), max(y) FROM clips WHERE grid_key=?'
+        params = [grid_key]
+        if x is not None:
+            cmd += ' AND x=?'
+            params.append(x)
+        cmd += ' GROUP BY x'
+        with self._lock:
+            self._flush_pending()
+            return {row[0]: (row[1], row[2])
+                    for row in self.conn.execute(cmd, params)}
+
+    def find_clips(self, grid_key, datum_key):
+        """Get the Clip rows of a Datum"""
+        cmd = """SELECT clip_key, datum_key, x, y, edit_cursor_position
+                 FROM clips WHERE grid_key=? AND datum_key=?"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key, datum_key)).fetchall()
+
+    def _write_now(self, cmd, params):
+        """Execute a write after anything queued, it is never queued."""
+        with self._lock:
+            self._flush_pending()
+            self.conn.execute(cmd, params)
+            self._commit()
+
+    def shift_clips(self, grid_key, delta_x, min_x, max_x):
+        """Move the Clips in columns min_x to max_x over by delta_x"""
+        cmd = """UPDATE clips SET x=x+?
+                 WHERE grid_key=? AND x BETWEEN ? AND ?"""
+        self._write_now(cmd, (delta_x, grid_key, min_x, max_x))
+
+    def delete_column(self, grid_key, x):
+        cmd = 'DELETE FROM clips WHERE grid_key=? AND x=?'
+        self._write_now(cmd, (grid_key, x))
+
+    def write_clip(self, grid_key, clip_key, datum_key, x, y,
+                   edit_cursor_position):
+        cmd = """REPLACE INTO clips (grid_key, clip_key, datum_key, x, y,
+                                     edit_cursor_position)
+                 VALUES (?, ?, ?, ?, ?, ?)"""
+        self._write(('clips', grid_key, clip_key), cmd,
+                    (grid_key, clip_key, datum_key, x, y,
+                     edit_cursor_position))
+
+    def delete_clip(self, grid_key, clip_key):
+        cmd = 'DELETE FROM clips WHERE grid_key=? AND clip_key=?'
+        self._write(('clips', grid_key, clip_key), cmd, (grid_key, clip_key))
+
+    def get_relationships(self, grid_key):
+        """Get a Grid's relationships as a map of a_key to b_key to value"""
+        cmd = 'SELECT a_key, b_key, value FROM relationships WHERE grid_key=?'
+        relationships = {}
+        with self._lock:
+            self._flush_pending()
+            for a_key, b_key, value in self.conn.execute(cmd, (grid_key,)):
+                relationships.setdefault(a_key, {})[b_key] = value
+        return relationships
+
+    def write_relationship(self, grid_key, a_key, b_key, value):
+        cmd = """REPLACE INTO relationships (grid_key, a_key, b_key, value,
+                                             score)
+                 VALUES (?, ?, ?, ?, ?)"""
+        self._write(('relationships', grid_key, a_key, b_key), cmd,
+                    (grid_key, a_key, b_key, value, to_score(value)))
+
+    def get_scores_given(self, grid_key, b_key):
+        """Get a list of (a_key, score) given b_key, highest score first"""
+        cmd = """SELECT a_key, score FROM relationships
+                 WHERE grid_key=? AND b_key=? AND score IS NOT NULL
+                 ORDER BY score DESC"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key, b_key)).fetchall()
+
+    def get_top_scores(self, grid_key, a_key, k=None):
+        """Get a list of the k highest (b_key, score) for a_key, or all of
+        them if k is None, highest first"""
+        cmd = """SELECT b_key, score FROM relationships
+                 WHERE grid_key=? AND a_key=? AND score IS NOT NULL
+                 ORDER BY score DESC LIMIT ?"""
+        if k is None:
+            k = -1  # No limit
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key, a_key, k)).fetchall()
+
+    def get_active_self_scores(self, grid_key):
+        """Get a list of (datum_key, score) for active datums scored given
+        themselves, highest score first"""
+        cmd = """SELECT r.a_key, r.score
+                 FROM relationships r JOIN active_datums d
+                     ON d.grid_key=r.grid_key AND d.datum_key=r.a_key
+                 WHERE r.grid_key=? AND r.a_key=r.b_key
+                     AND r.score IS NOT NULL
+                 ORDER BY r.score DESC, r.a_key DESC"""
+        with self._lock:
+            self._flush_pending()
+            return self.conn.execute(cmd, (grid_key,)).fetchall()
+
+    def get_active_datums(self, grid_key):
+        """Get a list of a Grid's active datum keys, in the order added"""
+        cmd = """SELECT datum_key FROM active_datums WHERE grid_key=?
+                 ORDER BY rowid"""
+        with self._lock:
+            self._flush_pending()
+            return [row[0] for row in self.conn.execute(cmd, (grid_key,))]
+
+    def add_active_datum(self, grid_key, datum_key):
+        # A REPLACE gives it a new rowid, so it is last like in the Grid's
+        # list, even when a remove before it was queued over.
+        cmd = """REPLACE INTO active_datums (grid_key, datum_key)
+                 VALUES (?, ?)"""
+        self._write(('active_datums', grid_key, datum_key), cmd,
+                    (grid_key, datum_key))
+
+    def remove_active_datum(self, grid_key, datum_key):
+        cmd = 'DELETE FROM active_datums WHERE grid_key=? AND datum_key=?'
+        self._write(('active_datums', grid_key, datum_key), cmd,
+                    (grid_key, datum_key))
 
 
 class WrenModel:
@@ -111,10 +770,34 @@ class WrenModel:
 
     @staticmethod
     def load(key):
-        kind, serialized_value = get_storage().get(key)
+        try:
+            kind, serialized_value = get_storage().get(key)
+        except NotFound:
+            # Clips are not in kvs, they are rows of the clips table.
+            clip_model = ClipModel.load_many([key]).get(key)
+            if clip_model is None:
+                raise
+            return clip_model
         cls = eval(kind)
         return cls.deserialize(key, serialized_value)
 
+    @staticmethod
+    def load_many(keys):
+        """Load a map of key to Model, keys not found are left out."""
+        classes = {}  # kind to class
+        models = {}
+        for key, (kind, serialized_value) in get_storage().get_many(
+                keys).items():
+            cls = classes.get(kind)
+            if cls is None:
+                cls = eval(kind)
+                classes[kind] = cls
+            models[key] = cls.deserialize(key, serialized_value)
+        missing = [key for key in keys if key not in models]
+        if missing:
+            models.update(ClipModel.load_many(missing))
+        return models
+
     def serialize(self):
         raise NotImplementedError
 
@@ -169,9 +852,10 @@ class CursorModel(WrenModel):
 
 class ClipModel(WrenModel):
     """Key to a datum, x pos and y pos"""
-    # Note this is internal to GridModel, as there is no Clip without a grid
+    # Note this belongs to a GridModel, as there is no Clip without a grid
     # that it is in, and they have exclusive position within that grid. They
-    # may not be present in more than one grid.
+    # may not be present in more than one grid. Each Clip is its own row in
+    # the clips table, keyed by (grid_key, clip_key).
     def __init__(self, grid_key, datum_key, absolute_x, absolute_y,
                  edit_cursor_position, key=None):
         super().__init__(key=key)
@@ -180,14 +864,45 @@ class ClipModel(WrenModel):
         self.x = absolute_x
         self.y = absolute_y
         self.edit_cursor_position = edit_cursor_position
+        # Set when its row is deleted, so saving it does not put it back.
+        self.deleted = False
 
     def save(self):
-        """Clips save to their parent grid"""
+        """Clips save to their own row, via their parent grid"""
+        if self.deleted:
+            return
         parent_model = get_model(self.grid_key)
         parent_model.save_clip(self)
 
+    @staticmethod
+    def from_row(grid_key, row):
+        """The ClipModel for a row from the clips table.
+
+        If the ClipModel is already loaded it is brought up to date with the
+        row, which may have been moved since.
+
+        """
+        clip_key, datum_key, x, y, edit_cursor_position = row
+        clip_model = get_model_id_map().get(clip_key)
+        if clip_model is None:
+            clip_model = ClipModel(grid_key, datum_key, x, y,
+                                   edit_cursor_position, key=clip_key)
+        else:
+            clip_model.x = x
+            clip_model.y = y
+            clip_model.edit_cursor_position = edit_cursor_position
+        return clip_model
+
+    @staticmethod
+    def load_many(keys):
+        """Load a map of key to ClipModel from the clips table, keys not
+        found are left out."""
+        return {row[1]: ClipModel.from_row(row[0], row[1:])
+                for row in get_storage().get_clips_by_key(keys)}
+
     @staticmethod
     def deserialize(serialized_value):
+        # Only used to read Clips stored inline by older GridModels.
         key, grid_key, datum_key, x, y, edit_cursor_position = json.loads(
             serialized_value)
         return ClipModel(grid_key, datum_key, x, y, edit_cursor_position,
@@ -198,17 +913,48 @@ class ClipModel(WrenModel):
                            self.x, self.y, self.edit_cursor_position])
 
 
+class GridClipModels(Mapping):
+    """Map of clip key to ClipModel for a Grid, read from storage as used.
+
+    Nothing is loaded up front, so a big grid costs nothing until its Clips
+    are looked at. See also Grid.coordinates_to_clip.
+
+    """
+    def __init__(self, grid_key):
+        self.grid_key = grid_key
+
+    def __getitem__(self, clip_key):
+        row = get_storage().get_clip(self.grid_key, clip_key)
+        if row is None:
+            raise KeyError(clip_key)
+        return ClipModel.from_row(self.grid_key, row)
+
+    def __iter__(self):
+        return iter(get_storage().get_clip_keys(self.grid_key))
+
+    def __len__(self):
+        return get_storage().count_clips(self.grid_key)
+
+
 class GridModel(WrenModel):
     """Model for a grid of individual datums"""
-    # Note this is implemented as if the entire grid is just a single row
-    # in the database. We may want something a little bit more integrated with
-    # the database for queries, but this is good for now.
-    def __init__(self, key=None, clip_models=(), cursor_models=None,
-                 relationships=None, x_offset=None, y_offset=None,
+    # Note the grid itself is a single row in the kvs table holding the
+    # offsets, cursors and clipboard. Its Clips, relationships and active
+    # datums are rows in their own tables, each saved as it changes, so a
+    # small change is a small write.
+
+    # Grid rows are written with the binary encoding in codec.py, or 'json'
+    # for the older text format. Either format is read, and a row in the
+    # other format is rewritten the next time the grid is saved.
+    serialize_format = 'binary'
+
+    def __init__(self, key=None, cursor_models=None, relationships=None,
+                 x_offset=None, y_offset=None,
                  active_datums=None,
                  clipboard_datum_key=None):
         super().__init__(key=key)
-        self.clip_models = clip_models
+        # Map of clip key to ClipModel.
+        self.clip_models = GridClipModels(self.key)
         if cursor_models is None:
             cursor_models = {}
         if 'main' in cursor_models:
@@ -220,6 +966,8 @@ class GridModel(WrenModel):
         else:
             self.secondary_cursor_model = CursorModel(self.key, 2, 2,
                                                       'secondary')
+        # Map of a datum_key to b datum_key to value, use set_relationship()
+        # to change it.
         if relationships is None:
             relationships = {}
         self.relationships = relationships
@@ -230,77 +978,173 @@ class GridModel(WrenModel):
             y_offset = -2
         self.x_offset = x_offset
         self.y_offset = y_offset
+        # datum_keys, use add_active_datum() and remove_active_datum().
         if active_datums is None:
             active_datums = []
-        self.active_datums = active_datums  # datum_keys
+        self.active_datums = active_datums
         self.clipboard_datum_key = clipboard_datum_key
+        # The grid row as last saved or loaded, save() skips the write when
+        # it has not changed. None until then, and the first save writes
+        # the relationships and active datums too.
+        self._saved_value = None
 
     @staticmethod
     def deserialize(key, serialized_value):
-        s_clips, cursor_models, relationships, x_offset, y_offset,\
-            active_datums, clipboard_datum_key = json.loads(
-            serialized_value)
-        clip_models = [ClipModel.deserialize(c) for c in s_clips]
-        main_cursor_model = CursorModel.deserialize(cursor_models['main'])
-        secondary_cursor_model = CursorModel.deserialize(cursor_models[
-                                                             'secondary'])
-        return GridModel(key=key,
-                         clip_models=tuple(clip_models),
-                         cursor_models={
-                             'main': main_cursor_model,
-                             'secondary': secondary_cursor_model
-                         },
-                         relationships=relationships,
-                         x_offset=x_offset,
-                         y_offset=y_offset,
-                         active_datums=active_datums,
-                         clipboard_datum_key=clipboard_datum_key)
+        legacy_clip_models = []
+        if codec.is_encoded_grid(serialized_value):
+            fields = codec.decode_grid(serialized_value)
+            cursor_models = {}
+            for name in ('main', 'secondary'):
+                cursor_key, x, y = fields['{}_cursor'.format(name)]
+                cursor_models[name] = CursorModel(key, x, y, name,
+                                                  key=cursor_key)
+            legacy_relationships = {}
+            x_offset = fields['x_offset']
+            y_offset = fields['y_offset']
+            legacy_active_datums = []
+            clipboard_datum_key = fields['clipboard_datum_key']
+        else:
+            values = json.loads(serialized_value)
+            if len(values) == 7:
+                # Older grids stored every Clip inline, these move to the
+                # clips table below.
+                s_clips = values.pop(0)
+                legacy_clip_models = [ClipModel.deserialize(c)
+                                      for c in s_clips]
+            s_cursors, legacy_relationships, x_offset, y_offset,\
+                legacy_active_datums, clipboard_datum_key = values
+            cursor_models = {
+                name: CursorModel.deserialize(s_cursors[name])
+                for name in ('main', 'secondary')}
+        storage = get_storage()
+        grid_model = GridModel(key=key,
+                               cursor_models=cursor_models,
+                               relationships=storage.get_relationships(key),
+                               x_offset=x_offset,
+                               y_offset=y_offset,
+                               active_datums=storage.get_active_datums(key),
+                               clipboard_datum_key=clipboard_datum_key)
+        grid_model._saved_value = serialized_value
+        if legacy_clip_models or legacy_relationships or \
+                legacy_active_datums:
+            # Older grids stored these in the grid row, they move to their
+            # tables and the row is saved without them.
+            with storage.batch():
+                for clip_model in legacy_clip_models:
+                    grid_model.save_clip(clip_model)
+                for a_key, row in legacy_relationships.items():
+                    for b_key, value in row.items():
+                        grid_model.set_relationship(a_key, b_key, value)
+                for datum_key in legacy_active_datums:
+                    grid_model.add_active_datum(datum_key)
+                grid_model.save()
+        return grid_model
 
     def serialize(self):
-        return json.dumps([[c_m.serialize() for c_m in self.clip_models],
-                           {
+        if self.serialize_format == 'json':
+            return self.serialize_json()
+        main = self.main_cursor_model
+        secondary = self.secondary_cursor_model
+        return codec.encode_grid(self.x_offset, self.y_offset,
+                                 (main.key, main.x, main.y),
+                                 (secondary.key, secondary.x, secondary.y),
+                                 self.clipboard_datum_key)
+
+    def serialize_json(self):
+        """The older json grid row. Its relationships and active datums are
+        left empty, they are in their own tables."""
+        return json.dumps([{
                                'main': self.main_cursor_model.serialize(),
                                'secondary':
-                                   self.secondary_cursor_model.serialize()
+                                   self.secondary_cursor_model.serialize(),
                            },
-                           self.relationships,
-                           self.x_offset, self.y_offset,
-                           self.active_datums,
+                           {},
+                           self.x_offset,
+                           self.y_offset,
+                           [],
                            self.clipboard_datum_key])
 
+    def save(self):
+        """Save the grid row, if it changed since it was saved or loaded.
+
+        Clips, relationships and active datums save as they change, see
+        save_clip(), set_relationship() and add_active_datum().
+
+        """
+        value = self.serialize()
+        if value == self._saved_value:
+            return
+        storage = get_storage()
+        if self._saved_value is None:
+            # The first save writes the relationships and active datums
+            # too, in one transaction.
+            with storage.batch():
+                for a_key, row in self.relationships.items():
+                    for b_key, b_value in row.items():
+                        storage.write_relationship(self.key, a_key, b_key,
+                                                   b_value)
+                for datum_key in self.active_datums:
+                    storage.add_active_datum(self.key, datum_key)
+                storage.write(self.key, type(self).__name__, value)
+        else:
+            # Not in a batch, so the write-behind thread can queue it.
+            storage.write(self.key, type(self).__name__, value)
+        self._saved_value = value
+
+    def reload(self):
+        """Read the relationships, active datums and grid row from storage
+        again, ex. after a batch was rolled back. The cursors and offsets
+        are kept, the next save() writes them if they differ."""
+        storage = get_storage()
+        self.relationships = storage.get_relationships(self.key)
+        self.active_datums = storage.get_active_datums(self.key)
+        try:
+            self._saved_value = storage.get(self.key)[1]
+        except NotFound:
+            self._saved_value = None
+
+    def set_relationship(self, a_key, b_key, value):
+        """Set the value of a given b and save just that cell."""
+        self.relationships.setdefault(a_key, {})[b_key] = value
+        get_storage().write_relationship(self.key, a_key, b_key, value)
+
+    def scores_given(self, b_key):
+        """List of (a_key, score) given b_key, highest score first"""
+        return get_storage().get_scores_given(self.key, b_key)
+
+    def top_scores(self, a_key, k=None):
+        """List of the k highest (b_key, score) for a_key, highest first"""
+        return get_storage().get_top_scores(self.key, a_key, k)
+
+    def active_self_scores(self):
+        """List of (datum_key, score) for active datums given themselves"""
+        return get_storage().get_active_self_scores(self.key)
+
+    def active_datums_by_last_changed(self):
+        """List of the active datum keys, least recently changed first"""
+        return get_storage().get_datums_by_last_changed(
+            DatumModel.__name__, grid_key=self.key)
+
+    def add_active_datum(self, datum_key):
+        self.active_datums.append(datum_key)
+        get_storage().add_active_datum(self.key, datum_key)
+
+    def remove_active_datum(self, datum_key):
+        self.active_datums.remove(datum_key)
+        get_storage().remove_active_datum(self.key, datum_key)
+
     def save_clip(self, clip_model):
+        """Save just the given Clip's row, the grid row is not rewritten."""
         assert isinstance(clip_model, ClipModel)
-        # remove existing data on this clip if it exists
-        index = None
-        for i, existing_clip_model in enumerate(self.clip_models):
-            if existing_clip_model.key == clip_model.key:
-                index = i
-                break
-        if index is not None:
-            assert isinstance(self.clip_models, tuple)
-            self.clip_models = self.clip_models[:index] + self.clip_models[
-                index + 1:]
-            # Same as: del self.clip_models[index] would be on a list.
-        # Add this clip to the model and save.
-        self.clip_models = self.clip_models + (clip_model,)
-        self.save()
+        get_storage().write_clip(self.key, clip_model.key,
+                                 clip_model.datum_key,
+                                 clip_model.x, clip_model.y,
+                                 clip_model.edit_cursor_position)
 
     def delete_clip(self, clip_model):
         assert isinstance(clip_model, ClipModel)
-        # remove existing data on this clip if it exists
-        index = None
-        for i, existing_clip_model in enumerate(self.clip_models):
-            if existing_clip_model.key == clip_model.key:
-                index = i
-                break
-        if index is not None:
-            assert isinstance(self.clip_models, tuple)
-            self.clip_models = self.clip_models[:index] + self.clip_models[
-                index + 1:]
-            # Same as: del self.clip_models[index] would be on a list.
-        # Don't add this clip to the model and save.
-        # self.clip_models = self.clip_models + (clip_model,)
-        self.save()
+        clip_model.deleted = True
+        get_storage().delete_clip(self.key, clip_model.key)
 
 
 class DatumModel(WrenModel):
@@ -318,6 +1162,16 @@ class DatumModel(WrenModel):
         self.last_changed = last_changed
         self.parent = parent
 
+    def save(self):
+        """Datums also save their name to the datums index, in the same
+        transaction."""
+        storage = get_storage()
+        with storage.batch():
+            super().save()
+            storage.write_datum(self.key, self.name, self.data,
+                                type(self).__name__,
+                                unix_time(self.last_changed))
+
     def serialize(self):
         return json.dumps([self.data, self.name,
                            unix_time(self.last_changed),
@@ -331,15 +1185,34 @@ class DatumModel(WrenModel):
                    parent=parent)
 
 
+def _reload_models():
+    """Bring the loaded GridModels and ClipModels back in step with
+    storage, after a batch was rolled back."""
+    models = get_model_id_map().values()
+    clip_models = [m for m in models if isinstance(m, ClipModel)]
+    rows = {row[1]: row for row in get_storage().get_clips_by_key(
+        [clip_model.key for clip_model in clip_models])}
+    for clip_model in clip_models:
+        row = rows.get(clip_model.key)
+        if row is None:
+            # Its row was rolled back.
+            clip_model.deleted = True
+        else:
+            ClipModel.from_row(row[0], row[1:])
+    for grid_model in models:
+        if isinstance(grid_model, GridModel):
+            grid_model.reload()
+on_rollback(_reload_models)
+
+
 def get_datum_by_name(name):
-    # A hack, we look up a Text, which descends from Datum.
-    kind = DatumModel.__name__
-    cmd = 'SELECT key, value FROM kvs WHERE kind=?'
-    #cmd = 'SELECT key, kind, value FROM kvs'
-    for key, value in get_storage().conn.execute(cmd, (kind,)).fetchall():
-    #for key, kind, value in get_storage().conn.execute(cmd).fetchall():
-        datum_model = DatumModel.deserialize(key, value)
-        if datum_model.name == name:
-            return datum_model
-    return None
+    """Get the DatumModel with the given name, None if there is none"""
+    key = get_storage().get_datum_key(name)
+    if key is None:
+        return None
+    return get_model(key)
+
+
+def datum_name_exists(name):
+    return get_storage().get_datum_key(name) is not None
 
@@ -7,12 +7,11 @@
 #
 
 import numpy as np
-from numpy.random import choice, randint
+from numpy.random import randint, random_sample
 import torch as th
 from torch import nn
 from torch.autograd import Function, Variable
 from torch.utils.data import Dataset
-from collections import defaultdict as ddict
 
 eps = 1e-5
 
@@ -128,11 +127,51 @@ class SNEmbedding(Embedding):
         return lossfn(preds, targets)
 
 
+class AliasSampler:
+    """Draws from a discrete distribution by Walker's alias method, O(1) a
+    draw and two arrays as long as the distribution.
+
+        sampler = AliasSampler(weights)
+        samples = sampler.draw(1000000)
+
+    A draw picks a bucket i uniformly, then i itself with prob[i] and
+    alias[i] otherwise. The buckets are filled by Vose's method, each small
+    one topped up from a large one.
+
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        # As lists, the loop is over plain floats and not numpy scalars.
+        scaled = (weights * (n / weights.sum())).tolist()
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, q in enumerate(scaled) if q < 1]
+        large = [i for i, q in enumerate(scaled) if q >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        # What is left is full but for rounding, prob 1.
+        self.prob = np.array(prob)
+        self.alias = np.array(alias, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, size):
+        """Array of size draws, size an int or a shape"""
+        i = randint(0, len(self.prob), size=size)
+        return np.where(random_sample(size) < self.prob[i], i, self.alias[i])
+
+
 class GraphDataset(Dataset):
     _ntries = 10
     _dampening = 0.75
 
-    def __init__(self, idx, objects, nnegs, unigram_size=1e8):
+    def __init__(self, idx, objects, nnegs):
         print('Indexing data')
         self.idx = idx
         self.nnegs = nnegs
@@ -140,23 +179,50 @@ class GraphDataset(Dataset):
         self.objects = objects
         self.max_tries = self.nnegs * self._ntries
 
-        self._weights = ddict(lambda: ddict(int))
-        self._counts = np.ones(len(objects), dtype=np.float)
-        for i in range(idx.size(0)):
-            t, h, w = self.idx[i]
-            self._counts[h] += w
-            self._weights[t][h] += w
-        self._weights = dict(self._weights)
-        nents = int(np.array(list(self._weights.keys())).max() + 1)
+        edges = idx.numpy()
+        nents = int(edges[:, 0].max()) + 1
         assert len(objects) == nents, 'Number of objects do no match'
-
-        if unigram_size > 0:
-            c = self._counts ** self._dampening
-            self.unigram_table = choice(
-                len(objects),
-                size=int(unigram_size),
-                p=(c / c.sum())
-            )
+        # Weight of the edges into each object, plus one so every object can
+        # be drawn in burnin.
+        self._counts = 1 + np.bincount(edges[:, 1], weights=edges[:, 2],
+                                       minlength=nents)
+        self._edge_keys, self._indptr, self._heads, self._weights = \
+            self._adjacency(edges, nents)
+
+        # Negatives by their damped frequency, in burnin
+        self.unigram = AliasSampler(self._counts ** self._dampening)
+
+    @staticmethod
+    def _adjacency(edges, nents):
+        """(keys, indptr, heads, weights) of the edges as sorted CSR.
+
+        The heads of tail t are heads[indptr[t]:indptr[t + 1]], ascending,
+        weights the sums of the weights of their edges, and keys the edges
+        as sorted t * nents + h, see has_edges.
+
+        """
+        keys, inverse = np.unique(edges[:, 0] * nents + edges[:, 1],
+                                  return_inverse=True)
+        weights = np.zeros(len(keys), dtype=edges.dtype)
+        np.add.at(weights, inverse.ravel(), edges[:, 2])
+        tails, heads = np.divmod(keys, nents)
+        indptr = np.searchsorted(tails, np.arange(nents + 1))
+        return keys, indptr, heads, weights
+
+    def neighbours(self, t):
+        """(heads, weights) of the edges from t, heads ascending"""
+        span = slice(self._indptr[t], self._indptr[t + 1])
+        return self._heads[span], self._weights[span]
+
+    def has_edges(self, tails, heads):
+        """Array of whether there is an edge from each of tails to the head
+        with its index, by binary search"""
+        keys = np.asarray(tails) * len(self.objects) + np.asarray(heads)
+        if not len(self._edge_keys):
+            return np.zeros(keys.shape, dtype=bool)
+        pos = np.searchsorted(self._edge_keys, keys)
+        pos = np.minimum(pos, len(self._edge_keys) - 1)
+        return self._edge_keys[pos] == keys
 
     def __len__(self):
         return self.idx.size(0)
@@ -171,24 +237,74 @@ class SNGraphDataset(GraphDataset):
     model_name = '%s_%s_dim%d'
 
     def __getitem__(self, i):
-        t, h, _ = self.idx[i]
-        negs = set()
-        ntries = 0
-        while ntries < self.max_tries and len(negs) < self.nnegs:
-            if self.burnin:
-                n = randint(0, len(self.unigram_table))
-                n = int(self.unigram_table[n])
-            else:
-                n = randint(0, len(self.objects))
-            if n not in self._weights[t]:
-                negs.add(n)
-            ntries += 1
-        if len(negs) == 0:
-            negs.add(t)
-        ix = [t, h] + list(negs)
-        while len(ix) < self.nnegs + 2:
-            ix.append(ix[randint(2, len(ix))])
-        return th.LongTensor(ix).view(1, len(ix)), th.zeros(1).long()
+        return self.sample([i])
+
+    def _draw(self, shape):
+        """Array of candidate negatives, by damped frequency in burnin"""
+        if self.burnin:
+            return self.unigram.draw(shape)
+        return randint(0, len(self.objects), size=shape)
+
+    def _negatives(self, tails, candidates):
+        """(negs, counts) of the first nnegs distinct candidates of each row
+        that are not heads of its tail, negs padded past counts"""
+        nrows, ntries = candidates.shape
+        ok = ~self.has_edges(np.repeat(tails, ntries),
+                             candidates.ravel()).reshape(nrows, ntries)
+        # Only the first of a candidate drawn twice for a row.
+        keys = np.arange(nrows)[:, None] * len(self.objects) + candidates
+        first = np.zeros(nrows * ntries, dtype=bool)
+        first[np.unique(keys.ravel(), return_index=True)[1]] = True
+        ok &= first.reshape(nrows, ntries)
+        rank = np.cumsum(ok, axis=1)
+        ok &= rank <= self.nnegs
+        rows, cols = np.nonzero(ok)
+        negs = np.zeros((nrows, self.nnegs), dtype=np.int64)
+        negs[rows, rank[rows, cols] - 1] = candidates[rows, cols]
+        return negs, ok.sum(axis=1)
+
+    def sample(self, indices):
+        """The inputs and targets of a minibatch of the edges at indices.
+
+        Each row of inputs is [t, h, negs...], nnegs negatives of t drawn as
+        for one edge: up to max_tries candidates, kept when they are not
+        heads of t and not drawn before, and when there are fewer than
+        nnegs the rest are repeats of them (t when there are none).
+        It is all arrays, candidates for the whole minibatch at a time.
+
+        """
+        edges = self.idx.numpy()[np.asarray(indices, dtype=np.int64)]
+        tails = edges[:, 0]
+        # Most rows have enough after a few tries each, the rest get the
+        # rest of their tries.
+        ntries = min(2 * self.nnegs, self.max_tries)
+        candidates = self._draw((len(edges), ntries))
+        negs, counts = self._negatives(tails, candidates)
+        short = np.flatnonzero(counts < self.nnegs)
+        if len(short) and ntries < self.max_tries:
+            more = np.concatenate([
+                candidates[short],
+                self._draw((len(short), self.max_tries - ntries))], axis=1)
+            negs[short], counts[short] = self._negatives(tails[short], more)
+        none = counts == 0
+        negs[none, 0] = tails[none]
+        counts[none] = 1
+        # Padding, each a random one of the row's negatives.
+        picks = (np.random.random_sample(negs.shape) *
+                 counts[:, None]).astype(np.int64)
+        padded = negs[np.arange(len(negs))[:, None], picks]
+        negs = np.where(np.arange(self.nnegs) < counts[:, None], negs,
+                        padded)
+        ix = np.concatenate([edges[:, :2], negs], axis=1)
+        return th.from_numpy(ix), th.zeros(len(ix)).long()
+
+    def batches(self, indices, batch_size):
+        """Yield (inputs, targets) of minibatches of the edges at indices,
+        in a random order"""
+        indices = np.random.permutation(np.asarray(indices, dtype=np.int64))
+        for start in range(0, len(indices), batch_size):
+            inputs, targets = self.sample(indices[start:start + batch_size])
+            yield Variable(inputs), Variable(targets)
 
     @classmethod
     def initialize(cls, distfn, opt, idx, objects, max_norm=1):
@@ -0,0 +1,57 @@
+"""Riemannian SGD, for training embeddings in the poincare ball.
+
+The gradient of the poincare distance is euclidean, scaling it by the
+inverse of the ball's metric tensor, (1 - |p|^2)^2 / 4, gives the
+riemannian gradient. The step is then taken as a euclidean one (the
+retraction), the Embedding's max_norm keeps the rows inside the ball.
+
+"""
+import torch as th
+from torch.optim.optimizer import Optimizer, required
+
+
+def poincare_grad(p, d_p):
+    """Riemannian gradient of d_p at p, d_p sparse or dense"""
+    if d_p.is_sparse:
+        indices = d_p._indices()
+        values = d_p._values()
+        p_sqnorm = th.sum(p.data[indices[0]] ** 2, dim=1, keepdim=True)
+        values = values * ((1 - p_sqnorm) ** 2 / 4).expand_as(values)
+        return th.sparse_coo_tensor(indices, values, d_p.size())
+    p_sqnorm = th.sum(p.data ** 2, dim=-1, keepdim=True)
+    return d_p * ((1 - p_sqnorm) ** 2 / 4).expand_as(d_p)
+
+
+def euclidean_grad(p, d_p):
+    return d_p
+
+
+def euclidean_retraction(p, d_p, lr):
+    p.data.add_(-lr, d_p)
+
+
+class RiemannianSGD(Optimizer):
+    """SGD with a gradient conversion and retraction per parameter group.
+
+        optimizer = RiemannianSGD(model.parameters(), lr=0.3,
+                                  rgrad=poincare_grad,
+                                  retraction=euclidean_retraction)
+
+    It takes no locks, so processes can step one model in shared memory at
+    once (Hogwild), see poincare.train.
+
+    """
+    def __init__(self, params, lr=required, rgrad=required,
+                 retraction=required):
+        defaults = dict(lr=lr, rgrad=rgrad, retraction=retraction)
+        super(RiemannianSGD, self).__init__(params, defaults)
+
+    def step(self, lr=None):
+        """Take a step, at lr if it is given and not the group's"""
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                d_p = group['rgrad'](p, p.grad.data)
+                group['retraction'](p, d_p,
+                                    group['lr'] if lr is None else lr)
@@ -0,0 +1,256 @@
+"""Train poincare embeddings of a graph, Hogwild.
+
+    python -m poincare.train mammal_closure.tsv mammals.pth -procs 4
+
+Worker processes share the embedding's weights in shared memory and each
+runs SGD on its own shard of the edges, stepping the weights without
+locks. A step only changes the rows of its batch, so steps seldom collide.
+
+The first -burnin epochs draw negatives by their damped frequency (see
+GraphDataset.burnin) at BURNIN_LR_MULTIPLIER times the learning rate, to
+place the rows roughly before the training proper.
+
+The checkpoint is written every -checkpoint_each epochs and at the end as
+{'model': state_dict, 'epoch': epoch, 'objects': objects}, which is what
+embedding.EmbeddingStore loads. With -init the rows of the terms another
+checkpoint has start from it, to extend an embedding with new edges.
+
+Each epoch logs the throughput, in edges per second per process. With
+-eval each checkpoint also logs how well the embedding reconstructs the
+edges, see reconstruction.
+
+"""
+import argparse
+import logging
+import os
+import timeit
+
+import numpy as np
+import torch as th
+import torch.multiprocessing as mp
+
+from poincare import model, rsgd
+from poincare.data import slurp
+
+log = logging.getLogger(__name__)
+
+BURNIN_LR_MULTIPLIER = 0.01
+
+# Map of -distfn to the distance and its riemannian gradient.
+DISTANCES = {
+    'poincare': (model.PoincareDistance, rsgd.poincare_grad),
+    'euclidean': (model.EuclideanDistance, rsgd.euclidean_grad),
+}
+
+
+def train(embedding, data, optimizer, opt, rank=0, report=None):
+    """Run opt.epochs epochs of SGD on shard rank of opt.procs of data.
+
+    After each epoch report is called with (rank, epoch, edges, seconds,
+    mean loss).
+
+    """
+    shard = np.arange(rank, len(data), opt.procs)
+    for epoch in range(opt.epochs):
+        data.burnin = epoch < opt.burnin
+        lr = opt.lr * BURNIN_LR_MULTIPLIER if data.burnin else opt.lr
+        losses = []
+        start = timeit.default_timer()
+        # Whole minibatches sampled at once, see SNGraphDataset.sample
+        for inputs, targets in data.batches(shard, opt.batchsize):
+            optimizer.zero_grad()
+            preds = embedding(inputs)
+            loss = embedding.loss(preds, targets, size_average=True)
+            loss.backward()
+            optimizer.step(lr=lr)
+            losses.append(loss.item())
+        if report is not None:
+            report((rank, epoch, len(shard), timeit.default_timer() - start,
+                    float(np.mean(losses)) if losses else 0.0))
+
+
+def _train_worker(embedding, data, optimizer, opt, rank, queue):
+    # Forked with the parent's random state, so each worker draws its own
+    # negatives, and one thread each as there is a process per core.
+    np.random.seed(opt.seed + rank)
+    th.manual_seed(opt.seed + rank)
+    th.set_num_threads(1)
+    try:
+        train(embedding, data, optimizer, opt, rank, queue.put)
+    except Exception:
+        log.exception('Training worker {} failed'.format(rank))
+        queue.put(None)
+
+
+def reconstruction(kernel, vectors, data):
+    """(mean rank, mean average precision) of the edges of data by the
+    distances of kernel, a distance.py kernel of vectors.
+
+    The heads of each tail t are ranked by their distance from it, each
+    among the objects that are not heads of t, as in the paper. One pass
+    over the rows per tail.
+
+    """
+    ranks, precisions = [], []
+    for t in range(len(data.objects)):
+        heads, _ = data.neighbours(t)
+        if not len(heads):
+            continue
+        dists = kernel.one_to_many(vectors[t])
+        others = np.ones(len(dists), dtype=bool)
+        others[heads] = False
+        others[t] = False
+        # The number of the others nearer than each head, nearest first.
+        nearer = np.searchsorted(np.sort(dists[others]),
+                                 np.sort(dists[heads]))
+        ranks.append(nearer + 1)
+        found = np.arange(1, len(heads) + 1)
+        precisions.append(np.mean(found / (found + nearer)))
+    if not ranks:
+        return 0.0, 0.0
+    return float(np.mean(np.concatenate(ranks))), float(np.mean(precisions))
+
+
+def save_checkpoint(embedding, objects, epoch, file_name):
+    """Write the checkpoint, under another name first so a reader never
+    sees half of one"""
+    with open(file_name + '.tmp', 'wb') as f:
+        th.save({'model': embedding.state_dict(), 'epoch': epoch,
+                 'objects': list(objects)}, f)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def load_init(embedding, objects, file_name):
+    """Start the rows of the terms in checkpoint file_name from it, returns
+    the number of them"""
+    serialization = th.load(file_name)
+    rows = dict(zip(serialization['objects'],
+                    serialization['model']['lt.weight']))
+    weight = embedding.lt.weight.data
+    found = 0
+    for i, term in enumerate(objects):
+        row = rows.get(term)
+        if row is not None and len(row) == weight.size(1):
+            weight[i] = row
+            found += 1
+    return found
+
+
+class Progress:
+    """Gathers the workers' reports, logging each epoch once every worker
+    has finished it and writing checkpoints."""
+    def __init__(self, embedding, data, opt):
+        self.embedding = embedding
+        self.data = data
+        self.opt = opt
+        self._reports = {}  # Map of epoch to its reports so far
+
+    def __call__(self, report):
+        epoch = report[1]
+        reports = self._reports.setdefault(epoch, [])
+        reports.append(report)
+        if len(reports) < self.opt.procs:
+            return
+        del self._reports[epoch]
+        edges = sum(r[2] for r in reports)
+        seconds = max(r[3] for r in reports)
+        per_core = np.mean([r[2] / r[3] for r in reports if r[3] > 0])
+        loss = np.mean([r[4] for r in reports])
+        log.info('epoch {} loss {:.6f} {:,} edges in {:.2f}s, {:,.0f} '
+                 'edges/s/core on {} processes{}'.format(
+                     epoch, loss, edges, seconds, per_core, self.opt.procs,
+                     ' (burnin)' if epoch < self.opt.burnin else ''))
+        if epoch == self.opt.epochs - 1 or \
+                (epoch + 1) % self.opt.checkpoint_each == 0:
+            save_checkpoint(self.embedding, self.data.objects, epoch,
+                            self.opt.fout)
+            if self.opt.eval:
+                self.evaluate(epoch)
+
+    def evaluate(self, epoch):
+        from distance import EuclideanDistance, PoincareDistance
+        kernel = {'poincare': PoincareDistance,
+                  'euclidean': EuclideanDistance}[self.opt.distfn]
+        vectors = self.embedding.embedding()
+        mean_rank, mean_ap = reconstruction(kernel(vectors), vectors,
+                                            self.data)
+        log.info('epoch {} mean rank {:.2f} mAP {:.4f}'.format(
+            epoch, mean_rank, mean_ap))
+
+
+def run(embedding, data, opt):
+    """Train embedding on data with opt.procs processes, Hogwild"""
+    distfn, rgrad = DISTANCES[opt.distfn]
+    optimizer = rsgd.RiemannianSGD(embedding.parameters(), lr=opt.lr,
+                                   rgrad=rgrad,
+                                   retraction=rsgd.euclidean_retraction)
+    progress = Progress(embedding, data, opt)
+    if opt.procs == 1:
+        train(embedding, data, optimizer, opt, 0, progress)
+        return
+    embedding.share_memory()
+    queue = mp.Queue()
+    workers = [mp.Process(target=_train_worker,
+                          args=(embedding, data, optimizer, opt, rank,
+                                queue))
+               for rank in range(opt.procs)]
+    for worker in workers:
+        worker.start()
+    try:
+        for _ in range(opt.epochs * opt.procs):
+            report = queue.get()
+            if report is None:
+                raise RuntimeError('A training worker failed')
+            progress(report)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Train poincare embeddings, Hogwild')
+    parser.add_argument('dset', help='tsv of the edges, see poincare.data')
+    parser.add_argument('fout', help='checkpoint to write')
+    parser.add_argument('-dim', type=int, default=5)
+    parser.add_argument('-distfn', default='poincare',
+                        choices=sorted(DISTANCES))
+    parser.add_argument('-lr', type=float, default=0.3)
+    parser.add_argument('-epochs', type=int, default=300)
+    parser.add_argument('-batchsize', type=int, default=10)
+    parser.add_argument('-negs', type=int, default=50)
+    parser.add_argument('-burnin', type=int, default=20)
+    parser.add_argument('-procs', type=int, default=os.cpu_count())
+    parser.add_argument('-checkpoint_each', type=int, default=10)
+    parser.add_argument('-sym', action='store_true',
+                        help='train on the edges both ways')
+    parser.add_argument('-init', help='checkpoint to start from')
+    parser.add_argument('-eval', action='store_true',
+                        help='log the mean rank and mAP at checkpoints')
+    parser.add_argument('-seed', type=int, default=0)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = parse_args(args)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(message)s')
+    np.random.seed(opt.seed)
+    th.manual_seed(opt.seed)
+    idx, objects = slurp(opt.dset, symmetrize=opt.sym)
+    distfn, _ = DISTANCES[opt.distfn]
+    embedding, data, _, _ = model.SNGraphDataset.initialize(
+        distfn, opt, idx, objects)
+    if opt.init:
+        log.info('{} of {} terms from {}'.format(
+            load_init(embedding, objects, opt.init), len(objects),
+            opt.init))
+    run(embedding, data, opt)
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,929 @@ class BaseTestCase(unittest.TestCase):
         self.assertEqual(key, grid_model_2.key)
         self.assertEqual(0, len(grid_model_2.clip_models))
 
+    def test_clip_saves_to_clip_table(self):
+        from model import ClipModel, DatumModel, GridModel, get_storage
+
+        grid_model = GridModel()
+        grid_model.save()
+        key = grid_model.key
+        datum_model = DatumModel('clip text')
+        datum_model.save()
+
+        clip_model = ClipModel(key, datum_model.key, 1, 2, 0)
+        clip_model.save()
+        clip_model.x = 3
+        clip_model.save()
+        rows = list(get_storage().get_clips(key))
+        self.assertEqual(
+            [(clip_model.key, datum_model.key, 3, 2, 0)], rows)
+        # The grid row does not hold its Clips.
+        _, value = get_storage().get(key)
+        self.assertNotIn(clip_model.key.encode(), value)
+
+        grid_model_2 = GridModel.load(key)
+        self.assertEqual(1, len(grid_model_2.clip_models))
+        clip_model_2 = grid_model_2.clip_models[clip_model.key]
+        self.assertEqual(datum_model.key, clip_model_2.datum_key)
+        self.assertEqual((3, 2), (clip_model_2.x, clip_model_2.y))
+
+        grid_model_2.delete_clip(clip_model_2)
+        self.assertEqual([], list(get_storage().get_clips(key)))
+
+    def test_storage_batch(self):
+        from model import NotFound, get_storage
+        storage = get_storage()
+
+        with storage.batch():
+            storage.write('outer', 'DatumModel', 'outer value')
+            with storage.batch():
+                storage.write('inner', 'DatumModel', 'inner value')
+            # The inner batch leaves the commit to the outer batch.
+            self.assertTrue(storage.conn.in_transaction)
+        self.assertFalse(storage.conn.in_transaction)
+        self.assertEqual(('DatumModel', 'inner value'), storage.get('inner'))
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                storage.write('rolled_back', 'DatumModel', 'value')
+                raise ValueError
+        with self.assertRaises(NotFound):
+            storage.get('rolled_back')
+
+        # A Datum's kvs row and datums row are saved together or not at all.
+        from model import DatumModel
+
+        def fail(*args):
+            raise ValueError
+        datum_model = DatumModel('text', name='half saved')
+        storage.write_datum = fail
+        try:
+            with self.assertRaises(ValueError):
+                datum_model.save()
+        finally:
+            del storage.write_datum
+        with self.assertRaises(NotFound):
+            storage.get(datum_model.key)
+
+    def test_storage_write_behind(self):
+        import threading
+        from model import get_storage
+        storage = get_storage()
+        # A long interval, so only the explicit flushes write.
+        storage.start_writer(interval=3600)
+        try:
+            changes = storage.conn.total_changes
+            for x in range(10):
+                storage.write('cursor', 'CursorModel', str(x))
+            self.assertEqual(changes, storage.conn.total_changes)
+            storage.flush()
+            self.assertEqual(changes + 1, storage.conn.total_changes)
+            self.assertEqual(('CursorModel', '9'), storage.get('cursor'))
+
+            # Reads see queued writes.
+            storage.write('cursor', 'CursorModel', 'last')
+            self.assertEqual(('CursorModel', 'last'), storage.get('cursor'))
+
+            # Queued writes are made in the order of the latest ones, so a
+            # datum removed and added again is last.
+            for datum_key in ['a', 'b']:
+                storage.add_active_datum('grid', datum_key)
+            storage.remove_active_datum('grid', 'a')
+            storage.add_active_datum('grid', 'a')
+            self.assertEqual(['b', 'a'], storage.get_active_datums('grid'))
+            # Also when the remove is queued over by the add.
+            storage.remove_active_datum('grid', 'b')
+            storage.add_active_datum('grid', 'b')
+            self.assertEqual(['a', 'b'], storage.get_active_datums('grid'))
+
+            # A read left part way through does not hold up the thread.
+            for y in range(2):
+                storage.write_clip('grid', 'clip_{}'.format(y), 'datum', 0,
+                                   y, 0)
+            clips = storage.get_clips('grid')
+            next(clips)
+            flusher = threading.Thread(target=storage.flush, daemon=True)
+            flusher.start()
+            flusher.join(5)
+            self.assertFalse(flusher.is_alive())
+        finally:
+            storage.stop_writer()
+
+    def test_storage_log_backend(self):
+        import os
+        import tempfile
+        from model import NotFound, WrenData
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'wren.db')
+            # Made with sqlite, its kvs rows are copied to the log.
+            storage = WrenData.initialize(file_name=file_name)
+            storage.write('moved', 'DatumModel', '["moved", "a", 0, null]')
+            storage.close()
+            storage = WrenData.initialize(file_name=file_name,
+                                          backend='log')
+            self.assertEqual('DatumModel', storage.get('moved')[0])
+            storage.close()
+            # And left in the table, so the file still opens with sqlite,
+            # with a warning that the log is newer.
+            with self.assertLogs('wren', 'WARNING'):
+                storage = WrenData.initialize(file_name=file_name,
+                                              backend='sqlite')
+            self.assertEqual('DatumModel', storage.get('moved')[0])
+            storage.close()
+            storage = WrenData.initialize(file_name=file_name,
+                                          backend='log')
+
+            storage.write('text', 'CursorModel', 'text value')
+            storage.write('bytes', 'GridModel', b'WRG\0')
+            with self.assertRaises(ValueError):
+                with storage.batch():
+                    storage.write('rolled_back', 'CursorModel', 'value')
+                    raise ValueError
+            with self.assertRaises(NotFound):
+                storage.get('rolled_back')
+            storage.close()
+
+            # Written over enough, the log is compacted.
+            storage = WrenData.initialize(file_name=file_name,
+                                          backend='log')
+            kvs = storage.kvs
+            kvs.compact_min = 0
+            for x in range(10):
+                storage.write('cursor', 'CursorModel', str(x))
+            storage.close()
+            self.assertGreater(kvs.compactions, 0)
+
+            # A torn record at the end is cut off.
+            with open(file_name + '.log', 'ab') as log_file:
+                log_file.write(b'torn')
+            storage = WrenData.initialize(file_name=file_name,
+                                          backend='log')
+            self.assertEqual(('CursorModel', '9'), storage.get('cursor'))
+            self.assertEqual(('GridModel', b'WRG\0'), storage.get('bytes'))
+            self.assertEqual({'moved', 'text', 'bytes', 'cursor'},
+                             {key for key, _, _ in storage.kvs.scan()})
+            storage.close()
+
+    def test_embedding_store(self):
+        import os
+        import tempfile
+        import numpy as np
+        import torch as th
+        import embedding
+        from embedding import EmbeddingStore
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'terms.pth')
+            weights = th.rand(3, 2, dtype=th.float64) / 2
+            th.save({'model': {'lt.weight': weights},
+                     'objects': ['a', 'b', 'c']}, checkpoint)
+            store = EmbeddingStore(checkpoint)
+            self.assertEqual(['a', 'b', 'c'], store.objects)
+            self.assertEqual(2, store.term_index('c'))
+            self.assertNotIn('d', store)
+            np.testing.assert_array_equal(weights.numpy(), store.vectors)
+            self.assertEqual(2, len(os.listdir(store.cache_dir)))
+            # Distance vectors are cached.
+            dists = store.distances(1)
+            self.assertIs(dists, store.distances(1))
+            self.assertEqual((1, 1), (store.hits, store.misses))
+            self.assertEqual(0, dists[1])
+            self.assertAlmostEqual(dists[2], store.distance(1, 2), places=6)
+            np.testing.assert_allclose(
+                [dists[0], dists[2]], store.pair_distances([1, 1], [0, 2]),
+                atol=1e-6)
+
+            # A changed checkpoint gets its own cache.
+            th.save({'model': {'lt.weight': weights[:2]},
+                     'objects': ['a', 'b']}, checkpoint)
+            store_2 = EmbeddingStore(checkpoint)
+            self.assertEqual(2, len(store_2))
+            self.assertNotEqual(store.version, store_2.version)
+            self.assertEqual(4, len(os.listdir(store.cache_dir)))
+
+            # Nearest terms, by a pass over them or with the index.
+            term_ids, near_dists = store.nearest(1, 2)
+            self.assertEqual([1, int(np.argsort(dists)[1])], list(term_ids))
+            np.testing.assert_array_equal(dists[term_ids], near_dists)
+            within = store.within(1, float(near_dists[1]))
+            np.testing.assert_array_equal(term_ids, within[0])
+            old_min_terms = embedding.INDEX_MIN_TERMS
+            embedding.INDEX_MIN_TERMS = 0
+            try:
+                np.testing.assert_array_equal(term_ids,
+                                              store.nearest(1, 2)[0])
+                np.testing.assert_array_equal(
+                    term_ids, store.within(1, float(near_dists[1]))[0])
+                # Every term is all of them sorted, ex. the mammals import.
+                np.testing.assert_array_equal(
+                    np.argsort(dists, kind='stable'),
+                    store.nearest(1, len(store))[0])
+            finally:
+                embedding.INDEX_MIN_TERMS = old_min_terms
+            self.assertEqual(5, len(os.listdir(store.cache_dir)))
+
+            # With the distance matrix precomputed scores are looked up.
+            self.assertIsNone(store.matrix)
+            store.precompute(processes=2)
+            self.assertEqual((3, 3), store.matrix.shape)
+            np.testing.assert_allclose(dists, store.distances(1), atol=1e-6)
+            self.assertAlmostEqual(dists[2], store.distance(1, 2), places=6)
+            np.testing.assert_allclose(
+                [dists[0], dists[2]], store.pair_distances([1, 1], [0, 2]),
+                atol=1e-6)
+            # Not of the changed checkpoint.
+            self.assertIsNone(EmbeddingStore(checkpoint).matrix)
+
+    def test_distance_kernels(self):
+        import numpy as np
+        import torch as th
+        import distance
+        import poincare.model
+        rows = th.rand(50, 5, dtype=th.float64) * 2 - 1
+        # Inside the unit ball, some close to its edge.
+        rows /= (rows.norm(dim=-1, keepdim=True) * 1.0001)
+        rows[:25] *= th.rand(25, 1, dtype=th.float64)
+        vectors = rows.numpy()
+        us = rows[:7]
+
+        def one_to_all(torch_distance):
+            return np.stack([torch_distance(u.expand_as(rows), rows).detach()
+                             .numpy() for u in us])
+
+        transe = poincare.model.TranseDistance(dim=5)
+        for kernel, torch_distance in [
+                (distance.PoincareDistance(vectors),
+                 poincare.model.PoincareDistance().forward),
+                (distance.EuclideanDistance(vectors),
+                 poincare.model.EuclideanDistance()),
+                (distance.TranseDistance(vectors, transe.r.detach().numpy()),
+                 transe)]:
+            expected = one_to_all(torch_distance)
+            self.assertEqual(np.float32, kernel.one_to_many(vectors[0]).dtype)
+            for i, u in enumerate(us.numpy()):
+                np.testing.assert_allclose(expected[i], kernel.one_to_many(u),
+                                           rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(expected, kernel.pairwise(us.numpy()),
+                                       rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(
+                expected[0, [3, 1, 40]],
+                kernel.one_to_rows(vectors[0], [3, 1, 40]),
+                rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(
+                torch_distance(us, rows[7:14]).detach().numpy(),
+                kernel.paired(us.numpy(), vectors[7:14]),
+                rtol=1e-5, atol=1e-5)
+
+    def test_term_ids(self):
+        import os
+        import tempfile
+        import torch as th
+        import embedding
+        from controllers import Datum, TermIds
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'terms.pth')
+            th.save({'model': {'lt.weight': th.rand(3, 2) / 2},
+                     'objects': ['a', 'b', 'c']}, checkpoint)
+            old_embedding = embedding._EMBEDDING
+            embedding._EMBEDDING = embedding.EmbeddingStore(checkpoint)
+            try:
+                a, c, x = [Datum.create(text) for text in 'acx']
+                term_ids = TermIds([a.model.key, x.model.key])
+                term_ids.add(c.model.key)
+                keys, ids = term_ids.items()
+                self.assertEqual([a.model.key, x.model.key, c.model.key],
+                                 keys)
+                self.assertEqual([0, TermIds.NO_TERM, 2], list(ids))
+                self.assertIsNone(term_ids.get(x.model.key))
+
+                # Worked out again when the data changes.
+                x.set_data('b')
+                self.assertEqual(1, term_ids.get(x.model.key))
+                term_ids.remove(a.model.key)
+                keys, ids = term_ids.items()
+                self.assertEqual([c.model.key, x.model.key], keys)
+                self.assertEqual([2, 1], list(ids))
+                # Not kept, but still looked up.
+                self.assertNotIn(a.model.key, term_ids)
+                self.assertEqual(0, term_ids.get(a.model.key))
+            finally:
+                embedding._EMBEDDING = old_embedding
+
+    def test_vptree(self):
+        import os
+        import tempfile
+        import numpy as np
+        from distance import PoincareDistance
+        from vptree import VPTree
+        random = np.random.RandomState(0)
+        vectors = random.uniform(-1, 1, (2000, 5))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors *= random.uniform(0, 0.99, (2000, 1))
+        vectors = vectors.astype(np.float32)
+        tree = VPTree(vectors, leaf_size=8)
+        kernel = PoincareDistance(vectors)
+        for u in vectors[:20]:
+            dists = kernel.one_to_many(u)
+            expected = np.argsort(dists, kind='stable')
+            ids, near_dists = tree.knn(u, 10)
+            np.testing.assert_array_equal(expected[:10], ids)
+            np.testing.assert_allclose(dists[ids], near_dists, rtol=1e-5)
+            # Approximate, each is no more than 1 + eps times as far.
+            ids, near_dists = tree.knn(u, 10, eps=0.5)
+            self.assertTrue(np.all(
+                near_dists <= dists[expected[:10]] * 1.5 + 1e-5))
+            radius = float(np.sort(dists)[50]) + 1e-3
+            ids, _ = tree.within(u, radius)
+            self.assertEqual(set(np.flatnonzero(dists <= radius)), set(ids))
+        self.assertEqual(0, len(tree.knn(vectors[0], 0)[0]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'tree.npz')
+            tree.save(file_name)
+            loaded = VPTree.load(file_name, vectors)
+            np.testing.assert_array_equal(tree.knn(vectors[5], 10)[0],
+                                          loaded.knn(vectors[5], 10)[0])
+            with self.assertRaises(ValueError):
+                VPTree.load(file_name, vectors[:10])
+
+    def test_riemannian_sgd(self):
+        import torch as th
+        from poincare import rsgd
+        weight = th.nn.Parameter(th.tensor([[0.5, 0.0], [0.0, 0.0]]))
+        grad = th.ones(2, 2)
+        # Scaled by (1 - |p|^2)^2 / 4, dense or sparse.
+        expected = th.tensor([[0.140625] * 2, [0.25] * 2])
+        self.assertTrue(th.allclose(expected,
+                                    rsgd.poincare_grad(weight, grad)))
+        sparse = th.sparse_coo_tensor(th.tensor([[1, 0]]), grad, (2, 2))
+        self.assertTrue(th.allclose(
+            expected, rsgd.poincare_grad(weight, sparse).to_dense()))
+
+        optimizer = rsgd.RiemannianSGD([weight], lr=1.0,
+                                       rgrad=rsgd.poincare_grad,
+                                       retraction=rsgd.euclidean_retraction)
+        weight.grad = grad
+        optimizer.step(lr=0.1)
+        self.assertTrue(th.allclose(
+            th.tensor([[0.5, 0.0], [0.0, 0.0]]) - 0.1 * expected,
+            weight.data))
+
+    def test_alias_sampler(self):
+        import numpy as np
+        from poincare.model import AliasSampler
+        weights = np.array([1.0, 0.0, 3.0, 6.0, 0.5])
+        sampler = AliasSampler(weights)
+        self.assertEqual(5, len(sampler))
+        np.random.seed(0)
+        samples = sampler.draw((1000, 200))
+        self.assertEqual((1000, 200), samples.shape)
+        freqs = np.bincount(samples.ravel(), minlength=5) / samples.size
+        np.testing.assert_allclose(weights / weights.sum(), freqs, atol=0.01)
+        self.assertEqual(0, freqs[1])
+
+    def test_graph_dataset(self):
+        import numpy as np
+        import torch as th
+        from distance import EuclideanDistance
+        from poincare.model import SNGraphDataset
+        from poincare.train import reconstruction
+        # t, h, weight; 0 -> 1 twice
+        idx = th.LongTensor([[0, 1, 1], [0, 1, 2], [0, 2, 1], [3, 0, 1]])
+        data = SNGraphDataset(idx, ['a', 'b', 'c', 'd'], 2)
+        heads, weights = data.neighbours(0)
+        self.assertEqual([1, 2], heads.tolist())
+        self.assertEqual([3, 1], weights.tolist())
+        self.assertEqual([], data.neighbours(1)[0].tolist())
+        self.assertEqual([2, 4, 2, 1], data._counts.tolist())
+        self.assertEqual([True, False, True, False],
+                         data.has_edges([0, 0, 3, 1], [1, 3, 0, 0]).tolist())
+
+        np.random.seed(0)
+        for burnin in [False, True]:
+            data.burnin = burnin
+            inputs, targets = data.sample(np.arange(4))
+            self.assertEqual((4, 4), tuple(inputs.size()))
+            self.assertEqual([0] * 4, targets.tolist())
+            inputs = inputs.numpy()
+            np.testing.assert_array_equal(idx.numpy()[:, :2], inputs[:, :2])
+            # Neither negative of 0 is a head of it, and they differ.
+            self.assertEqual([0, 3], sorted(inputs[0, 2:]))
+            self.assertFalse(data.has_edges(
+                inputs[:, :1].repeat(2, axis=1), inputs[:, 2:]).any())
+
+        vectors = np.array([[0, 0], [0.1, 0], [0.2, 0], [0.5, 0]])
+        # 1 and 2 are nearest 0, 3 has 1 and 2 nearer than 0.
+        mean_rank, mean_ap = reconstruction(EuclideanDistance(vectors),
+                                            vectors, data)
+        self.assertAlmostEqual(5 / 3, mean_rank)
+        self.assertAlmostEqual(2 / 3, mean_ap)
+
+    def test_ranked(self):
+        import numpy as np
+        from distance import ranked
+        dists = np.random.RandomState(0).rand(1000).astype(np.float32)
+        dists[10:20] = 0.5  # Ties
+        chunks = list(ranked(dists, 7))
+        self.assertEqual([7, 14, 28, 56, 112, 224, 448, 111],
+                         [len(chunk) for chunk in chunks])
+        order = np.concatenate(chunks)
+        np.testing.assert_array_equal(np.argsort(dists, kind='stable'), order)
+        self.assertEqual([], list(ranked([], 7)))
+
+    def test_get_datum_by_name(self):
+        from model import DatumModel, datum_name_exists, get_datum_by_name
+        datum_model = DatumModel('text', name='alpha')
+        datum_model.save()
+        self.assertIs(datum_model, get_datum_by_name('alpha'))
+        self.assertTrue(datum_name_exists('alpha'))
+
+        datum_model.name = 'beta'
+        datum_model.save()
+        self.assertIsNone(get_datum_by_name('alpha'))
+        self.assertFalse(datum_name_exists('alpha'))
+        self.assertIs(datum_model, get_datum_by_name('beta'))
+
+    def test_search_datums(self):
+        from model import ClipModel, DatumModel, GridModel, get_storage
+        storage = get_storage()
+        lion = DatumModel('lion', name='big cat')
+        lion.save()
+        sea_lion = DatumModel('sea lion', name='pinniped')
+        sea_lion.save()
+        DatumModel('house cat', name='small cat').save()
+
+        for has_text_index in [True, False]:
+            storage.has_text_index = has_text_index
+            # Exact data first.
+            self.assertEqual([lion.key, sea_lion.key],
+                             storage.search_datums('lion'))
+            self.assertEqual([sea_lion.key], storage.search_datums('se li'))
+            self.assertEqual(2, len(storage.search_datums('cat')))
+            self.assertEqual(1, len(storage.search_datums('cat', limit=1)))
+            self.assertEqual([], storage.search_datums('  '))
+        storage.has_text_index = True
+
+        # Saving a Datum updates the index.
+        lion.data = 'tiger'
+        lion.save()
+        self.assertEqual([sea_lion.key], storage.search_datums('lion'))
+        self.assertEqual([lion.key], storage.search_datums('tig'))
+
+        # The index refers to rows by id, which VACUUM keeps.
+        storage.conn.execute('DELETE FROM datums WHERE key=?', (lion.key,))
+        storage.conn.commit()
+        storage.conn.execute('VACUUM')
+        self.assertEqual([sea_lion.key], storage.search_datums('lion'))
+        self.assertEqual([], storage.search_datums('tig'))
+        lion.save()
+
+        grid_model = GridModel()
+        grid_model.save()
+        ClipModel(grid_model.key, lion.key, 4, 2, 0).save()
+        self.assertEqual([(4, 2)], [(row[2], row[3]) for row in
+                                    storage.find_clips(grid_model.key,
+                                                       lion.key)])
+
+    def test_datums_by_last_changed(self):
+        from datetime import timedelta
+        from model import DatumModel, GridModel, epoch, get_storage
+        storage = get_storage()
+        kind = DatumModel.__name__
+        future = epoch + timedelta(days=100 * 365)
+        datum_models = [
+            DatumModel(str(i), name=str(i),
+                       last_changed=future + timedelta(days=days))
+            for i, days in enumerate([3, 1, 2, 1])]
+        for datum_model in datum_models:
+            datum_model.save()
+        keys = [datum_model.key for datum_model in datum_models]
+        # After the Datums made by setUp.
+        self.assertEqual([keys[1], keys[3], keys[2], keys[0]],
+                         storage.get_datums_by_last_changed(kind)[-4:])
+        self.assertEqual([keys[0], keys[2]],
+                         storage.get_datums_by_last_changed(
+                             kind, limit=2, reverse=True))
+
+        grid_model = GridModel()
+        grid_model.save()
+        for key in [keys[3], keys[0], keys[1]]:
+            grid_model.add_active_datum(key)
+        # Ties keep the order they were added in.
+        self.assertEqual([keys[3], keys[1], keys[0]],
+                         grid_model.active_datums_by_last_changed())
+
+        # Files made before the datums table get it filled in from kvs.
+        storage.conn.execute('DROP TABLE IF EXISTS datums_text')
+        storage.conn.execute('DROP TABLE datums')
+        storage.create_tables()
+        self.assertEqual([keys[3], keys[1], keys[0]],
+                         grid_model.active_datums_by_last_changed())
+
+    def test_load_many(self):
+        from model import DatumModel, NotFound, get_model_id_map, \
+            get_models, get_storage
+        keys = []
+        for i in range(600):  # More than one chunk.
+            datum_model = DatumModel('text {}'.format(i), name=str(i))
+            datum_model.save()
+            keys.append(datum_model.key)
+        self.assertEqual(
+            600, len(get_storage().get_many(keys + ['missing_key'])))
+
+        get_model_id_map()._reset()
+        models = get_models(keys)
+        self.assertEqual(keys, [m.key for m in models])
+        self.assertEqual('text 599', models[-1].data)
+        self.assertIs(models[0], get_models(keys[:1])[0])
+        with self.assertRaises(NotFound):
+            get_models(['missing_key'])
+
+    def test_id_map(self):
+        from wren import IDMap
+
+        class Thing:
+            pass
+
+        id_map = IDMap(capacity=2)
+        things = [Thing() for _ in range(4)]
+        for i, thing in enumerate(things):
+            id_map.set(i, thing)
+        self.assertIs(things[0], id_map.get(0))
+        self.assertIsNone(id_map.get('missing'))
+
+        # Unused ones past capacity are let go, unless pinned.
+        id_map.set('pinned', Thing())
+        id_map.pin('pinned')
+        del things
+        self.assertIsNone(id_map.get(1))
+        self.assertIsNone(id_map.get(2))
+        self.assertIsNotNone(id_map.get(3))
+        for i in range(3):
+            id_map.set(i, Thing())
+        self.assertIsNotNone(id_map.get('pinned'))
+        id_map.unpin('pinned')
+        for i in range(3):
+            id_map.set(i, Thing())
+        self.assertIsNone(id_map.get('pinned'))
+        with self.assertRaises(KeyError):
+            id_map.pin('pinned')
+
+        stats = id_map.stats()
+        self.assertEqual(3, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertGreater(stats['evictions'], 0)
+        self.assertEqual(2, stats['recent'])
+        self.assertEqual(0, stats['pinned'])
+
+    def test_clip_coordinate_queries(self):
+        from model import ClipModel, GridModel, get_model_id_map, get_storage
+        storage = get_storage()
+        grid_model = GridModel()
+        grid_model.save()
+        key = grid_model.key
+        for x, y in [(0, 0), (0, 1), (0, -2), (1, 0), (3, 5)]:
+            ClipModel(key, 'datum_{}_{}'.format(x, y), x, y, 0).save()
+
+        self.assertEqual('datum_0_1', storage.get_clip_at(key, 0, 1)[1])
+        self.assertIsNone(storage.get_clip_at(key, 1, 1))
+        self.assertEqual({(0, 0), (0, 1), (1, 0)},
+                         {(row[2], row[3]) for row in storage.get_clips_in(
+                             key, 0, 1, 0, 1)})
+        self.assertEqual({0: (-2, 1), 1: (0, 0), 3: (5, 5)},
+                         storage.get_column_bounds(key))
+        self.assertEqual({3: (5, 5)}, storage.get_column_bounds(key, 3))
+
+        storage.shift_clips(key, -1, 0, 1)
+        storage.delete_column(key, 3)
+        self.assertEqual({-1: (-2, 1), 0: (0, 0)},
+                         storage.get_column_bounds(key))
+
+        # Clip models are read as they are looked up.
+        get_model_id_map()._reset()
+        grid_model = GridModel.load(key)
+        self.assertEqual(4, len(grid_model.clip_models))
+        clip_key = storage.get_clip_at(key, 0, 0)[0]
+        self.assertIsNone(get_model_id_map().get(clip_key))
+        clip_model = grid_model.clip_models[clip_key]
+        self.assertEqual((0, 0), (clip_model.x, clip_model.y))
+        self.assertIs(clip_model, grid_model.clip_models[clip_key])
+
+    def test_clip_map_eviction(self):
+        from controllers import ClipMap, Grid, get_controller_id_map
+        from model import (ClipModel, DatumModel, GridModel,
+                           get_model_id_map)
+        grid_model = GridModel()
+        grid_model.save()
+        # Not set up, that needs the main window.
+        grid = Grid(grid_model)
+        get_controller_id_map().set(grid_model.key, grid)
+        datum_model = DatumModel('clip text')
+        datum_model.save()
+        for y in range(3):
+            ClipModel(grid_model.key, datum_model.key, 0, y, 0).save()
+        clips = ClipMap(grid_model.key, 2)
+        clip = clips[0, 0]
+        clips.get((0, 1))
+        clips.get((0, 2))
+        # Out of the map, but still in use so it is the one found again.
+        self.assertNotIn((0, 0), clips._clips)
+        self.assertIs(clip, clips[0, 0])
+        self.assertIs(clip.model, get_model_id_map().get(clip.model.key))
+
+    def test_clip_map_shift_evicted(self):
+        from controllers import ClipMap, Grid, get_controller_id_map
+        from model import ClipModel, DatumModel, GridModel, get_storage
+        grid_model = GridModel()
+        grid_model.save()
+        # Not set up, that needs the main window.
+        grid = Grid(grid_model)
+        get_controller_id_map().set(grid_model.key, grid)
+        datum_model = DatumModel('clip text')
+        datum_model.save()
+        for y in range(4):
+            ClipModel(grid_model.key, datum_model.key, 0, y, 0).save()
+        clips = ClipMap(grid_model.key, 2)
+        held = clips[0, 0]
+        clips.get((0, 1))
+        clips.get((0, 2))
+        self.assertNotIn((0, 0), clips._clips)
+        clips.shift(-1, 0, 0)
+        self.assertIs(held, clips[-1, 0])
+        self.assertEqual((-1, 0), (held.model.x, held.model.y))
+        # Saving it, ex. from the Inspector, leaves it where it was moved.
+        held.model.save()
+        self.assertEqual(
+            [(-1, 0), (-1, 1), (-1, 2), (-1, 3)],
+            sorted((row[2], row[3])
+                   for row in get_storage().get_clips(grid_model.key)))
+        # A row moved without the ClipMap is picked up when it is read.
+        get_storage().shift_clips(grid_model.key, 1, -1, -1)
+        self.assertIs(held, ClipMap(grid_model.key, 2)[0, 0])
+        self.assertEqual(0, held.model.x)
+
+    def test_batch_rollback_reloads(self):
+        import codec
+        from controllers import ClipMap, Grid, TermIds, get_controller_id_map
+        from model import ClipModel, DatumModel, GridModel, get_storage
+        storage = get_storage()
+        grid_model = GridModel()
+        grid_model.save()
+        key = grid_model.key
+        datum_models = [DatumModel(text) for text in 'AB']
+        for datum_model in datum_models:
+            datum_model.save()
+        a_key, b_key = [datum_model.key for datum_model in datum_models]
+        ClipModel(key, a_key, 0, 0, 0).save()
+        grid_model.add_active_datum(a_key)
+        # Not set up, that needs the main window.
+        grid = Grid(grid_model)
+        get_controller_id_map().set(key, grid)
+        grid.coordinates_to_clip = ClipMap(key, 100)
+        grid._load_bounds()
+        grid.active_datums = set(grid_model.active_datums)
+        grid.term_ids = TermIds(grid_model.active_datums)
+        clip = grid.coordinates_to_clip[0, 0]
+
+        with self.assertRaises(ValueError):
+            with storage.batch():
+                grid_model.add_active_datum(b_key)
+                grid.active_datums.add(b_key)
+                grid.term_ids.add(b_key)
+                grid.coordinates_to_clip.move_row(
+                    storage.get_clip_at(key, 0, 0), 1, 0)
+                new_clip_model = ClipModel(key, b_key, 0, 1, 0)
+                new_clip_model.save()
+                grid.y_lower_bounds[0] = 1
+                grid_model.x_offset = 5
+                grid_model.save()
+                raise ValueError
+        # What is in memory is what is in storage again.
+        self.assertEqual([a_key], grid_model.active_datums)
+        self.assertEqual({a_key}, grid.active_datums)
+        self.assertNotIn(b_key, grid.term_ids)
+        self.assertEqual((0, 0), (clip.model.x, clip.model.y))
+        self.assertIs(clip, grid.coordinates_to_clip[0, 0])
+        self.assertNotIn((1, 0), grid.coordinates_to_clip)
+        self.assertEqual(({0: 0}, {0: 0}),
+                         (grid.y_upper_bounds, grid.y_lower_bounds))
+        new_clip_model.save()
+        self.assertIsNone(storage.get_clip(key, new_clip_model.key))
+        # The grid row was rolled back, so saving again writes it.
+        grid_model.save()
+        self.assertEqual(5, codec.decode_grid(storage.get(key)[1])['x_offset'])
+
+    def test_clip_model_load(self):
+        import gc
+        from exceptions import NotFound
+        from model import (ClipModel, GridModel, get_model, get_model_id_map,
+                           get_models)
+        grid_model = GridModel()
+        grid_model.save()
+        ClipModel(grid_model.key, 'datum', 1, 2, 3, key='clip').save()
+        # Out of both tiers of the id-map, it is read from the clips table.
+        get_model_id_map()._recent.clear()
+        gc.collect()
+        self.assertIsNone(get_model_id_map().get('clip'))
+        clip_model = get_model('clip')
+        self.assertEqual((grid_model.key, 'datum', 1, 2, 3),
+                         (clip_model.grid_key, clip_model.datum_key,
+                          clip_model.x, clip_model.y,
+                          clip_model.edit_cursor_position))
+        self.assertEqual([grid_model, clip_model],
+                         get_models([grid_model.key, 'clip']))
+        del clip_model
+        get_model_id_map()._recent.clear()
+        gc.collect()
+        self.assertEqual('clip', get_models(['clip'])[0].key)
+        with self.assertRaises(NotFound):
+            get_model('no clip')
+
+    def test_clip_map_delete_column(self):
+        from controllers import ClipMap, Grid, get_controller_id_map
+        from model import ClipModel, DatumModel, GridModel, get_storage
+        grid_model = GridModel()
+        grid_model.save()
+        # Not set up, that needs the main window.
+        grid = Grid(grid_model)
+        get_controller_id_map().set(grid_model.key, grid)
+        datum_model = DatumModel('clip text')
+        datum_model.save()
+        for x, y in [(0, 0), (0, 1), (0, 2), (1, 0)]:
+            ClipModel(grid_model.key, datum_model.key, x, y, 0).save()
+        clips = ClipMap(grid_model.key, 2)
+        held = clips[0, 0]
+        clips.get((0, 1))
+        clips.get((0, 2))
+        self.assertNotIn((0, 0), clips._clips)
+        clips.delete_column(0)
+        self.assertNotIn((0, 0), clips)
+        # Saving it, ex. from the Inspector, does not bring it back.
+        held.model.edit_cursor_position = 1
+        held.model.save()
+        self.assertEqual(
+            [(1, 0)], [(row[2], row[3])
+                       for row in get_storage().get_clips(grid_model.key)])
+        # Nor does saving one deleted by its row.
+        clip = clips[1, 0]
+        clips.delete_row(get_storage().get_clip_at(grid_model.key, 1, 0))
+        clip.model.save()
+        self.assertEqual(0, get_storage().count_clips(grid_model.key))
+
+    def test_archive_datum(self):
+        from controllers import ClipMap, Grid, TermIds, get_controller_id_map
+        from model import ClipModel, GridModel, get_storage
+        storage = get_storage()
+        grid_model = GridModel()
+        grid_model.save()
+        key = grid_model.key
+        for datum_key, x, y in [
+                # Column 0 keeps its home Clip, A is cut from both sides.
+                ('C', 0, -2), ('A', 0, -1), ('B', 0, 0), ('A', 0, 1),
+                ('D', 0, 2),
+                # Column 1 has A home, it goes.
+                ('A', 1, 0), ('X', 1, 1),
+                # Column 2 is only a home Clip.
+                ('E', 2, 0),
+                ('F', 3, 0), ('G', 3, 1)]:
+            ClipModel(key, datum_key, x, y, 0).save()
+        for datum_key in 'ABCDEFGX':
+            grid_model.add_active_datum(datum_key)
+        # Not set up, that needs the main window.
+        grid = Grid(grid_model)
+        get_controller_id_map().set(key, grid)
+        grid.coordinates_to_clip = ClipMap(key, 100)
+        grid.y_upper_bounds = {}
+        grid.y_lower_bounds = {}
+        for x, (min_y, max_y) in storage.get_column_bounds(key).items():
+            grid.y_upper_bounds[x] = min(0, min_y)
+            grid.y_lower_bounds[x] = max(0, max_y)
+        grid._update_min_max_x()
+        grid.active_datums = set(grid_model.active_datums)
+        grid.term_ids = TermIds(grid_model.active_datums)
+
+        grid._archive_datum_key('A')
+        self.assertEqual(
+            {(0, -1): 'C', (0, 0): 'B', (0, 1): 'D', (1, 0): 'E',
+             (2, 0): 'F', (2, 1): 'G'},
+            {(row[2], row[3]): row[1] for row in storage.get_clips(key)})
+        self.assertEqual({0: -1, 1: 0, 2: 0}, grid.y_upper_bounds)
+        self.assertEqual({0: 1, 1: 0, 2: 1}, grid.y_lower_bounds)
+        self.assertEqual((0, 2), (grid.min_x, grid.max_x))
+        self.assertNotIn('A', grid_model.active_datums)
+
+    def test_grid_serialize_formats(self):
+        import codec
+        import json
+        from model import GridModel, get_model_id_map, get_storage
+        grid_model = GridModel(x_offset=3, y_offset=-2,
+                               active_datums=['a', 'b', 'c'],
+                               relationships={'a': {'b': '.5', 'c': '1'}},
+                               clipboard_datum_key='c')
+        grid_model.main_cursor_model.x = 4
+        main_key = grid_model.main_cursor_model.key
+        self.assertTrue(codec.is_encoded_grid(grid_model.serialize()))
+        # The older json row, with the cursors json inside the json.
+        json_value = json.dumps([
+            {name: json.dumps([cursor_model.key, grid_model.key,
+                               cursor_model.x, cursor_model.y, name])
+             for name, cursor_model in [
+                 ('main', grid_model.main_cursor_model),
+                 ('secondary', grid_model.secondary_cursor_model)]},
+            grid_model.relationships, 3, -2, grid_model.active_datums, 'c'])
+        # The json row moves its relationships and active datums to their
+        # tables, a saved grid row only has the offsets, cursors and
+        # clipboard.
+        loaded_models = []
+        get_model_id_map()._reset()
+        loaded_models.append(GridModel.deserialize(grid_model.key,
+                                                   json_value))
+        get_model_id_map()._reset()
+        loaded_models.append(GridModel.load(grid_model.key))
+        self.assertEqual(
+            {'x_offset', 'y_offset', 'main_cursor', 'secondary_cursor',
+             'clipboard_datum_key'},
+            set(codec.decode_grid(get_storage().get(grid_model.key)[1])))
+        # Written as json when asked, with the same tables.
+        loaded_models[-1].serialize_format = 'json'
+        loaded_models[-1].save()
+        self.assertEqual([{}, 3, -2, [], 'c'],
+                         json.loads(get_storage().get(grid_model.key)[1])[1:])
+        get_model_id_map()._reset()
+        loaded_models.append(GridModel.load(grid_model.key))
+        for loaded in loaded_models:
+            self.assertEqual((3, -2), (loaded.x_offset, loaded.y_offset))
+            self.assertEqual(['a', 'b', 'c'], loaded.active_datums)
+            self.assertEqual({'a': {'b': '.5', 'c': '1'}},
+                             loaded.relationships)
+            self.assertEqual('c', loaded.clipboard_datum_key)
+            self.assertEqual(main_key, loaded.main_cursor_model.key)
+            self.assertEqual(4, loaded.main_cursor_model.x)
+
+    def test_grid_saves_changes_only(self):
+        from model import GridModel, get_model_id_map, get_storage
+        storage = get_storage()
+        grid_model = GridModel()
+        grid_model.add_active_datum('a')
+        grid_model.add_active_datum('b')
+        grid_model.set_relationship('a', 'b', '.5')
+        grid_model.save()
+        _, value = storage.get(grid_model.key)
+
+        # Nothing changed, nothing is written.
+        changes = storage.conn.total_changes
+        grid_model.save()
+        self.assertEqual(changes, storage.conn.total_changes)
+
+        grid_model.set_relationship('a', 'b', '.7')
+        grid_model.remove_active_datum('a')
+        self.assertEqual(changes + 2, storage.conn.total_changes)
+        self.assertEqual(value, storage.get(grid_model.key)[1])
+
+        grid_model.main_cursor_model.y = 7
+        grid_model.main_cursor_model.save()
+        self.assertEqual(changes + 3, storage.conn.total_changes)
+
+        # With the write-behind thread cursor moves are queued, and
+        # coalesce into one write.
+        storage.start_writer(interval=3600)
+        try:
+            for y in range(10):
+                grid_model.main_cursor_model.y = y
+                grid_model.main_cursor_model.save()
+            self.assertEqual(changes + 3, storage.conn.total_changes)
+            storage.flush()
+            self.assertEqual(changes + 4, storage.conn.total_changes)
+        finally:
+            storage.stop_writer()
+        grid_model.main_cursor_model.y = 7
+        grid_model.main_cursor_model.save()
+
+        get_model_id_map()._reset()
+        loaded = GridModel.load(grid_model.key)
+        self.assertEqual(['b'], loaded.active_datums)
+        self.assertEqual({'a': {'b': '.7'}}, loaded.relationships)
+        self.assertEqual(7, loaded.main_cursor_model.y)
+
+    def test_relationship_scores(self):
+        from model import GridModel
+        grid_model = GridModel()
+        grid_model.save()
+        for a_key, b_key, value in [('a', 'x', '.5'), ('b', 'x', '2'),
+                                    ('c', 'x', 'not a number'),
+                                    ('a', 'y', '.1'), ('a', 'z', '.9'),
+                                    ('a', 'a', '3'), ('b', 'b', '4'),
+                                    ('c', 'c', '5')]:
+            grid_model.set_relationship(a_key, b_key, value)
+        grid_model.add_active_datum('a')
+        grid_model.add_active_datum('b')
+
+        self.assertEqual([('b', 2.0), ('a', 0.5)],
+                         grid_model.scores_given('x'))
+        self.assertEqual([('a', 3.0), ('z', 0.9)],
+                         grid_model.top_scores('a', 2))
+        self.assertEqual(4, len(grid_model.top_scores('a')))
+        # 'c' is not active.
+        self.assertEqual([('b', 4.0), ('a', 3.0)],
+                         grid_model.active_self_scores())
 
     def test_clip_grid_add(self):
         from model import ClipModel, GridModel, TextModel
@@ -10,6 +10,7 @@ from PyQt5.QtWidgets import QAction, QApplication, QDesktopWidget, \
     QSizePolicy, QTextEdit, QVBoxLayout, QWidget
 
 from controllers import Clip, get
+from model import get_storage
 from parse import get_text_and_commands
 from util import pluralize
 from wren import CLIP_BACKGROUND, CLIP_BACKGROUND_HOMEROW, CLIP_HEIGHT, \
@@ -83,7 +84,10 @@ class WrenWindow(QMainWindow):
                         status_bar=self.statusBar())
         import controllers
         self.inspector = controllers.Inspector(None)
-        controllers.get_controller_id_map().set('main_inspector', self.inspector)
+        id_map = controllers.get_controller_id_map()
+        id_map.set('main_inspector', self.inspector)
+        # It has no Model, it could not be made again if it was let go.
+        id_map.pin('main_inspector')
         self.inspector.setup(self.grid)
 
         self.h_box.addWidget(self.grid.view)
@@ -300,14 +304,15 @@ class ImportDialog(QDialog):
 
     def do_import(self):
         count = 0
-        for datum_text in self.datums:
-            count += 1
-            self.grid.status_bar.showMessage(
-                'Importing {}'.format(pluralize(count, 'Datum')))
-            x, y = self.grid._get_next_coords()
-            self.grid.new_datum_and_clip(x - self.grid.model.x_offset,
-                                         y - self.grid.model.y_offset,
-                                         datum_text, 0, emit=False)
+        with get_storage().batch():
+            for datum_text in self.datums:
+                count += 1
+                self.grid.status_bar.showMessage(
+                    'Importing {}'.format(pluralize(count, 'Datum')))
+                x, y = self.grid._get_next_coords()
+                self.grid.new_datum_and_clip(x - self.grid.model.x_offset,
+                                             y - self.grid.model.y_offset,
+                                             datum_text, 0, emit=False)
         self.grid.view.clip_changed.emit()
         self.grid.status_bar.showMessage(
             'Import file {} complete - {} imported'.format(
@@ -336,12 +341,19 @@ class GridView(QWidget):
         from app import get_application
         self.window = get_application().main_window
         self.coordinates_to_clip = {}  # Screen Coordinates.
+        # Map of (anchor term id, term id) to distance, see update_scores()
+        self.scores = {}
 
         self.grid_layout = QGridLayout()
         self.grid_layout.setSpacing(0)
         self.setLayout(self.grid_layout)
         self.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.setFocusPolicy(Qt.TabFocus)
+        # Connected before the ClipViews connect theirs, so they refresh
+        # with the new scores.
+        self.cursor_changed.connect(self.update_scores)
+        self.secondary_cursor_changed.connect(self.update_scores)
+        self.clip_changed.connect(self.update_scores)
         for screen_x in range(self.grid_width):
             for screen_y in range(self.grid_height):
                 clip_view = ClipView(self, None, self.grid,
@@ -357,10 +369,58 @@ class GridView(QWidget):
 
 
     def refresh(self):
+        self.update_scores()
         for screen_x in range(self.grid_width):
             for screen_y in range(self.grid_height):
                 self.coordinates_to_clip[screen_x, screen_y].refresh()
 
+    def update_scores(self):
+        self.grid.load_viewport()
+        self.scores = self.viewport_scores()
+
+    def viewport_scores(self):
+        """Get the scores the ClipViews show, all in one pass.
+
+        A Clip is scored against its anchors, the cursor's Clip and the home
+        row Clip of its column. Returns a map of (anchor term id, term id)
+        to their distance.
+
+        """
+        from embedding import get_embedding
+        embedding = get_embedding()
+        grid = self.grid
+
+        def term_id(clip):
+            if clip is None:
+                return None
+            return grid.term_ids.get(clip.model.datum_key)
+
+        selection_id = term_id(grid.get_cursor_clip())
+        pairs = set()
+        for screen_x in range(self.grid_width):
+            home_id = term_id(grid.coordinates_to_clip.get(
+                (screen_x + grid.model.x_offset, 0)))
+            for screen_y in range(self.grid_height):
+                clip_id = term_id(grid.get_clip_at(screen_x, screen_y))
+                if clip_id is None:
+                    continue
+                for anchor_id in (selection_id, home_id):
+                    if anchor_id is not None:
+                        pairs.add((anchor_id, clip_id))
+        pairs = list(pairs)
+        dists = embedding.pair_distances([pair[0] for pair in pairs],
+                                         [pair[1] for pair in pairs])
+        return dict(zip(pairs, dists.tolist()))
+
+    def score(self, anchor_term_id, term_id):
+        """Distance from an anchor to a term, from the last update_scores()
+        if it was worked out there."""
+        dist = self.scores.get((anchor_term_id, term_id))
+        if dist is None:
+            from embedding import get_embedding
+            dist = get_embedding().distance(anchor_term_id, term_id)
+        return dist
+
     def sizeHint(self):
         return QSize(self.grid_width*CLIP_WIDTH, self.grid_height*CLIP_HEIGHT)
 
@@ -384,11 +444,12 @@ class GridView(QWidget):
         with open('./documents/tensors.txt') as f:
             text = f.read()
         datums_text = list(filter(lambda y: y != '', text.split('-')))
-        for datum_text in datums_text:
-            x, y = self.grid._get_next_coords()
-            self.grid.new_datum_and_clip(x - self.grid.model.x_offset,
-                                         y - self.grid.model.y_offset,
-                                         datum_text, 0, emit=False)
+        with get_storage().batch():
+            for datum_text in datums_text:
+                x, y = self.grid._get_next_coords()
+                self.grid.new_datum_and_clip(x - self.grid.model.x_offset,
+                                             y - self.grid.model.y_offset,
+                                             datum_text, 0, emit=False)
         self.clip_changed.emit()
         log.info("import took %s seconds" % (datetime.now() - start).seconds)
 
@@ -431,9 +492,9 @@ class GridView(QWidget):
         progress.setValue(count+1)
         # This is a map of number (objects index) to "is a kind of" indexes
 
-        import torch as th
-        serialization = th.load('mammals.pth')
-        datums_text = serialization['objects']
+        from embedding import get_embedding
+        embedding = get_embedding()
+        datums_text = embedding.objects
         count = 0
         text_to_index = {}
         text_to_clip = {}
@@ -445,52 +506,46 @@ class GridView(QWidget):
 
         # Sort these by distance from 'mammal'
 
-        from torch.autograd import Variable
-        from controllers import _lt, _embedding, _term_to_index, _m
-
-        # Mammal is term 29.
-        s_e = Variable(_lt[29].expand_as(_embedding), volatile=True)
-        _dists = _m.dist()(s_e, _embedding).data.cpu().numpy().flatten()
-
-        positives = []
-        for i, datum_text in enumerate(datums_text):
-            progress.setValue(i)
-            term_id = _term_to_index[datum_text]
-            score = _dists[term_id]
-            score = float(score)
-            positives.append((score, datum_text))
-
-        datums_text = [x[1] for x in sorted(positives)]
-
-        for i, datum_text in enumerate(datums_text):
-            progress.setValue(i+1)
-            text_to_index[datum_text] = i
-            count += 1
-            #x, y = self.grid._get_next_coords()
-            x = 0
-            y = i
-            clip = self.grid.new_datum_and_clip(x - self.grid.model.x_offset,
-                                                y - self.grid.model.y_offset,
-                                                datum_text, 0, emit=False)
-            text_to_clip[datum_text] = clip
-            self.grid.status_bar.showMessage('new clips {}'.format(count))
-
-        # Set the parentage
-        progress.setLabelText('Setting {} Parentages'.format(len(adjacency)))
-        progress.setMinimumDuration(
-            max(0, old_min_time - (datetime.now()-start_time).seconds*1000))
-        progress.setRange(0, len(adjacency))
-        progress.reset()
-        for i, (parent, children) in enumerate(adjacency.items()):
-            progress.setValue(i)
-            parent_text = objects[parent]
-            parent_clip = text_to_clip[parent_text]
-            parent_key = parent_clip.datum.model.key
-            for child in children:
-                child_text = objects[child]
-                child_clip = text_to_clip[child_text]
-                child_clip.datum.model.parent = parent_key
-                child_clip.datum.model.save()
+        # Mammal is term 29. The terms are in row order, so a term's
+        # term_id is its index.
+        term_ids, _ = embedding.nearest(29, len(datums_text))
+        progress.setValue(len(datums_text))
+
+        datums_text = [datums_text[i] for i in term_ids.tolist()]
+
+        with get_storage().batch():
+            for i, datum_text in enumerate(datums_text):
+                progress.setValue(i+1)
+                text_to_index[datum_text] = i
+                count += 1
+                #x, y = self.grid._get_next_coords()
+                x = 0
+                y = i
+                clip = self.grid.new_datum_and_clip(
+                    x - self.grid.model.x_offset,
+                    y - self.grid.model.y_offset,
+                    datum_text, 0, emit=False)
+                text_to_clip[datum_text] = clip
+                self.grid.status_bar.showMessage('new clips {}'.format(count))
+
+            # Set the parentage
+            progress.setLabelText(
+                'Setting {} Parentages'.format(len(adjacency)))
+            progress.setMinimumDuration(
+                max(0,
+                    old_min_time - (datetime.now()-start_time).seconds*1000))
+            progress.setRange(0, len(adjacency))
+            progress.reset()
+            for i, (parent, children) in enumerate(adjacency.items()):
+                progress.setValue(i)
+                parent_text = objects[parent]
+                parent_clip = text_to_clip[parent_text]
+                parent_key = parent_clip.datum.model.key
+                for child in children:
+                    child_text = objects[child]
+                    child_clip = text_to_clip[child_text]
+                    child_clip.datum.model.parent = parent_key
+                    child_clip.datum.model.save()
 
         self.clip_changed.emit()
         msg = "import took %s seconds" % (datetime.now() - start_time).seconds
@@ -662,22 +717,19 @@ class ClipView(QFrame):
             self.right_score.display('')
             return
 
-        from controllers import _m, _term_to_index, _embedding, _lt
-        from torch.autograd import Variable
-        clip_datum_key = self.clip.model.datum_key
-        clip_datum_text = get(clip_datum_key).model.data
-        clip_term_id = _term_to_index[clip_datum_text]
+        # Scores worked out for the whole screen, see GridView.update_scores
+        grid_view = self.parentWidget()
+        term_ids = self.grid.term_ids
+        clip_term_id = term_ids.get(self.clip.model.datum_key)
         # Left side is distance from this to selection
         selection_score = None
         selection_clip = self.grid.get_cursor_clip()
+        selection_term_id = None
         if selection_clip:
-            selection_datum_key = selection_clip.model.datum_key
-            selection_datum_text = get(selection_datum_key).model.data
-            selection_term_id = _term_to_index[selection_datum_text]
-            s_e = Variable(_lt[selection_term_id].expand_as(_embedding),
-                   volatile=True)
-            _dists = _m.dist()(s_e, _embedding).data.cpu().numpy().flatten()
-            selection_score = round(float(_dists[clip_term_id]), 5)
+            selection_term_id = term_ids.get(selection_clip.model.datum_key)
+        if selection_term_id is not None and clip_term_id is not None:
+            selection_score = round(
+                grid_view.score(selection_term_id, clip_term_id), 5)
         if selection_score is None:
             left_score_text = ''
         else:
@@ -694,16 +746,14 @@ class ClipView(QFrame):
         # absolute.
         absolute_x = self.screen_x + self.grid.model.x_offset
         coords = (absolute_x, 0)
-        home_clip = self.grid.coordinates_to_clip[coords]
+        home_clip = self.grid.coordinates_to_clip.get(coords)
 
+        home_term_id = None
         if home_clip:
-            home_datum_key = home_clip.model.datum_key
-            home_datum_text = get(home_datum_key).model.data
-            home_term_id = _term_to_index[home_datum_text]
-            s_e = Variable(_lt[home_term_id].expand_as(_embedding),
-                   volatile=True)
-            _dists = _m.dist()(s_e, _embedding).data.cpu().numpy().flatten()
-            home_score = round(float(_dists[clip_term_id]), 5)
+            home_term_id = term_ids.get(home_clip.model.datum_key)
+        if home_term_id is not None and clip_term_id is not None:
+            home_score = round(
+                grid_view.score(home_term_id, clip_term_id), 5)
         if home_score is None:
             right_score_text = ''
         else:
@@ -1012,27 +1062,13 @@ class InspectorView(QWidget):
         if None in [a, b]:
             return
 
-        relationships = grid.model.relationships
-        try:
-            c1 = relationships[a.datum.model.key]
-        except KeyError:
-            c1 = {}
-            relationships[a.datum.model.key] = c1
-        c1[b.datum.model.key] = a_text
-
+        grid.model.set_relationship(a.datum.model.key, b.datum.model.key,
+                                    a_text)
         if a is not b:
-            try:
-                c1 = relationships[b.datum.model.key]
-            except KeyError:
-                c1 = {}
-                relationships[b.datum.model.key] = c1
-            # This code only set the other value if it was empty
+            # This code used to only set the other value if it was empty.
             # Policy is to always set the other value same as first.
-            #if a.datum.model.key not in c1:
-            #    c1[a.datum.model.key] = b_text
-            c1[a.datum.model.key] = a_text  # same as 'a'
-
-        grid.model.save()
+            grid.model.set_relationship(b.datum.model.key,
+                                        a.datum.model.key, a_text)
 
         a.refresh()
         b.refresh()
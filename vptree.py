@@ -0,0 +1,198 @@
+"""A vantage-point tree, for nearest terms without a pass over every row.
+
+    tree = VPTree(store.vectors)
+    ids, dists = tree.knn(store.vectors[term_id], 10)  # 10 nearest
+    ids, dists = tree.within(store.vectors[term_id], 0.5)  # Within 0.5
+    tree.save('mammals.vpt.npz')
+    tree = VPTree.load('mammals.vpt.npz', store.vectors)
+
+Each node has a vantage point, one of its rows, and splits the others at
+their median distance mu from it, those nearer in its inside child and
+the rest in its outside child. By the triangle inequality a query q can
+skip a child when no row of it can be closer than what it has, ex. the
+inside child when d(q, vantage) - mu is more than the k-th nearest so far.
+Rows in leaves of up to leaf_size are measured in one pass of the kernel.
+
+The distance has to be a metric, the poincare distance (the default) is,
+the squared euclidean distances of distance.py are not.
+
+knn is exact unless given eps, then each of its results is at most 1 + eps
+times as far as the true one at that rank, and it visits fewer nodes.
+
+The tree is flat arrays, a node's rows are the slice start:end of order,
+so it saves and loads as one .npz.
+
+"""
+import numpy as np
+
+LEAF_SIZE = 32
+# Bounds are of float32 distances, a node is only skipped when it is out by
+# more than this times 1 + the distance, so knn is exact.
+SLACK = 1e-4
+
+
+def _ranges(starts, ends):
+    """All of range(start, end) for each start and end, as one array"""
+    lengths = ends - starts
+    firsts = starts - np.cumsum(lengths) + lengths
+    return np.repeat(firsts, lengths) + np.arange(lengths.sum())
+
+
+class VPTree:
+    """Vantage-point tree of the rows of vectors, see the module doc.
+
+    distance is the kernel class, one of distance.py's, the default is
+    PoincareDistance.
+
+    """
+    def __init__(self, vectors, distance=None, leaf_size=LEAF_SIZE, seed=0,
+                 _arrays=None):
+        if distance is None:
+            from distance import PoincareDistance as distance
+        self.vectors = vectors
+        self.leaf_size = leaf_size
+        if _arrays is None:
+            _arrays = self._build(distance(vectors),
+                                  np.random.RandomState(seed))
+        (self.order, self.starts, self.ends, self.mus, self.his,
+         self.insides, self.outsides) = _arrays
+        # A kernel of the rows in tree order, so the rows of a node are a
+        # slice of it.
+        self.kernel = distance(np.asarray(vectors)[self.order])
+
+    def __len__(self):
+        return len(self.order)
+
+    def _build(self, kernel, random):
+        order = np.arange(len(self.vectors))
+        starts, ends, mus, his, insides, outsides = [], [], [], [], [], []
+
+        def new_node(start, end):
+            starts.append(start)
+            ends.append(end)
+            mus.append(0.0)
+            his.append(0.0)
+            insides.append(-1)
+            outsides.append(-1)
+            return len(starts) - 1
+
+        stack = [new_node(0, len(order))] if len(order) else []
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= self.leaf_size:
+                continue
+            # A random vantage point, moved to start.
+            pick = start + random.randint(end - start)
+            order[[start, pick]] = order[[pick, start]]
+            rest = order[start + 1:end]
+            dists = kernel.one_to_rows(self.vectors[order[start]], rest)
+            # Nearer half first, split at the median.
+            half = len(rest) // 2
+            part = np.argpartition(dists, half)
+            order[start + 1:end] = rest[part]
+            mus[node] = float(dists[part[half]])
+            his[node] = float(dists.max())
+            middle = start + 1 + half
+            insides[node] = new_node(start + 1, middle)
+            outsides[node] = new_node(middle, end)
+            stack += [insides[node], outsides[node]]
+        return (order, np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64),
+                np.array(mus, dtype=np.float64),
+                np.array(his, dtype=np.float64),
+                np.array(insides, dtype=np.int64),
+                np.array(outsides, dtype=np.int64))
+
+    def _search(self, u, bound):
+        """Get (positions, dists) of the rows of the nodes not skipped.
+
+        A level of the tree at a time, all its nodes in one pass.
+        bound(positions, dists) gives how far the rows can be and still
+        be wanted, given those found so far.
+
+        """
+        distances = self.kernel.to_rows(u)
+        positions = [np.empty(0, dtype=np.int64)]
+        dists = [np.empty(0, dtype=np.float32)]
+        tau = float('inf')
+        nodes = np.zeros(1 if len(self) else 0, dtype=np.int64)
+        while len(nodes):
+            is_leaf = self.insides[nodes] < 0
+            leaves = nodes[is_leaf]
+            inner = nodes[~is_leaf]
+            # The rows of the leaves and the vantage points of the others.
+            found = np.concatenate([
+                _ranges(self.starts[leaves], self.ends[leaves]),
+                self.starts[inner]])
+            found_dists = distances(found)
+            positions.append(found)
+            dists.append(found_dists)
+            positions, dists, tau = bound(np.concatenate(positions),
+                                          np.concatenate(dists))
+            positions, dists = [positions], [dists]
+            d = found_dists[len(found) - len(inner):].astype(np.float64)
+            mus = self.mus[inner]
+            inside_bounds = np.maximum(d - mus, 0)
+            outside_bounds = np.maximum(np.maximum(mus - d, 0),
+                                        d - self.his[inner])
+            tau += SLACK * (1 + tau)
+            nodes = np.concatenate([
+                self.insides[inner][inside_bounds <= tau],
+                self.outsides[inner][outside_bounds <= tau]])
+        return positions[0], dists[0]
+
+    def knn(self, u, k, eps=0.0):
+        """Get (ids, dists) of the k rows nearest vector u, nearest first.
+
+        With eps it is approximate, see the module doc.
+
+        """
+        def bound(positions, dists):
+            # Keep the k nearest, and children that might be nearer.
+            if len(dists) > k:
+                nearest = np.argpartition(dists, k - 1)[:k]
+                positions, dists = positions[nearest], dists[nearest]
+            tau = float(dists.max()) / (1 + eps) \
+                if len(dists) == k else float('inf')
+            return positions, dists, tau
+
+        if k <= 0:
+            return (np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.float32))
+        positions, dists = self._search(u, bound)
+        nearest = np.lexsort((positions, dists))
+        return self.order[positions[nearest]], dists[nearest]
+
+    def within(self, u, radius):
+        """Get (ids, dists) of the rows no further than radius from vector
+        u, nearest first"""
+        def bound(positions, dists):
+            near = dists <= radius
+            return positions[near], dists[near], radius
+
+        positions, dists = self._search(u, bound)
+        nearest = np.lexsort((positions, dists))
+        return self.order[positions[nearest]], dists[nearest]
+
+    def save(self, file_name):
+        """Write the tree to file_name, a .npz"""
+        with open(file_name, 'wb') as f:
+            np.savez(f, order=self.order, starts=self.starts, ends=self.ends,
+                     mus=self.mus, his=self.his, insides=self.insides,
+                     outsides=self.outsides,
+                     leaf_size=np.array(self.leaf_size))
+
+    @classmethod
+    def load(cls, file_name, vectors, distance=None):
+        """Read a tree of vectors written by save"""
+        with np.load(file_name) as data:
+            arrays = tuple(data[name] for name in
+                           ['order', 'starts', 'ends', 'mus', 'his',
+                            'insides', 'outsides'])
+            leaf_size = int(data['leaf_size'])
+        if len(arrays[0]) != len(vectors):
+            raise ValueError('{} is a tree of {} rows, not {}'.format(
+                file_name, len(arrays[0]), len(vectors)))
+        return cls(vectors, distance=distance, leaf_size=leaf_size,
+                   _arrays=arrays)
@@ -1,10 +1,12 @@
 
 """Wren - An interface for examining data and its relationships in a grid."""
 
+from collections import OrderedDict
 from io import BytesIO
 import logging
 import os
 import sys
+import weakref
 
 from PyQt5.QtGui import QImage, QPixmap
 
@@ -32,6 +34,10 @@ GRID_BACKGROUND = '#999'
 GRID_BACKGROUND_HOMEROW = '#777'
 CLIP_BACKGROUND = '#ff0'
 CLIP_BACKGROUND_HOMEROW = '#cc0'
+# Number of recently used Models (and Controllers) kept even when unused.
+ID_MAP_CAPACITY = 4096
+# Where Models are stored, 'sqlite' or 'log', see kvstore.py
+KVS_BACKEND = 'sqlite'
 
 # -- Miscellaneous ------------------------------------------------------------
 
@@ -121,20 +127,93 @@ class StyleSheet:
 
 
 class IDMap:
-    """Map of datum key to its Controller"""
-    def __init__(self):
-        # Map of key to object.
-        self.id_map = {}
+    """Map of datum key to its Controller (or Model), one object per key.
+
+    Objects are held by weak reference, so one that nothing else uses is
+    freed and loaded again the next time it is asked for. The `capacity`
+    most recently used are held strongly too, so those are not reloaded on
+    every lookup, and pinned ones are held until they are unpinned. While
+    an object is alive it is the one returned for its key.
+
+    """
+    def __init__(self, capacity=None):
+        if capacity is None:
+            capacity = ID_MAP_CAPACITY
+        self.capacity = capacity
+        self._reset()
 
     def get(self, key):
-        return self.id_map.get(key)
+        obj = self.id_map.get(key)
+        if obj is None:
+            obj = self._pinned.get(key)
+        if obj is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._use(key, obj)
+        return obj
 
     def set(self, key, obj):
-        self.id_map[key] = obj
+        try:
+            self.id_map[key] = obj
+        except TypeError:
+            # Can't be weakly referenced, hold it for good.
+            self._pinned[key] = obj
+            return
+        self._use(key, obj)
+
+    def values(self):
+        """List of the objects that are alive now"""
+        return list(self.id_map.values()) + [
+            obj for key, obj in self._pinned.items()
+            if key not in self.id_map]
+
+    def remove(self, key):
+        self.id_map.pop(key, None)
+        self._recent.pop(key, None)
+        self._pinned.pop(key, None)
+
+    def pin(self, key):
+        """Hold the object for key until unpin(key), however long unused."""
+        obj = self.id_map.get(key)
+        if obj is None:
+            obj = self._pinned.get(key)
+        if obj is None:
+            raise KeyError(key)
+        self._pinned[key] = obj
+
+    def unpin(self, key):
+        obj = self._pinned.pop(key, None)
+        if obj is not None and key in self.id_map:
+            self._use(key, obj)
+
+    def stats(self):
+        """Map of the counters and sizes, for checking the hit rate."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'live': len(self.id_map),
+            'recent': len(self._recent),
+            'pinned': len(self._pinned),
+        }
+
+    def _use(self, key, obj):
+        # Most recently used last, the oldest is let go past capacity.
+        self._recent[key] = obj
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.capacity:
+            self._recent.popitem(last=False)
+            self.evictions += 1
 
     def _reset(self):
         """Reset map for testing purposes only"""
-        self.id_map = {}
+        self.id_map = weakref.WeakValueDictionary()
+        self._recent = OrderedDict()
+        self._pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
 
 # -- Main ---------------------------------------------------------------------